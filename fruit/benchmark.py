@@ -0,0 +1,442 @@
+import argparse, json, math, multiprocessing, random, re, sys, time
+from timeit import default_timer
+
+from . import messaging
+from .rpc import game_pb2
+from .server import npcs
+from .server.gamestate import GameState, Player, Thing
+from .server.scheduler import UpdateScheduler
+
+args = None
+
+class Timer(object):
+
+    """Accumulates the time spent inside "with timer:" blocks, so that
+    a benchmark can exclude the setup it does between iterations.  The
+    benchmark also counts the operations it performed, so the result
+    can be given as the time per operation."""
+
+    def __init__(self):
+        self.elapsed = 0.0
+        self.operations = 0
+
+    def __enter__(self):
+        self.__start = default_timer()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.elapsed += default_timer() - self.__start
+
+class StubSocket(object):
+
+    """Stands in for a socket, so that an Rpc can be benchmarked without
+    any real networking.  Reads return the given chunks of data, over
+    and over again.  Writes are accepted in full, and thrown away
+    unless keep is true."""
+
+    def __init__(self, chunks=(), keep=False):
+        self.chunks = chunks
+        self.keep = keep
+        self.sent = []
+        self.__next_chunk = 0
+
+    def setblocking(self, flag):
+        pass
+
+    def fileno(self):
+        # Only used as a key in the socket map, which is never polled.
+        return id(self)
+
+    def getpeername(self):
+        return ("stub", 0)
+
+    def close(self):
+        pass
+
+    def recv_into(self, buffer):
+        chunk = self.chunks[self.__next_chunk]
+        self.__next_chunk = (self.__next_chunk + 1) % len(self.chunks)
+        buffer[:len(chunk)] = chunk
+        return len(chunk)
+
+    def send(self, data):
+        if self.keep:
+            self.sent.append(bytes(data))
+        return len(data)
+
+class StubConnection(object):
+
+    """Stands in for a FruitRequestHandler.  Messages are serialized,
+    as they would be by the real connection, and then thrown away."""
+
+    lagging = False
+
+    def send_rpc(self, msg, low_priority=False):
+        msg.SerializeToString()
+        return True
+
+    def cork(self):
+        pass
+
+    def uncork(self):
+        pass
+
+class _Receiver(messaging.Rpc):
+    @messaging.handles(game_pb2.Ping)
+    def __ping(self, data):
+        pass
+
+    @messaging.handles(game_pb2.WorldSnapshot)
+    def __snapshot(self, data):
+        pass
+
+def _sample_message(kind, number=0):
+    if kind == "small":
+        msg = game_pb2.Ping()
+        msg.sequence = number
+    else:
+        msg = game_pb2.WorldSnapshot()
+        msg.tick = number
+        for index in xrange(100):
+            state = msg.things.add()
+            state.id = index
+            for vector in (state.location, state.velocity):
+                vector.x, vector.y, vector.z = random.uniform(-500, 500), random.uniform(-500, 500), 0
+            state.angle = random.uniform(0, 360)
+            state.angular_velocity = 0
+
+    return msg
+
+def _encode_frames(messages):
+    """Return the MessageTable frame, and the frames for the messages,
+    as they would be sent by an Rpc."""
+
+    sender = messaging.Rpc(messaging.NetworkThread(), StubSocket(keep=True))
+    sender.handle_write()
+    table = "".join(sender.socket.sent)
+
+    del sender.socket.sent[:]
+    for msg in messages:
+        sender.send_rpc(msg)
+    sender.handle_write()
+
+    return table, "".join(sender.socket.sent)
+
+def framing(kind, arrival):
+    """Receive and dispatch a stream of messages.  The stream arrives
+    either coalesced (many frames per read) or fragmented (frames split
+    across reads, as a slow network or a large frame would)."""
+
+    count = 1000 if kind == "small" else 20
+    table, frames = _encode_frames([_sample_message(kind, number) for number in xrange(count)])
+
+    if arrival == "coalesced":
+        sizes = [16384]
+    elif kind == "small":
+        sizes = [1, 3, 7, 20, 50]
+    else:
+        # The usual TCP segment size on Ethernet.
+        sizes = [1448]
+
+    chunks = []
+    position = 0
+    while position < len(frames):
+        size = sizes[len(chunks) % len(sizes)]
+        chunks.append(frames[position:position + size])
+        position += size
+
+    network = messaging.NetworkThread(inbox_size=len(chunks) + count)
+    sock = StubSocket([table])
+    receiver = _Receiver(network, sock)
+
+    # Receive the MessageTable, so that the frames which follow can be parsed.
+    receiver.handle_read()
+    sock.chunks = chunks
+
+    def step(timer):
+        with timer:
+            for _ in xrange(len(chunks)):
+                receiver.handle_read()
+            network.process_messages()
+
+        timer.operations += count
+
+    return step
+
+def send_rpc(kind):
+    """Serialize messages and append them to the output buffer."""
+
+    messages = [_sample_message(kind, number) for number in xrange(100)]
+    sender = messaging.Rpc(messaging.NetworkThread(), StubSocket())
+
+    def step(timer):
+        with timer:
+            for msg in messages:
+                sender.send_rpc(msg)
+            sender.handle_write()
+
+        timer.operations += len(messages)
+
+    return step
+
+def variants():
+    """Encode and decode event arguments."""
+
+    values = [1, -42, 2.5, "w", "arrow_left", 100000]
+
+    def step(timer):
+        with timer:
+            for _ in xrange(100):
+                for value in values:
+                    messaging.Rpc.decode_variant(messaging.Rpc.encode_variant(value))
+
+        timer.operations += 100 * len(values)
+
+    return step
+
+def scheduler_churn(items):
+    """Simulate ticks of Thing.schedule_for_update and
+    Player.update_all's pop_due, with a tenth of the Things being
+    moved (and so rescheduled) each tick."""
+
+    scheduler = UpdateScheduler()
+    things = range(items)
+    clock = [0.0]
+    for thing in things:
+        scheduler.schedule(thing, random.uniform(0, 5))
+
+    def step(timer):
+        clock[0] += 1.0 / 30
+        moved = random.sample(things, items // 10)
+
+        with timer:
+            for thing in moved:
+                scheduler.schedule(thing, 0)
+            for thing in scheduler.pop_due(clock[0]):
+                scheduler.schedule(thing, clock[0] + random.choice((0.5, 5)))
+
+        timer.operations += 1
+
+    return step
+
+class StubNpc(Thing):
+
+    """A Thing with no physical body.  The update code only needs its
+    position, and attaching thousands of characters to the physics
+    engine would take much longer than the benchmarks themselves."""
+
+    def __init__(self, game_state):
+        Thing.__init__(self, game_state)
+        self.height = 1.75
+        self.radius = 0.4
+        self.node_path = game_state.render.attachNewNode(self.get_unique_name("Npc"))
+
+def _make_world(things, players):
+    """Create a GameState with some NPCs and players, scattered at
+    random over an area which grows with the number of Things, so
+    the number of Things near each player stays about the same."""
+
+    game_state = GameState(None)
+    size = 10 * math.sqrt(things + players)
+
+    def scatter(thing):
+        thing.move(random.uniform(0, size), random.uniform(0, size), 0)
+
+    npcs = [StubNpc(game_state) for _ in xrange(things)]
+    for npc in npcs:
+        scatter(npc)
+
+    avatars = [Player(game_state, StubConnection()) for _ in xrange(players)]
+    for avatar in avatars:
+        scatter(avatar)
+
+    return game_state, npcs, avatars
+
+def _wander(things):
+    for thing in things:
+        position = thing.node_path.getPos()
+        thing.move(position.x + random.uniform(-2, 2), position.y + random.uniform(-2, 2), 0)
+
+def update_known_things(things, players):
+    """Work out which Things each player should know about, as
+    players move around."""
+
+    game_state, npcs, avatars = _make_world(things, players)
+
+    def step(timer):
+        _wander(avatars)
+
+        with timer:
+            for avatar in avatars:
+                avatar.update_known_things()
+
+        timer.operations += len(avatars)
+
+    return step
+
+def update_all(things, players):
+    """Run whole ticks of Player.update_all, with the players and a
+    tenth of the NPCs moving each tick."""
+
+    game_state, npcs, avatars = _make_world(things, players)
+
+    def step(timer):
+        game_state.tick += 1
+        _wander(avatars)
+        _wander(random.sample(npcs, things // 10))
+
+        with timer:
+            Player.update_all()
+
+        # The clients acknowledge every snapshot straight away.
+        for avatar in avatars:
+            avatar.acknowledge_snapshot(game_state.tick)
+
+        timer.operations += 1
+
+    return step
+
+def npc_tick(things, players):
+    """Run whole ticks of an NpcStore full of walking NPCs, and of
+    Player.update_all sending them to the players."""
+
+    game_state, _, avatars = _make_world(0, players)
+    radius = 5 * math.sqrt(things + players)
+    store = npcs.NpcStore(game_state, 1.5, radius, seed=1)
+    store.spawn(things)
+
+    for avatar in avatars:
+        avatar.move(random.uniform(-radius, radius) * 0.7, random.uniform(-radius, radius) * 0.7, 0)
+
+    def step(timer):
+        game_state.tick += 1
+        _wander(avatars)
+
+        with timer:
+            store.update(1.0 / 30, time.time())
+            Player.update_all(store)
+
+        for avatar in avatars:
+            avatar.acknowledge_snapshot(game_state.tick)
+
+        timer.operations += 1
+
+    return step
+
+# The sizes of world which the update benchmarks use, as (Things, players).
+WORLD_SIZES = ((10, 1), (100, 10), (1000, 10), (1000, 100), (10000, 100), (10000, 500))
+
+# The NPC benchmarks need NumPy, and are about larger numbers of NPCs than players.
+NPC_SIZES = ((1000, 10), (10000, 10), (10000, 100), (20000, 20))
+
+BENCHMARKS = ([("framing.%s.%s" % (kind, arrival), framing, (kind, arrival))
+               for kind in ("small", "snapshot") for arrival in ("coalesced", "fragmented")] +
+              [("send_rpc.%s" % kind, send_rpc, (kind,)) for kind in ("small", "snapshot")] +
+              [("variants", variants, ())] +
+              [("scheduler_churn.%d" % items, scheduler_churn, (items,)) for items in (1000, 10000)] +
+              [("update_known_things.%dx%d" % size, update_known_things, size) for size in WORLD_SIZES] +
+              [("update_all.%dx%d" % size, update_all, size) for size in WORLD_SIZES] +
+              [("npc_tick.%dx%d" % size, npc_tick, size) for size in NPC_SIZES if npcs.numpy is not None])
+
+def measure(factory, parameters, repeat, min_time):
+    """Return the fastest time per operation, out of repeat runs of at
+    least min_time seconds each.  The fastest run is the one least
+    disturbed by whatever else the machine was doing."""
+
+    random.seed(1)
+    step = factory(*parameters)
+
+    # The first iteration often does extra work, such as telling the players about all the Things near them.
+    step(Timer())
+
+    best = None
+    for _ in xrange(repeat):
+        timer = Timer()
+        while timer.elapsed < min_time:
+            step(timer)
+
+        result = timer.elapsed / timer.operations
+        if best is None or result < best:
+            best = result
+
+    return best
+
+def run_isolated(factory, parameters):
+    """Run a benchmark in a new process, so that the class-level state
+    of the game (such as the list of all Things) left behind by one
+    benchmark doesn't affect the next."""
+
+    pool = multiprocessing.Pool(1)
+    try:
+        return pool.apply(measure, (factory, parameters, args.repeat, args.min_time))
+    finally:
+        pool.close()
+        pool.join()
+
+def parse_command_line():
+    global args
+
+    argparser = argparse.ArgumentParser(description="Benchmarks for the FriendlyFruit protocol and server "
+                                        "update code.")
+
+    argparser.add_argument("-k", "--filter", default="",
+                           help="only run benchmarks whose names match this regular expression", dest="filter")
+
+    argparser.add_argument("--repeat", default=5, type=int,
+                           help="run each benchmark this many times, and report the fastest", dest="repeat")
+
+    argparser.add_argument("--min-time", default=0.2, type=float,
+                           help="each run lasts at least this many seconds", dest="min_time")
+
+    argparser.add_argument("--baseline", default="benchmark-baseline.json",
+                           help="compare the results with this file", dest="baseline")
+
+    argparser.add_argument("--save-baseline", action="store_true",
+                           help="save the results as the new baseline", dest="save_baseline")
+
+    argparser.add_argument("--threshold", default=10, type=float,
+                           help="report a regression if a benchmark is this many percent slower than the baseline",
+                           dest="threshold")
+
+    args = argparser.parse_args()
+
+def run():
+    parse_command_line()
+
+    try:
+        with open(args.baseline) as baseline_file:
+            baseline = json.load(baseline_file)
+    except IOError:
+        baseline = {}
+
+    results = {}
+    regressions = []
+    pattern = re.compile(args.filter)
+
+    print "%-36s %12s %12s %8s" % ("benchmark", "us/op", "baseline", "change")
+
+    for name, factory, parameters in BENCHMARKS:
+        if not pattern.search(name):
+            continue
+
+        result = results[name] = run_isolated(factory, parameters)
+
+        if name in baseline:
+            change = (result / baseline[name] - 1) * 100
+            if change > args.threshold:
+                regressions.append(name)
+
+            print "%-36s %12.2f %12.2f %+7.1f%%%s" % (name, result * 1e6, baseline[name] * 1e6, change,
+                                                     " REGRESSION" if change > args.threshold else "")
+        else:
+            print "%-36s %12.2f %12s %8s" % (name, result * 1e6, "-", "-")
+
+        sys.stdout.flush()
+
+    if args.save_baseline:
+        baseline.update(results)
+        with open(args.baseline, "w") as baseline_file:
+            json.dump(baseline, baseline_file, indent=2, sort_keys=True)
+
+    if regressions:
+        print "%d benchmark(s) slower than the baseline: %s" % (len(regressions), ", ".join(regressions))
+        sys.exit(1)
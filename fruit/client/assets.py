@@ -0,0 +1,92 @@
+from direct.actor.Actor import Actor
+from panda3d.core import Filename, Point3, getModelPath
+
+class AssetCache(object):
+
+    """Loads each model once, and hands out copies of it.
+
+    The first time a model is needed, it is loaded into a template
+    Actor, which is never displayed.  Actors for the scene are made
+    with Actor's copy constructor, so they share the template's
+    geometry and animation data, but can be animated independently.
+    The model's bounds are calculated once, from the template.
+
+    Models can be preloaded in the background with preload.  Code
+    which mustn't stall the frame loop should ask for a model with
+    when_loaded, which calls back when the model is ready (straight
+    away, if it has already been loaded)."""
+
+    def __init__(self, loader):
+        self.loader = loader
+        self.__templates = {}
+        self.__bounds = {}
+        self.__waiting = {}
+
+    def resolve(self, model):
+        """Return the file to load for a model: the baked bam file if
+        there is one on the model path, otherwise the model itself."""
+
+        baked = Filename(model)
+        baked.setExtension("bam")
+        if baked.resolveFilename(getModelPath().getValue()):
+            return baked
+        else:
+            return Filename(model)
+
+    def load_model(self, model):
+        """Load a model which isn't animated, such as scenery."""
+
+        return self.loader.loadModel(self.resolve(model))
+
+    def is_loaded(self, model):
+        return model in self.__templates
+
+    def preload(self, model):
+        """Start loading a model in the background, if it hasn't been
+        loaded already."""
+
+        if model not in self.__templates and model not in self.__waiting:
+            self.__waiting[model] = []
+            self.loader.loadModel(self.resolve(model), callback=self.__model_loaded, extraArgs=[model])
+
+    def when_loaded(self, model, callback, *args):
+        if model in self.__templates:
+            callback(*args)
+        else:
+            self.preload(model)
+            self.__waiting[model].append((callback, args))
+
+    def __model_loaded(self, node_path, model):
+        # The model may already have been loaded by get_actor while we were waiting.  If the background load
+        # failed, loading it again in the foreground raises an exception saying why.
+        if model not in self.__templates:
+            self.__templates[model] = Actor(node_path if node_path is not None else self.resolve(model))
+
+        for callback, args in self.__waiting.pop(model, []):
+            callback(*args)
+
+    def __template(self, model):
+        template = self.__templates.get(model)
+        if template is None:
+            template = Actor(self.resolve(model))
+            self.__templates[model] = template
+
+        return template
+
+    def get_actor(self, model):
+        """Return a new Actor for the model.  If the model hasn't been
+        loaded yet, it is loaded now, which may take some time."""
+
+        return Actor(other=self.__template(model))
+
+    def get_height(self, model):
+        """Return the height of the model, at its original scale."""
+
+        bounds = self.__bounds.get(model)
+        if bounds is None:
+            point1 = Point3()
+            point2 = Point3()
+            self.__template(model).calcTightBounds(point1, point2)
+            bounds = self.__bounds[model] = (point1, point2)
+
+        return bounds[1].z - bounds[0].z
@@ -0,0 +1,61 @@
+class Entity(object):
+
+    """The client's record of a Thing which the server has told us
+    about.  The server refers to it by thing_id; tag is its
+    human-readable name.  node_path refers to the physical body (a character
+    controller), and actor is the 3D model which is attached to it,
+    or None if there isn't one (the player's own avatar has no
+    model, because the camera is inside it.)"""
+
+    def __init__(self, thing_id, tag, node_path, actor):
+        self.thing_id = thing_id
+        self.tag = tag
+        self.node_path = node_path
+        self.node = node_path.node()
+        self.actor = actor
+
+class EntityRegistry(object):
+
+    """Keeps track of the Entities on the client, indexed by ID, so
+    that we don't have to search the scene graph to find them.
+
+    States received from the server are buffered, rather than being
+    applied as soon as they arrive.  If several states arrive for the
+    same Entity, only the latest is kept.  The game loop applies all
+    the buffered states once per frame."""
+
+    def __init__(self):
+        self.__entities = {}
+        self.__pending_states = {}
+
+    def __len__(self):
+        return len(self.__entities)
+
+    def __iter__(self):
+        return self.__entities.itervalues()
+
+    def add(self, entity):
+        self.__entities[entity.thing_id] = entity
+
+    def get(self, thing_id):
+        return self.__entities.get(thing_id)
+
+    def remove(self, thing_id):
+        """Forget about an Entity, and any state which is waiting to be
+        applied to it.  The Entity is returned (or None, if there was no
+        such Entity) so the caller can clean up its nodes."""
+
+        self.__pending_states.pop(thing_id, None)
+        return self.__entities.pop(thing_id, None)
+
+    def buffer_state(self, thing_id, state):
+        self.__pending_states[thing_id] = state
+
+    def take_pending_states(self):
+        """Return a list of (entity, state) pairs for all the buffered
+        states, and empty the buffer."""
+
+        pending = [(self.__entities[thing_id], state) for thing_id, state in self.__pending_states.iteritems()
+                   if thing_id in self.__entities]
+        self.__pending_states.clear()
+        return pending
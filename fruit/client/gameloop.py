@@ -1,20 +1,31 @@
-import asyncore
-
 from direct.showbase.ShowBase import ShowBase
-from direct.actor.Actor import Actor
 from direct.interval.IntervalGlobal import Sequence
 from panda3d.bullet import BulletCapsuleShape, BulletCharacterControllerNode, BulletPlaneShape, BulletRigidBodyNode, \
     BulletWorld, ZUp
-from panda3d.core import DirectionalLight, Point3, VBase4, Vec3, deg2Rad
+from panda3d.core import ButtonRegistry, DirectionalLight, Point3, VBase4, Vec3, deg2Rad
 from pandac.PandaModules import loadPrcFile
 
+from .assets import AssetCache
+from .entities import Entity, EntityRegistry
+from .. import controls
+
 loadPrcFile("client-config.prc")
 
+# The model used for other players and NPCs.
+PLAYER_MODEL = "player.egg"
+
 class FriendlyFruit(ShowBase):
-    def __init__(self, player_tag):
+    def __init__(self, player_tag, network, server):
         ShowBase.__init__(self)
         self.__player_tag = player_tag
+        self.network = network
+        self.server = server
         self.__rotations = {}
+        self.entities = EntityRegistry()
+        self.assets = AssetCache(self.loader)
+
+        # Start loading the model for other players straight away, so it is ready when they appear.
+        self.assets.preload(PLAYER_MODEL)
 
         # Panda pollutes the global namespace.  Some of the extra globals can be referred to in nicer ways
         # (for example self.render instead of render).  The globalClock object, though, is only a global!  We
@@ -36,12 +47,34 @@ class FriendlyFruit(ShowBase):
         self.world.attachRigidBody(node)
 
         # Load the 3dWarehouse model.
-        cathedral = self.loader.loadModel("3dWarehouse_Reykjavik_Cathedral.egg")
+        cathedral = self.assets.load_model("3dWarehouse_Reykjavik_Cathedral.egg")
         cathedral.reparentTo(self.render)
         cathedral.setScale(0.5)
 
-        # Load the Blender model.
-        self.humanoid = Actor("player.egg")
+        # The Blender model is loaded in the background (see above), and walks up and down once it arrives.
+        self.assets.when_loaded(PLAYER_MODEL, self.__add_demo_humanoid)
+
+        # Create a light so we can see the scene.
+        dlight = DirectionalLight('dlight')
+        dlight.setColor(VBase4(2, 2, 2, 0))
+        dlnp = self.render.attachNewNode(dlight)
+        dlnp.setHpr(0, -60, 0)
+        self.render.setLight(dlnp)
+
+        # Create a task to update the scene regularly.
+        self.taskMgr.add(self.update, "UpdateTask")
+
+        # The controls are sampled at a fixed rate, rather than being sent to the server whenever a key is
+        # pressed or released, so that the number of messages doesn't depend on how the keys are bashed.
+        button_registry = ButtonRegistry.ptr()
+        self.__control_buttons = [(button_registry.findButton(key), control) for key, control in controls.KEYS]
+        self.__input_sequence = 0
+        self.__input_commands = []
+        self.__input_idle = True
+        self.taskMgr.doMethodLater(1.0 / controls.INPUT_RATE, self.__sample_controls, "SampleControlsTask")
+
+    def __add_demo_humanoid(self):
+        self.humanoid = self.assets.get_actor(PLAYER_MODEL)
         self.humanoid.setScale(0.5)
         self.humanoid.reparentTo(self.render)
         self.humanoid.loop("Walk")
@@ -57,19 +90,13 @@ class FriendlyFruit(ShowBase):
 
         self.humanoidPace.loop()
 
-        # Create a light so we can see the scene.
-        dlight = DirectionalLight('dlight')
-        dlight.setColor(VBase4(2, 2, 2, 0))
-        dlnp = self.render.attachNewNode(dlight)
-        dlnp.setHpr(0, -60, 0)
-        self.render.setLight(dlnp)
-
-        # Create a task to update the scene regularly.
-        self.taskMgr.add(self.update, "UpdateTask")
-
     # Update the scene by turning objects if necessary, and processing physics.
+
     def update(self, task):
-        asyncore.loop(timeout=0.01, use_poll=True, count=1)
+        self.network.process_messages()
+
+        for entity, state in self.entities.take_pending_states():
+            self.__move_entity(entity, *state)
 
         for node, angular_velocity in self.__rotations.iteritems():
             node.setAngularMovement(angular_velocity)
@@ -78,7 +105,34 @@ class FriendlyFruit(ShowBase):
         self.world.doPhysics(dt)
         return task.cont
 
-    def server_created_object(self, tag, height, radius):
+    def __sample_controls(self, task):
+        held = 0
+
+        # There is no keyboard to read if there is no window.
+        if self.mouseWatcherNode is not None:
+            for button, control in self.__control_buttons:
+                if self.mouseWatcherNode.isButtonDown(button):
+                    held |= control
+
+        self.__input_sequence += 1
+        self.__input_commands.append((self.__input_sequence, held))
+
+        if len(self.__input_commands) >= controls.COMMANDS_PER_BATCH:
+            # While nothing is held, there is nothing to tell the server, once it has been told the keys were
+            # released.
+            idle = not any(sampled for sequence, sampled in self.__input_commands)
+            if not (idle and self.__input_idle):
+                self.server.send_input(self.__input_commands)
+
+            self.__input_idle = idle
+            self.__input_commands = []
+
+        return task.again
+
+    def server_created_object(self, thing_id, tag, height, radius):
+        # If we already know about an object with this ID, the server must have replaced it.
+        self.server_removed_object(thing_id)
+
         # This shape is used for collision detection, preventing the player falling through the ground for
         # example.
         shape = BulletCapsuleShape(radius, height - 2 * radius, ZUp)
@@ -91,36 +145,81 @@ class FriendlyFruit(ShowBase):
         node_path = self.render.attachNewNode(node)
         self.world.attachCharacter(node_path.node())
 
+        entity = Entity(thing_id, tag, node_path, None)
+        self.entities.add(entity)
+
         # Does this object represent the player who is using this client?
         if tag == self.__player_tag:
             # If yes, attach the camera to the object, so the player's view follows the object.
             self.camera.reparentTo(node_path)
         else:
-            # If no, create a new Actor to represent the player or NPC.
-            humanoid = Actor("player.egg")
-            humanoid.setH(180)
-            humanoid.reparentTo(node_path)
-
-            # Scale the Actor so it is the same height as the bounding volume requested by the server.
-            point1 = Point3()
-            point2 = Point3()
-            humanoid.calcTightBounds(point1, point2)
-            humanoid.setScale(height / (point2.z - point1.z))
-
-            # If the 3D model has the origin point at floor level, we need to move it down by half the height
-            # of the bounding volume.  Otherwise it will hang in mid air, with its feet in the middle of the
-            # bounding volume.
-            humanoid.setZ(-height / 2)
-
-    def server_moves_thing(self, tag, loc_x, loc_y, loc_z, speed_x, speed_y, speed_z, angle, angular_velocity):
-        node_path = self.render.find("**/" + tag)
+            # If no, create a new Actor to represent the player or NPC.  If the model is still loading, this
+            # happens when it is ready, so that a lot of players arriving at once doesn't stall the game.
+            self.assets.when_loaded(PLAYER_MODEL, self.__add_actor, entity, height)
+
+    def __add_actor(self, entity, height):
+        # The object may have been removed while the model was loading.
+        if self.entities.get(entity.thing_id) is not entity:
+            return
+
+        humanoid = self.assets.get_actor(PLAYER_MODEL)
+        humanoid.setH(180)
+        humanoid.reparentTo(entity.node_path)
+
+        # Scale the Actor so it is the same height as the bounding volume requested by the server.
+        humanoid.setScale(height / self.assets.get_height(PLAYER_MODEL))
+
+        # If the 3D model has the origin point at floor level, we need to move it down by half the height
+        # of the bounding volume.  Otherwise it will hang in mid air, with its feet in the middle of the
+        # bounding volume.
+        humanoid.setZ(-height / 2)
+
+        entity.actor = humanoid
+
+    def server_resumed(self, player_tag, server):
+        """The connection to the server was lost, and has been resumed.
+        The server will tell us about all the objects we can see again,
+        so forget the ones we know about."""
+
+        for entity in list(self.entities):
+            self.server_removed_object(entity.thing_id)
+
+        self.__player_tag = player_tag
+        self.server = server
+
+    def server_removed_object(self, thing_id):
+        entity = self.entities.remove(thing_id)
+        if entity is None:
+            return
+
+        if self.camera.getParent() == entity.node_path:
+            self.camera.reparentTo(self.render)
+
+        self.__rotations.pop(entity.node, None)
+        self.world.removeCharacter(entity.node)
+
+        if entity.actor is not None:
+            entity.actor.cleanup()
+
+        entity.node_path.removeNode()
+
+    def server_sent_snapshot(self, states):
+        """Buffer the new states.  They are applied in update, so if
+        several snapshots arrive in the same frame, only the latest
+        state of each object is applied."""
+
+        for thing_id, state in states:
+            self.entities.buffer_state(thing_id, state)
+
+    def __move_entity(self, entity, loc_x, loc_y, loc_z, speed_x, speed_y, speed_z, angle, angular_velocity):
+        node_path = entity.node_path
         node_path.setPos(loc_x, loc_y, loc_z)
-        node_path.node().setLinearMovement(Vec3(speed_x, speed_y, speed_z), True)
+        entity.node.setLinearMovement(Vec3(speed_x, speed_y, speed_z), True)
 
         # I don't know why deg2Rad is required in the following line; I suspect it is a Panda bug.
         node_path.setH(deg2Rad(angle))
 
         if angular_velocity != 0:
-            self.__rotations[node_path.node()] = angular_velocity
-        elif node_path.node() in self.__rotations:
-            del self.__rotations[node_path.node()]
+            self.__rotations[entity.node] = angular_velocity
+        elif entity.node in self.__rotations:
+            del self.__rotations[entity.node]
@@ -1,59 +1,118 @@
-import argparse, asyncore, socket, sys
+import argparse, socket, sys, time
 
 from . import gameloop
-from .. import messaging
+from .. import messaging, snapshots
 from ..rpc import account_pb2, game_pb2
 
 args = None
 
+# If the connection to the server drops, we try to resume the session this many times, this many seconds
+# apart, before giving up.
+RECONNECT_ATTEMPTS = 5
+RECONNECT_DELAY = 2
+
 class ServerConnection(messaging.Rpc):
     """This class connects to the server, and handles messages that
     arrive.  The superclass provides a function to send messages back
     to the server (send_rpc).  These messages are sent asynchronously,
-    when asyncore.loop is entered.
+    by the network thread.
 
     The superclass also catches and displays exceptions.  It then
     invokes uncaught_exception; the client exits when this function is
     called, but the server does nothing because it should attempt to
-    carry on running."""
+    carry on running.
+
+    If the connection drops after the game has started, a new
+    connection is made, which resumes the session using the token the
+    server sent in the Start message."""
 
-    def __init__(self, sock):
-        messaging.Rpc.__init__(self, sock=sock)
-        self.app = None
+    def __init__(self, network, sock, app=None):
+        messaging.Rpc.__init__(self, network, sock)
+        self.app = app
+        self.session_token = None
+        self.__decoder = None
 
     def uncaught_exception(self, e):
         sys.exit(1)
 
-    def message_received(self, name, msg):
-        if name == "account_pb2.Kick":
-            sys.exit(0)
-        elif name == "account_pb2.TellUser":
-            data = account_pb2.TellUser()
-            data.ParseFromString(msg)
-            print data.message
-        elif name == "account_pb2.Error":
-            data = account_pb2.Error()
-            data.ParseFromString(msg)
-            print data.message
-        elif name == "game_pb2.Start":
-            data = game_pb2.Start()
-            data.ParseFromString(msg)
+    def connection_closed(self):
+        if self.session_token is None:
+            print "The server closed the connection."
+            sys.exit(1)
+
+        print "Lost the connection to the server.  Reconnecting..."
+        resume_session(self.network, self.app, self.session_token)
+
+    @messaging.handles(account_pb2.Kick)
+    def __kick(self, data):
+        sys.exit(0)
+
+    @messaging.handles(account_pb2.TellUser)
+    def __tell_user(self, data):
+        print data.message
+
+    @messaging.handles(account_pb2.Error)
+    def __error(self, data):
+        print data.message
+
+    @messaging.handles(game_pb2.Start)
+    def __start(self, data):
+        if data.HasField("position_precision"):
+            self.__decoder = snapshots.SnapshotDecoder(snapshots.Quantizer(data.position_precision,
+                                                                           data.angle_precision))
+        else:
+            self.__decoder = snapshots.SnapshotDecoder()
+
+        if data.HasField("session_token"):
+            self.session_token = data.session_token
+
+        if args.keepalive > 0:
+            keepalive = game_pb2.KeepaliveRequest()
+            keepalive.interval = args.keepalive
+            self.send_rpc(keepalive)
+
+        if self.app is None:
             self.__start_game(data.player_tag)
-        elif name == "game_pb2.AddObject":
-            data = game_pb2.AddObject()
-            data.ParseFromString(msg)
-            self.app.server_created_object(data.tag, data.height, data.radius)
-        elif name == "game_pb2.ThingState":
-            data = game_pb2.ThingState()
-            data.ParseFromString(msg)
-            self.app.server_moves_thing(data.tag, data.location.x, data.location.y, data.location.z,
-                                        data.velocity.x, data.velocity.y, data.velocity.z,
-                                        data.angle, data.angular_velocity)
-
-        elif name == "game_pb2.EventListen":
-            data = game_pb2.EventListen()
-            data.ParseFromString(msg)
-            self.app.accept(data.event, self.__send_event_to_server, [data.tag])
+        else:
+            self.app.server_resumed(data.player_tag, self)
+
+    @messaging.handles(game_pb2.AddObject)
+    def __add_object(self, data):
+        self.app.server_created_object(data.id, data.tag, data.height, data.radius)
+
+    @messaging.handles(game_pb2.RemoveObject)
+    def __remove_object(self, data):
+        self.__decoder.forget(data.id)
+        self.app.server_removed_object(data.id)
+
+    @messaging.handles(game_pb2.EventListen)
+    def __event_listen(self, data):
+        self.app.accept(data.event, self.__send_event_to_server, [data.tag])
+
+    @messaging.handles(game_pb2.WorldSnapshot)
+    def __snapshot_received(self, data):
+        states = self.__decoder.decode(data)
+
+        if self.__decoder.quantizer is not None:
+            # Acknowledge the snapshot so the server can use it as the base for future deltas.  If we couldn't
+            # decode it, acknowledging tick 0 asks the server to send full states instead.
+            ack = game_pb2.SnapshotAck()
+            ack.tick = data.tick if states is not None else 0
+            self.send_rpc(ack)
+
+        if states is not None:
+            self.app.server_sent_snapshot(states)
+
+    def send_input(self, commands):
+        """Send samples of the controls, as a list of (sequence
+        number, controls) pairs."""
+
+        batch = game_pb2.InputBatch()
+        for sequence, controls in commands:
+            command = batch.commands.add()
+            command.sequence = sequence
+            command.controls = controls
+        self.send_rpc(batch)
 
     def __send_event_to_server(self, tag, *args):
         data = game_pb2.EventOccurred()
@@ -62,7 +121,7 @@ class ServerConnection(messaging.Rpc):
         self.send_rpc(data)
 
     def __start_game(self, player_tag):
-        self.app = gameloop.FriendlyFruit(player_tag)
+        self.app = gameloop.FriendlyFruit(player_tag, self.network, self)
 
 def parse_command_line():
     global args
@@ -78,6 +137,10 @@ def parse_command_line():
     argparser.add_argument("--port", default=41810, type=int,
                            help="connect to the server on this port", dest="port")
 
+    argparser.add_argument("--keepalive", default=0, type=float,
+                           help="ask the server to resend every object's state this often (seconds), even if it "
+                           "hasn't changed", dest="keepalive")
+
     argparser.add_argument("--register", action="store_true",
                            help="register a new account on the server", dest="new_account")
 
@@ -85,11 +148,37 @@ def parse_command_line():
 
     args = argparser.parse_args()
 
+def resume_session(network, app, session_token, attempt=1):
+    """Reconnect to the server and resume the session.  The attempts
+    are scheduled on the game's task manager, rather than slept for,
+    so the game goes on running while we wait."""
+
+    def reconnect(task):
+        try:
+            sock = socket.create_connection((args.host, args.port))
+        except socket.error as e:
+            print "Couldn't reconnect: %s" % e
+            if attempt >= RECONNECT_ATTEMPTS:
+                print "Giving up."
+                sys.exit(1)
+
+            resume_session(network, app, session_token, attempt + 1)
+            return task.done
+
+        server_connection = ServerConnection(network, sock, app)
+        resume = account_pb2.Resume()
+        resume.session_token = session_token
+        server_connection.send_rpc(resume)
+        return task.done
+
+    app.taskMgr.doMethodLater(RECONNECT_DELAY, reconnect, "reconnect")
+
 def run():
     parse_command_line()
 
+    network = messaging.NetworkThread()
     sock = socket.create_connection((args.host, args.port))
-    server_connection = ServerConnection(sock)
+    server_connection = ServerConnection(network, sock)
 
     if args.new_account:
         register = account_pb2.NewAccount()
@@ -102,7 +191,11 @@ def run():
         login.password = args.password
         server_connection.send_rpc(login)
 
-    while True:
-        asyncore.loop(use_poll=True, count=1)
-        if server_connection.app is not None:
-            server_connection.app.run()
+    network.start()
+
+    # Wait for the server to start the game.  From then on, the game loop processes messages.
+    while server_connection.app is None:
+        network.process_messages()
+        time.sleep(0.01)
+
+    server_connection.app.run()
@@ -0,0 +1,23 @@
+# The controls a player can hold down.  The client sends the set of controls which are held as a bitmask of these
+# values, in InputCommand messages.
+FORWARD = 1
+BACKWARD = 2
+STRAFE_LEFT = 4
+STRAFE_RIGHT = 8
+TURN_LEFT = 16
+TURN_RIGHT = 32
+
+# The key which operates each control, as named by Panda.
+KEYS = (("w", FORWARD), ("s", BACKWARD), ("a", STRAFE_LEFT), ("d", STRAFE_RIGHT),
+        ("arrow_left", TURN_LEFT), ("arrow_right", TURN_RIGHT))
+
+# The client samples the controls INPUT_RATE times a second, and sends COMMANDS_PER_BATCH samples in each
+# InputBatch, so it sends INPUT_RATE / COMMANDS_PER_BATCH messages a second however fast the keys are pressed.
+INPUT_RATE = 30
+COMMANDS_PER_BATCH = 2
+
+def axis(controls, positive, negative, amount):
+    """Return amount if the positive control is held, -amount if the
+    negative one is, and 0 if neither or both are."""
+
+    return (amount if controls & positive else 0) - (amount if controls & negative else 0)
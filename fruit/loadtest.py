@@ -0,0 +1,340 @@
+import argparse, csv, json, random, socket, sys, time
+
+from . import controls, messaging
+from .rpc import account_pb2, game_pb2
+
+args = None
+
+# The controls a bot holds to walk around, in groups which don't make sense to hold together.
+MOVEMENT_CONTROLS = ((controls.FORWARD, controls.BACKWARD, 0), (controls.STRAFE_LEFT, controls.STRAFE_RIGHT, 0, 0),
+                     (controls.TURN_LEFT, controls.TURN_RIGHT, 0, 0))
+
+def percentile(ordered, fraction):
+    """Return the value below which the given fraction of the values
+    in the sorted list fall."""
+
+    if not ordered:
+        return None
+
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+class Statistics(object):
+
+    """The measurements made while a fixed number of bots were
+    connected."""
+
+    def __init__(self, bots):
+        self.bots = bots
+        self.start_time = time.time()
+        self.round_trip_times = []
+        self.tick_durations = []
+        self.first_tick = None
+        self.last_tick = None
+        self.snapshots = 0
+        self.thing_states = 0
+        self.errors = 0
+        self.disconnections = 0
+
+    def pong_received(self, round_trip_time, tick, tick_duration):
+        self.round_trip_times.append(round_trip_time)
+        self.tick_durations.append(tick_duration)
+
+        if self.first_tick is None:
+            self.first_tick = tick
+        self.last_tick = tick
+
+    def summarize(self, bytes_received):
+        duration = time.time() - self.start_time
+        rtts = sorted(self.round_trip_times)
+        ticks = sorted(self.tick_durations)
+
+        def ms(seconds):
+            return round(seconds * 1000, 2) if seconds is not None else None
+
+        return {"bots": self.bots,
+                "duration": round(duration, 2),
+                "rtt_p50_ms": ms(percentile(rtts, 0.5)),
+                "rtt_p90_ms": ms(percentile(rtts, 0.9)),
+                "rtt_p99_ms": ms(percentile(rtts, 0.99)),
+                "rtt_max_ms": ms(rtts[-1] if rtts else None),
+                "bytes_per_second": int(bytes_received / duration),
+                "snapshots_per_second": round(self.snapshots / duration, 1),
+                "thing_states_per_second": round(self.thing_states / duration, 1),
+                "server_ticks_per_second": (round((self.last_tick - self.first_tick) / duration, 1)
+                                            if self.first_tick is not None else None),
+                "tick_mean_ms": ms(sum(ticks) / len(ticks) if ticks else None),
+                "tick_p99_ms": ms(percentile(ticks, 0.99)),
+                "errors": self.errors,
+                "disconnections": self.disconnections}
+
+FIELDS = ("bots", "duration", "rtt_p50_ms", "rtt_p90_ms", "rtt_p99_ms", "rtt_max_ms", "bytes_per_second",
+          "snapshots_per_second", "thing_states_per_second", "server_ticks_per_second", "tick_mean_ms",
+          "tick_p99_ms", "errors", "disconnections")
+
+class Bot(messaging.Rpc):
+
+    """A simulated player.  It logs in like the real client, but
+    instead of reading the keyboard, it holds controls at random to
+    walk around, and it measures the round trip time to the server by
+    sending Pings.  The controls are sent in InputBatches at the same
+    rate as the client sends them."""
+
+    def __init__(self, swarm, sock, user_id):
+        messaging.Rpc.__init__(self, swarm.network, sock)
+        self.swarm = swarm
+        self.user_id = user_id
+        self.started = False
+        self.kicked = False
+        self.closed = False
+
+        self.__acknowledge = False
+        self.__controls = 0
+        self.__input_sequence = 0
+        self.__input_idle = True
+        self.__next_input = 0
+        self.__next_move = 0
+        self.__next_ping = 0
+        self.__ping_sequence = 0
+        self.__pings = {}
+
+    def connection_closed(self):
+        self.closed = True
+        if not self.kicked:
+            self.swarm.stats.disconnections += 1
+
+    @messaging.handles(account_pb2.Kick)
+    def __kick(self, data):
+        self.kicked = True
+        self.network.call(self.handle_close)
+
+    @messaging.handles(account_pb2.Error)
+    def __error(self, data):
+        # Registering a bot that already exists isn't an error worth reporting.
+        if data.message != "That user ID is already in use.":
+            print >> sys.stderr, "%s: %s" % (self.user_id, data.message)
+            self.swarm.stats.errors += 1
+
+    @messaging.handles(game_pb2.Start)
+    def __start(self, data):
+        self.started = True
+        self.__acknowledge = data.HasField("position_precision")
+
+    @messaging.handles(game_pb2.WorldSnapshot)
+    def __snapshot_received(self, data):
+        self.swarm.stats.snapshots += 1
+        self.swarm.stats.thing_states += len(data.things) + len(data.deltas)
+
+        if self.__acknowledge:
+            ack = game_pb2.SnapshotAck()
+            ack.tick = data.tick
+            self.send_rpc(ack)
+
+    @messaging.handles(game_pb2.Pong)
+    def __pong(self, data):
+        sent = self.__pings.pop(data.sequence, None)
+        if sent is not None:
+            self.swarm.stats.pong_received(time.time() - sent, data.tick, data.tick_duration)
+
+    def __send_input(self):
+        # Like the client, send nothing while idle, once the server knows nothing is held.
+        idle = self.__controls == 0
+        if idle and self.__input_idle:
+            return
+        self.__input_idle = idle
+
+        batch = game_pb2.InputBatch()
+        for _ in xrange(controls.COMMANDS_PER_BATCH):
+            self.__input_sequence += 1
+            command = batch.commands.add()
+            command.sequence = self.__input_sequence
+            command.controls = self.__controls
+        self.send_rpc(batch)
+
+    def act(self, now):
+        """Ping the server, change direction, and send the controls,
+        when it's time to."""
+
+        if not self.started or self.closed:
+            return
+
+        if now >= self.__next_ping:
+            self.__next_ping = now + args.ping_interval
+            self.__ping_sequence += 1
+            self.__pings[self.__ping_sequence] = now
+
+            ping = game_pb2.Ping()
+            ping.sequence = self.__ping_sequence
+            self.send_rpc(ping)
+
+        if now >= self.__next_move:
+            self.__next_move = now + random.uniform(0.5, 2) * args.move_interval
+            self.__controls = sum(random.choice(group) for group in MOVEMENT_CONTROLS)
+
+        if now >= self.__next_input:
+            self.__next_input = now + float(controls.COMMANDS_PER_BATCH) / controls.INPUT_RATE
+            self.__send_input()
+
+class Swarm(object):
+
+    """All the bots, and the statistics for the current stage of the
+    test."""
+
+    def __init__(self):
+        self.network = messaging.NetworkThread()
+        self.bots = []
+        self.stats = Statistics(0)
+
+    def connect(self, user_id):
+        sock = socket.create_connection((args.host, args.port))
+        return Bot(self, sock, user_id)
+
+    def wait(self, seconds, act=False):
+        """Handle messages for a while.  If act is true, the bots
+        walk around and ping the server."""
+
+        finish = time.time() + seconds
+        while True:
+            now = time.time()
+            if now >= finish:
+                break
+
+            self.network.process_messages()
+            if act:
+                for bot in self.bots:
+                    bot.act(now)
+
+            time.sleep(0.01)
+
+    def register(self, user_ids):
+        """Create accounts for the bots.  Accounts which already exist
+        are left alone."""
+
+        pending = []
+        for user_id in user_ids:
+            registration = self.connect(user_id)
+            msg = account_pb2.NewAccount()
+            msg.user_id = user_id
+            msg.password = args.password
+            registration.send_rpc(msg)
+            pending.append(registration)
+
+            # Don't have too many registrations in progress at once.
+            while len(pending) >= args.connect_rate:
+                self.wait(0.1)
+                pending = [other for other in pending if not other.closed]
+
+        while pending:
+            self.wait(0.1)
+            pending = [bot for bot in pending if not bot.closed]
+
+    def add_bots(self, count):
+        """Log in more bots, at the rate given on the command line."""
+
+        for _ in xrange(count):
+            bot = self.connect("%s%d" % (args.prefix, len(self.bots) + 1))
+            msg = account_pb2.Login()
+            msg.user_id = bot.user_id
+            msg.password = args.password
+            bot.send_rpc(msg)
+            self.bots.append(bot)
+            self.wait(1.0 / args.connect_rate, act=True)
+
+    def bytes_received(self):
+        return sum(bot.bytes_received for bot in self.bots)
+
+    def run_stage(self, count):
+        self.add_bots(count - len(self.bots))
+
+        # Let the new bots settle down before measuring.
+        self.wait(args.settle_time, act=True)
+
+        # Bots which failed to log in, or were disconnected, aren't counted.
+        self.stats = Statistics(sum(1 for bot in self.bots if bot.started and not bot.closed))
+        bytes_before = self.bytes_received()
+        self.wait(args.stage_time, act=True)
+        return self.stats.summarize(self.bytes_received() - bytes_before)
+
+def write_results(results, filename):
+    if filename.endswith(".json"):
+        with open(filename, "w") as output:
+            json.dump(results, output, indent=2)
+    else:
+        with open(filename, "wb") as output:
+            writer = csv.DictWriter(output, FIELDS)
+            writer.writeheader()
+            writer.writerows(results)
+
+def parse_command_line():
+    global args
+
+    argparser = argparse.ArgumentParser(description="Load tester for the FriendlyFruit server.  Logs in "
+                                        "increasing numbers of bots, and measures how the server copes.")
+
+    argparser.add_argument("--port", default=41810, type=int,
+                           help="connect to the server on this port", dest="port")
+
+    argparser.add_argument("--bots", default=10, type=int,
+                           help="number of bots in the first stage", dest="bots")
+
+    argparser.add_argument("--step", default=10, type=int,
+                           help="number of bots to add in each later stage", dest="step")
+
+    argparser.add_argument("--max-bots", type=int,
+                           help="stop after the stage with this many bots (default: just one stage)",
+                           dest="max_bots")
+
+    argparser.add_argument("--stage-time", default=30, type=float,
+                           help="measure each stage for this many seconds", dest="stage_time")
+
+    argparser.add_argument("--settle-time", default=5, type=float,
+                           help="wait this many seconds after adding bots before measuring",
+                           dest="settle_time")
+
+    argparser.add_argument("--connect-rate", default=20, type=int,
+                           help="log in at most this many bots per second", dest="connect_rate")
+
+    argparser.add_argument("--ping-interval", default=1, type=float,
+                           help="each bot pings the server this often (seconds)", dest="ping_interval")
+
+    argparser.add_argument("--move-interval", default=2, type=float,
+                           help="each bot changes direction about this often (seconds)", dest="move_interval")
+
+    argparser.add_argument("--prefix", default="bot",
+                           help="bots' user IDs are this followed by a number", dest="prefix")
+
+    argparser.add_argument("--password", default="bot",
+                           help="password for all the bots", dest="password")
+
+    argparser.add_argument("--register", action="store_true",
+                           help="create the bots' accounts first", dest="register")
+
+    argparser.add_argument("-o", "--output", default="loadtest.csv",
+                           help="write the results to this file (CSV, or JSON if it ends in .json)",
+                           dest="output")
+
+    argparser.add_argument("host", help="connect to this machine")
+
+    args = argparser.parse_args()
+
+def run():
+    parse_command_line()
+
+    swarm = Swarm()
+    swarm.network.start()
+
+    max_bots = args.max_bots or args.bots
+    stages = range(args.bots, max_bots + 1, args.step) if args.step > 0 else [args.bots]
+
+    if args.register:
+        swarm.register(["%s%d" % (args.prefix, number) for number in xrange(1, max_bots + 1)])
+
+    results = []
+    for count in stages:
+        result = swarm.run_stage(count)
+        print ", ".join("%s=%s" % (field, result[field]) for field in FIELDS)
+        results.append(result)
+
+        # Write the results after every stage, so they aren't lost if the server falls over.
+        write_results(results, args.output)
+
+    swarm.network.stop()
@@ -1,5 +1,219 @@
-import asynchat, struct, traceback
-from fruit.rpc import general_pb2
+import asynchat, asyncore, collections, errno, fcntl, os, socket, struct, threading, traceback
+from fruit.rpc import account_pb2, game_pb2, general_pb2
+
+# Every message type that can be sent, indexed by its name ("module.ClassName").
+_message_types = {}
+for _module in (account_pb2, game_pb2, general_pb2):
+    for _name in _module.DESCRIPTOR.message_types_by_name:
+        _message_types[_module.__name__[_module.__name__.rfind(".") + 1:] + "." + _name] = getattr(_module, _name)
+
+# The numbers we use to identify each message type we send.  Number 0 is reserved for the MessageTable which
+# tells the other end of the connection what the numbers mean.
+_outgoing_names = sorted(name for name in _message_types if name != "general_pb2.MessageTable")
+_outgoing_ids = dict((_message_types[name], index) for index, name in enumerate(_outgoing_names, 1))
+
+# Frames start with the length of the rest of the frame, followed by the message number.
+_frame_header = struct.Struct("!iH")
+_frame_length = struct.Struct("!i")
+_message_id = struct.Struct("!H")
+
+# Incoming data is received into a buffer of this size, which only grows if a single frame doesn't fit.
+RECEIVE_BUFFER_SIZE = 65536
+
+# Frames longer than this are rejected, because they are much longer than any message we send, and accepting
+# them would allow the other end to make us allocate as much memory as it liked.
+MAX_FRAME_SIZE = 1048576
+
+# Errors from recv_into which mean that the other end has gone away.
+_disconnected = frozenset((errno.ECONNRESET, errno.ENOTCONN, errno.ESHUTDOWN, errno.ECONNABORTED, errno.EPIPE,
+                           errno.EBADF))
+
+# Maps each subclass of Rpc to a dictionary of {message type: name of handler method}.
+_handlers_by_class = {}
+
+def _encode_frame(message_id, msg):
+    binary = msg.SerializeToString()
+    return _frame_header.pack(len(binary) + 2, message_id) + binary
+
+def encode_frame(msg):
+    """Return the frame which send_rpc would send for the message.
+    This lets a process which doesn't own the connection (such as a
+    zone worker) encode messages, and the owner pass them on with
+    send_frames without parsing them."""
+
+    return _encode_frame(_outgoing_ids[msg.__class__], msg)
+
+class ProtocolError(Exception):
+    """The other end of the connection sent something which doesn't
+    make sense, so the connection should be dropped."""
+
+def handles(message_type):
+    """Declare that the decorated method handles messages of the
+    given type.  The method is called with the parsed message."""
+
+    def decorate(method):
+        method.handled_message_type = message_type
+        return method
+
+    return decorate
+
+class _Trigger(asyncore.file_dispatcher):
+
+    """A pipe which wakes the network thread up when it is waiting
+    for activity on its sockets, for example because there is new
+    data to send."""
+
+    def __init__(self, map):
+        read_fd, self.__write_fd = os.pipe()
+        fcntl.fcntl(self.__write_fd, fcntl.F_SETFL, fcntl.fcntl(self.__write_fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+        asyncore.file_dispatcher.__init__(self, read_fd, map)
+        self.__pulled = False
+
+    def writable(self):
+        return False
+
+    def handle_read(self):
+        self.__pulled = False
+        try:
+            self.recv(4096)
+        except OSError:
+            pass
+
+    def pull(self):
+        # There's no point writing to the pipe again if the network thread hasn't woken up yet.
+        if self.__pulled:
+            return
+
+        self.__pulled = True
+        try:
+            os.write(self.__write_fd, "x")
+        except OSError as e:
+            # If the pipe is full, the network thread is going to wake up anyway.
+            if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                raise
+
+class NetworkThread(threading.Thread):
+
+    """All socket handling happens on this thread, so that network
+    activity never delays the simulation.  The thread has its own
+    asyncore socket map, which all the dispatchers belonging to the
+    client or server must use.
+
+    Messages which arrive are parsed on the network thread, then
+    queued in the inbox.  The simulation calls process_messages once
+    per tick to run the handlers for everything in the inbox.  The
+    inbox is bounded: when it is full, the network thread stops
+    reading from the sockets, and TCP flow control slows the senders
+    down.
+
+    Other threads send messages by appending them to an Rpc object's
+    output buffer (which is protected by a lock) and then waking the
+    network thread up."""
+
+    def __init__(self, inbox_size=10000, poll_timeout=1.0):
+        threading.Thread.__init__(self, name="Network")
+        self.daemon = True
+        self.map = {}
+        self.inbox_size = inbox_size
+        self.poll_timeout = poll_timeout
+
+        self.__inbox = collections.deque()
+        self.__events = collections.deque()
+        self.__calls = collections.deque()
+        self.__stalled = set()
+        self.__trigger = _Trigger(self.map)
+        self.__running = True
+
+        # Totals for all the connections, for the server's metrics.  The message counts include only messages
+        # which have a handler.
+        self.bytes_received = 0
+        self.bytes_sent = 0
+        self.messages_received = 0
+        self.messages_sent = 0
+
+    def run(self):
+        while self.__running:
+            self.poll(self.poll_timeout)
+
+    def stop(self):
+        """Stop the thread, and wait for it to finish.  This doesn't
+        close the connections."""
+
+        self.__running = False
+        self.wake()
+        self.join()
+
+    def poll(self, timeout):
+        asyncore.loop(timeout=timeout, use_poll=True, map=self.map, count=1)
+
+        while self.__calls:
+            function, args = self.__calls.popleft()
+            function(*args)
+
+        if self.__stalled and not self.inbox_full():
+            for connection in list(self.__stalled):
+                self.__stalled.discard(connection)
+                connection.resume()
+
+    def wake(self):
+        self.__trigger.pull()
+
+    def call(self, function, *args):
+        """Run a function on the network thread."""
+
+        self.__calls.append((function, args))
+        self.wake()
+
+    def queued_messages(self):
+        """Return the number of messages and events waiting for
+        process_messages."""
+
+        return len(self.__inbox) + len(self.__events)
+
+    def inbox_full(self):
+        return len(self.__inbox) >= self.inbox_size
+
+    def post(self, connection, function, *args):
+        """Queue a message handler to be run by process_messages.  The
+        caller must check inbox_full first."""
+
+        self.__inbox.append((connection, function, args))
+
+    def post_event(self, connection, function, *args):
+        """Queue a function to be run by process_messages, even if the
+        inbox is full.  This is used for events which must not be lost,
+        such as connections closing."""
+
+        self.__events.append((connection, function, args))
+
+    def stall(self, connection):
+        """The connection has stopped reading because the inbox is
+        full.  It is resumed when there is room in the inbox."""
+
+        self.__stalled.add(connection)
+
+    def process_messages(self):
+        """Run the handlers for the messages which have arrived.  This
+        must be called from the simulation thread.  Only the messages
+        which were in the inbox when it was called are processed, so
+        a flood of incoming messages can't keep it running forever."""
+
+        was_full = self.inbox_full()
+
+        # Count the queued events before running anything, so that a connection's messages are always handled
+        # before the event saying that it closed.
+        for queue, count in ((self.__inbox, len(self.__inbox)), (self.__events, len(self.__events))):
+            for _ in xrange(count):
+                connection, function, args = queue.popleft()
+                try:
+                    function(*args)
+                except Exception as e:
+                    traceback.print_exc()
+                    connection.uncaught_exception(e)
+                    self.call(connection.handle_close)
+
+        if was_full:
+            self.wake()
 
 class Rpc(asynchat.async_chat):
 
@@ -9,48 +223,282 @@ class Rpc(asynchat.async_chat):
     any exceptions that occur, because async_chat doesn't show them in
     a convenient form.
 
+    The socket is handled by a NetworkThread.  Message handlers are
+    run on the thread which calls the NetworkThread's
+    process_messages method, and send_rpc may also be called from
+    that thread.  When the connection is closed, connection_closed is
+    called on the same thread.
+
+    Rather than sending the name of each message, we send a small
+    number.  When a connection is made, each end sends a MessageTable
+    listing the names of the messages it will send, in number order.
+    The receiver uses the table to build a dispatch table, mapping
+    each number to the message type and the method which handles it.
+    (Handlers are declared with the handles decorator.)  Messages
+    which have no handler are ignored.
+
+    Incoming data is read straight into a preallocated buffer.  After
+    each read, every complete frame in the buffer is parsed directly
+    from the buffer (through a memoryview, so the data isn't copied),
+    and only the incomplete frame at the end, if any, is moved back to
+    the start.  This replaces async_chat's terminator handling, which
+    copied the data several times and needed two callbacks for every
+    frame.
+
+    Outgoing frames are appended to a single output buffer, which is
+    written to the socket as quickly as the other end will accept it.
+    While the connection is corked, frames are held back and then
+    added to the output buffer together when it is uncorked, so a
+    whole tick's worth of messages goes out in one write.
+
+    If the other end doesn't keep up, and more than high_water_mark
+    bytes are waiting to be sent, the connection is marked as lagging.
+    Low priority messages are dropped (send_rpc returns False) until
+    the backlog falls below half the high water mark.  This stops a
+    slow client from using an unlimited amount of memory.
+
     The uncaught_exception method is overridden in the client; the
     client should exit following an uncaught exception, while the
-    server should attempt to carry on."""
+    server should attempt to carry on.  It is always called on the
+    thread which runs the message handlers, even when the exception
+    happened while a frame was being parsed on the network thread."""
+
+    high_water_mark = 262144
+
+    def __init__(self, network, sock=None):
+        asynchat.async_chat.__init__(self, sock, network.map)
+        self.network = network
+
+        self.__ibuffer = bytearray(RECEIVE_BUFFER_SIZE)
+        self.__ibuffer_used = 0
+        self.__stalled = False
+
+        # Statistics for this connection.
+        self.bytes_received = 0
+        self.bytes_sent = 0
+        self.messages_received = 0
+        self.messages_sent = 0
+
+        self.__olock = threading.Lock()
+        self.__obuffer = bytearray()
+        self.__corked_frames = None
+        self.__corked_bytes = 0
+        self.lagging = False
+
+        self.__dispatch = {}
+
+        table = general_pb2.MessageTable()
+        table.names.extend(_outgoing_names)
+        self.__send_frame(_encode_frame(0, table))
+
+    @classmethod
+    def __handlers(cls):
+        handlers = _handlers_by_class.get(cls)
+        if handlers is None:
+            handlers = {}
+            for name in dir(cls):
+                message_type = getattr(getattr(cls, name), "handled_message_type", None)
+                if message_type is not None:
+                    handlers[message_type] = name
 
-    def __init__(self, server=None, sock=None, addr=None):
-        asynchat.async_chat.__init__(self, sock)
-        self.__ibuffer = ""
-        self.__awaiting_count = True
-        self.set_terminator(4)
+            _handlers_by_class[cls] = handlers
 
-    def collect_incoming_data(self, data):
-        self.__ibuffer += data
+        return handlers
+
+    def __message_table_received(self, table):
+        handlers = self.__handlers()
+
+        for index, name in enumerate(table.names, 1):
+            message_type = _message_types.get(name)
+            handler_name = handlers.get(message_type)
+            if handler_name is not None:
+                self.__dispatch[index] = (message_type, getattr(self, handler_name))
 
     def uncaught_exception(self, e):
         pass
 
-    def found_terminator(self):
+    def connection_closed(self):
+        pass
+
+    def handle_close(self):
+        if self.socket is not None:
+            self.close()
+            self.network.post_event(self, self.connection_closed)
+
+    def readable(self):
+        return not self.__stalled
+
+    def handle_read(self):
         try:
-            if self.__awaiting_count:
-                self.__awaiting_count = False
-                message_size = struct.unpack('!i', self.__ibuffer)[0]
-                self.set_terminator(message_size)
-            else:
-                self.__awaiting_count = True
-                self.set_terminator(4)
+            received = self.socket.recv_into(memoryview(self.__ibuffer)[self.__ibuffer_used:])
+        except socket.error as e:
+            if e.args[0] in _disconnected:
+                self.handle_close()
+                return
+            elif e.args[0] in (errno.EWOULDBLOCK, errno.EAGAIN):
+                return
+            raise
+
+        if received == 0:
+            self.handle_close()
+            return
+
+        self.__ibuffer_used += received
+        self.bytes_received += received
+        self.network.bytes_received += received
+        self.__process_frames()
+
+    def resume(self):
+        """Called by the network thread when there is room in the inbox
+        again."""
+
+        self.__stalled = False
+        self.__process_frames()
+
+    def __process_frames(self):
+        """Parse every complete frame in the receive buffer and queue
+        it for the simulation thread, then move any partial frame to
+        the start of the buffer, making sure the buffer is big enough
+        to receive the rest of it.  If the inbox fills up, we stop, and
+        leave the remaining frames in the buffer."""
 
-                name, msg = self.__ibuffer.split("\0", 1)
-                self.message_received(name, msg)
+        try:
+            buf = self.__ibuffer
+            view = memoryview(buf)
+            start = 0
+            end = self.__ibuffer_used
+            frame_length = None
+
+            while end - start >= 4:
+                frame_length = _frame_length.unpack_from(buf, start)[0]
+                if frame_length < 2 or frame_length > MAX_FRAME_SIZE:
+                    raise ProtocolError("Received a frame with invalid length %d." % frame_length)
+
+                if end - start - 4 < frame_length:
+                    break
+
+                message_id = _message_id.unpack_from(buf, start + 4)[0]
+                if message_id == 0:
+                    # The MessageTable is needed to parse the following frames, so it is handled here.
+                    data = general_pb2.MessageTable()
+                    data.ParseFromString(view[start + 6:start + 4 + frame_length])
+                    self.__message_table_received(data)
+                else:
+                    entry = self.__dispatch.get(message_id)
+                    if entry is not None:
+                        if self.network.inbox_full():
+                            self.__stalled = True
+                            self.network.stall(self)
+                            frame_length = None
+                            break
+
+                        message_type, handler = entry
+                        data = message_type()
+                        data.ParseFromString(view[start + 6:start + 4 + frame_length])
+                        self.network.post(self, handler, data)
+                        self.messages_received += 1
+                        self.network.messages_received += 1
+
+                start += 4 + frame_length
+                frame_length = None
+
+            # The buffer can't be resized while a memoryview refers to it.
+            del view
 
-            self.__ibuffer = ""
+            remaining = end - start
+            if remaining and start:
+                buf[:remaining] = buf[start:end]
+            self.__ibuffer_used = remaining
+
+            if frame_length is not None and frame_length + 4 > len(buf):
+                buf.extend(bytearray(frame_length + 4 - len(buf)))
         except Exception as e:
+            # This runs on the network thread, so uncaught_exception is passed to the thread which handles the
+            # messages, like everything else.  (In the client, it exits, and exiting from the network thread
+            # would only stop that thread.)
             traceback.print_exc()
-            self.uncaught_exception(e)
+            self.network.post_event(self, self.uncaught_exception, e)
             raise
 
-    def send_rpc(self, msg):
-        rpc_name = msg.__module__
-        rpc_name = rpc_name[rpc_name.rfind(".") + 1:]
-        rpc_name = rpc_name + "." + msg.__class__.__name__
-        binary = rpc_name + "\0" + msg.SerializeToString()
-        length = struct.pack("!i", len(binary))
-        self.push(length + binary)
+    def send_rpc(self, msg, low_priority=False):
+        """Queue a message for sending.  Returns False if the message
+        was dropped, because it was low priority and the connection is
+        lagging."""
+
+        if low_priority and self.lagging:
+            return False
+
+        self.__send_frame(encode_frame(msg))
+        self.messages_sent += 1
+        self.network.messages_sent += 1
+        return True
+
+    def send_frames(self, frames, count):
+        """Queue frames made by encode_frame (joined into one string),
+        which contain count messages in all."""
+
+        self.__send_frame(frames)
+        self.messages_sent += count
+        self.network.messages_sent += count
+
+    def __send_frame(self, frame):
+        if self.__corked_frames is not None:
+            self.__corked_frames.append(frame)
+            self.__corked_bytes += len(frame)
+            self.__check_lagging()
+        else:
+            with self.__olock:
+                self.__obuffer += frame
+                self.__check_lagging()
+            self.network.wake()
+
+    def cork(self):
+        """Hold back outgoing messages until uncork is called."""
+
+        if self.__corked_frames is None:
+            self.__corked_frames = []
+
+    def uncork(self):
+        """Send all the messages which were held back while the
+        connection was corked."""
+
+        if self.__corked_frames is not None:
+            frames = self.__corked_frames
+            self.__corked_frames = None
+
+            if frames:
+                with self.__olock:
+                    self.__obuffer += "".join(frames)
+                    self.__corked_bytes = 0
+                    self.__check_lagging()
+                self.network.wake()
+            else:
+                self.__corked_bytes = 0
+
+    def buffered_bytes(self):
+        """Return the number of bytes waiting to be sent."""
+
+        return len(self.__obuffer) + self.__corked_bytes
+
+    def __check_lagging(self):
+        if self.lagging:
+            self.lagging = self.buffered_bytes() > self.high_water_mark / 2
+        else:
+            self.lagging = self.buffered_bytes() > self.high_water_mark
+
+    def writable(self):
+        return bool(self.__obuffer) or not self.connected
+
+    def handle_write(self):
+        with self.__olock:
+            if self.__obuffer and self.connected:
+                sent = self.send(self.__obuffer)
+                if sent:
+                    del self.__obuffer[:sent]
+                    self.bytes_sent += sent
+                    self.network.bytes_sent += sent
+                    if self.lagging:
+                        self.__check_lagging()
 
     @staticmethod
     def encode_variant(val):
@@ -0,0 +1,165 @@
+import Queue, multiprocessing, threading, traceback
+
+from .credentials import hash_password, verify_password
+from .. import config
+
+class AccountExists(Exception):
+    """An account with the requested user ID already exists."""
+
+class MemoryBackend(object):
+
+    """Keeps accounts in a dictionary.  They are lost when the server
+    stops, so this is only useful for testing and benchmarking, when
+    you don't want to depend on a database."""
+
+    def __init__(self):
+        self.__users = {}
+        self.__lock = threading.Lock()
+
+    def find_user(self, user_id):
+        with self.__lock:
+            user = self.__users.get(user_id)
+            return dict(user) if user is not None else None
+
+    def create_user(self, user):
+        with self.__lock:
+            if user["user_id"] in self.__users:
+                raise AccountExists(user["user_id"])
+
+            self.__users[user["user_id"]] = dict(user)
+
+    def set_password_hash(self, user_id, password_hash):
+        with self.__lock:
+            user = self.__users[user_id]
+            user.pop("password", None)
+            user["password_hash"] = password_hash
+
+class MongoBackend(object):
+
+    """Keeps accounts in MongoDB.  The connection is shared by all the
+    worker threads; PyMongo gives each thread its own socket from a
+    pool, so the workers don't have to wait for each other."""
+
+    def __init__(self, host, port, prefix, pool_size):
+        # Imported here so that the server can run with the memory backend when PyMongo isn't installed.
+        import pymongo, pymongo.errors
+        self.__errors = pymongo.errors
+
+        db = pymongo.Connection(host, port, max_pool_size=pool_size)
+        for name in prefix.split("."):
+            db = getattr(db, name)
+
+        self.__users = db.users
+        self.__users.create_index("user_id", unique=True)
+
+    def find_user(self, user_id):
+        return self.__users.find_one({"user_id": user_id})
+
+    def create_user(self, user):
+        try:
+            self.__users.insert(dict(user), safe=True)
+        except self.__errors.DuplicateKeyError:
+            raise AccountExists(user["user_id"])
+
+    def set_password_hash(self, user_id, password_hash):
+        self.__users.update({"user_id": user_id},
+                            {"$set": {"password_hash": password_hash}, "$unset": {"password": 1}}, safe=True)
+
+def open_backend(pool_size):
+    """Create the backend named in the database section of the
+    configuration file."""
+
+    backend = config.get("database", "backend")
+    if backend == "mongo":
+        return MongoBackend(config.get("database", "host"), config.getint("database", "port"),
+                            config.get("database", "prefix"), pool_size)
+    elif backend == "memory":
+        return MemoryBackend()
+    else:
+        raise ValueError("Unknown account backend %r" % backend)
+
+class AccountService(object):
+
+    """Runs account requests on a pool of worker threads, so that a
+    slow database doesn't hold up the game.
+
+    Each request takes a connection and a callback.  When the request
+    finishes, the callback is queued on the network thread, and run
+    by process_messages at the start of the next tick, just like a
+    message handler.  It is called with two arguments: the result, and
+    the exception that was raised (or None if the request succeeded).
+    If the callback raises an exception, the connection is dropped, as
+    it would be for a message handler.
+
+    Passwords are hashed by a pool of processes rather than threads.
+    Hashing is deliberately CPU-bound, and in separate processes it
+    can't compete with the simulation thread for the interpreter
+    lock."""
+
+    def __init__(self, network, backend, workers, hash_processes, hash_iterations):
+        self.network = network
+        self.backend = backend
+        self.hash_iterations = hash_iterations
+        self.__requests = Queue.Queue()
+
+        # Create the processes before starting any threads, because forking a process with running threads
+        # isn't safe.
+        self.__hashers = multiprocessing.Pool(hash_processes)
+
+        for _ in xrange(workers):
+            worker = threading.Thread(target=self.__work, name="Account worker")
+            worker.daemon = True
+            worker.start()
+
+    def __work(self):
+        while True:
+            connection, function, args, callback = self.__requests.get()
+
+            try:
+                result = function(*args)
+            except AccountExists as e:
+                self.network.post_event(connection, callback, None, e)
+            except Exception as e:
+                # Unexpected errors, such as the database being down, are printed here because the callback
+                # probably won't be able to say much more than that something went wrong.
+                traceback.print_exc()
+                self.network.post_event(connection, callback, None, e)
+            else:
+                self.network.post_event(connection, callback, result, None)
+
+    def __submit(self, connection, function, args, callback):
+        self.__requests.put((connection, function, args, callback))
+
+    def create_user(self, connection, user_id, password, callback):
+        """Create an account.  If the user ID is already in use, the
+        callback receives an AccountExists exception."""
+
+        self.__submit(connection, self.__create_user, (user_id, password), callback)
+
+    def authenticate(self, connection, user_id, password, callback):
+        """Check a user's password.  The result is the account, or
+        None if there is no such account or the password is wrong."""
+
+        self.__submit(connection, self.__authenticate, (user_id, password), callback)
+
+    def __hash(self, password):
+        return self.__hashers.apply(hash_password, (password, self.hash_iterations))
+
+    def __create_user(self, user_id, password):
+        self.backend.create_user({"user_id": user_id, "password_hash": self.__hash(password)})
+
+    def __authenticate(self, user_id, password):
+        user = self.backend.find_user(user_id)
+        if user is None:
+            return None
+
+        if "password_hash" in user:
+            if not self.__hashers.apply(verify_password, (password, user["password_hash"])):
+                return None
+        elif user.get("password") == password:
+            # Accounts created before passwords were hashed have them in plain text.  Replace it with a hash.
+            self.backend.set_password_hash(user_id, self.__hash(password))
+        else:
+            return None
+
+        return user
@@ -0,0 +1,382 @@
+import Queue, errno, mmap, operator, os, signal, struct, sys, threading, time, traceback
+
+from .gamestate import Player
+from .npcs import STATE_ARRAYS
+from .. import config
+
+# NumPy is only needed to load saved NPCs, and there can't be any NPCs without it.
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# A checkpoint starts with a header giving the magic number, the format version, the checkpoint's sequence
+# number, the time it was saved, the number of NPCs, the number of players, and the length of the session key.
+# The key follows, padded to a multiple of 8 bytes so that the NPC arrays after it are aligned.  Each array is
+# saved whole, as little-endian doubles, in the order of STATE_ARRAYS.  The players' locations come last.
+_CHECKPOINT_MAGIC = "FFWC"
+_CHECKPOINT_VERSION = 1
+_CHECKPOINT_HEADER = struct.Struct("<4sIQdIIH")
+
+# The log starts with the sequence number of the checkpoint it follows, and is then just a series of location
+# records.
+_LOG_MAGIC = "FFWL"
+_LOG_HEADER = struct.Struct("<4sQ")
+
+# A location record is the length of the user ID, the user ID in UTF-8, and then x, y, z and heading.
+_NAME_LENGTH = struct.Struct("<H")
+_LOCATION = struct.Struct("<4d")
+
+class CorruptCheckpoint(Exception):
+    """The checkpoint file can't be read."""
+
+def _pack_location(user_id, location):
+    name = user_id.encode("utf-8")
+    return _NAME_LENGTH.pack(len(name)) + name + _LOCATION.pack(*location)
+
+def _unpack_locations(data, offset, locations, count=None):
+    """Read location records from data, starting at offset, into the
+    locations dictionary.  Reads count records, or as many as there
+    are if count is None.  Returns the offset after the last complete
+    record; anything after that is a record which was only partly
+    written."""
+
+    read = 0
+    while count is None or read < count:
+        if offset + _NAME_LENGTH.size > len(data):
+            break
+
+        name_length, = _NAME_LENGTH.unpack_from(data, offset)
+        end = offset + _NAME_LENGTH.size + name_length + _LOCATION.size
+        if end > len(data):
+            break
+
+        name = data[offset + _NAME_LENGTH.size:offset + _NAME_LENGTH.size + name_length]
+        locations[name.decode("utf-8")] = _LOCATION.unpack_from(data, end - _LOCATION.size)
+        offset = end
+        read += 1
+
+    if count is not None and read < count:
+        raise CorruptCheckpoint("The checkpoint is truncated.")
+
+    return offset
+
+class SavedWorld(object):
+
+    """The state of the world as it was last saved.  npcs is a
+    dictionary of the NPC arrays, in the form taken by
+    NpcStore.restore, or None if there were no NPCs.  The arrays may
+    be views of the memory-mapped checkpoint, so they should be
+    copied rather than kept.  locations maps each user ID to where
+    that player was (x, y, z, heading) when they were last seen."""
+
+    def __init__(self, sequence=0, saved_time=None, session_key=None, npcs=None, locations=None):
+        self.sequence = sequence
+        self.saved_time = saved_time
+        self.session_key = session_key
+        self.npcs = npcs
+        self.locations = locations if locations is not None else {}
+
+def _entry_size(shape):
+    return reduce(operator.mul, shape, 1)
+
+def _read_checkpoint(data):
+    if len(data) < _CHECKPOINT_HEADER.size:
+        raise CorruptCheckpoint("The checkpoint is truncated.")
+
+    magic, version, sequence, saved_time, npc_count, player_count, key_length = \
+        _CHECKPOINT_HEADER.unpack_from(data, 0)
+    if magic != _CHECKPOINT_MAGIC:
+        raise CorruptCheckpoint("The file isn't a checkpoint.")
+    if version != _CHECKPOINT_VERSION:
+        raise CorruptCheckpoint("The checkpoint is version %d, but only version %d can be read." %
+                                (version, _CHECKPOINT_VERSION))
+
+    offset = _CHECKPOINT_HEADER.size
+    session_key = data[offset:offset + key_length]
+    offset += key_length
+    offset += -offset % 8
+
+    # The arrays are used straight from the mapped file, without being parsed or copied; NpcStore.restore
+    # copies them into its own arrays in one go.
+    npc_bytes = npc_count * 8 * sum(_entry_size(shape) for name, shape in STATE_ARRAYS)
+    if offset + npc_bytes > len(data):
+        raise CorruptCheckpoint("The checkpoint is truncated.")
+
+    npcs = None
+    if npc_count and numpy is not None:
+        npcs = {}
+        array_offset = offset
+        for name, shape in STATE_ARRAYS:
+            size = npc_count * _entry_size(shape)
+            npcs[name] = numpy.frombuffer(data, "<f8", size, array_offset).reshape((npc_count,) + shape)
+            array_offset += size * 8
+    elif npc_count:
+        print >>sys.stderr, "NumPy isn't installed, so the %d saved NPCs won't be restored." % npc_count
+
+    offset += npc_bytes
+    locations = {}
+    _unpack_locations(data, offset, locations, player_count)
+    return SavedWorld(sequence, saved_time, session_key, npcs, locations)
+
+def _replay_log(filename, saved):
+    """Apply the location records in the log to saved, if the log
+    follows its checkpoint.  A log left over from an older checkpoint
+    is ignored, since the checkpoint already includes it."""
+
+    try:
+        with open(filename, "rb") as log:
+            data = log.read()
+    except IOError as e:
+        if e.errno == errno.ENOENT:
+            return
+        raise
+
+    if len(data) < _LOG_HEADER.size:
+        return
+
+    magic, sequence = _LOG_HEADER.unpack_from(data, 0)
+    if magic == _LOG_MAGIC and sequence == saved.sequence:
+        _unpack_locations(data, _LOG_HEADER.size, saved.locations)
+
+def load(filename):
+    """Load the world saved by a Checkpointer.  The checkpoint is
+    memory-mapped, so loading it doesn't involve reading it all in and
+    parsing it; the NPC arrays in the result point straight at the
+    file.  If there is no checkpoint, an empty SavedWorld is returned.
+    If the checkpoint is corrupt, it is moved aside, with a warning,
+    and the server starts with an empty world rather than not at
+    all.  If only the log is corrupt, just the log is moved aside."""
+
+    try:
+        checkpoint = open(filename, "rb")
+    except IOError as e:
+        if e.errno == errno.ENOENT:
+            return SavedWorld()
+        raise
+
+    with checkpoint:
+        try:
+            data = mmap.mmap(checkpoint.fileno(), 0, access=mmap.ACCESS_READ)
+        except (ValueError, EnvironmentError):
+            # An empty file can't be mapped.
+            data = checkpoint.read()
+
+    try:
+        saved = _read_checkpoint(data)
+    except (CorruptCheckpoint, UnicodeError, struct.error) as e:
+        print >>sys.stderr, "Couldn't load the checkpoint %s (%s).  It has been renamed to %s.bad, and the world " \
+            "will start empty." % (filename, e, filename)
+        os.rename(filename, filename + ".bad")
+        return SavedWorld()
+
+    # A damaged log is no reason to throw away a good checkpoint.  The records before the damage have already
+    # been applied, so only the locations logged after it are lost.
+    log_filename = filename + ".log"
+    try:
+        _replay_log(log_filename, saved)
+    except (UnicodeError, struct.error) as e:
+        print >>sys.stderr, "Couldn't replay the log %s (%s).  It has been renamed to %s.bad; the locations " \
+            "logged after the damage are lost." % (log_filename, e, log_filename)
+        os.rename(log_filename, log_filename + ".bad")
+
+    return saved
+
+class Checkpointer(object):
+
+    """Saves the world regularly, so that the server can carry on
+    where it left off after a restart.
+
+    Every interval seconds, the state of the world is written to a
+    checkpoint: a compact binary file holding the NPC arrays, where
+    every player was last seen, and the session key.  In between,
+    every log_interval seconds, the locations of players who have
+    moved are appended to a log, so that players don't lose more than
+    a few seconds if the server crashes.  NPCs are only saved in
+    checkpoints.  They are constantly on the move, so logging them
+    would cost as much as writing checkpoints, and nobody will notice
+    if they jump back a few minutes.
+
+    Only the copying is done on the simulation thread; the files are
+    written by a separate thread.  Checkpoints are written to a new
+    file, which replaces the old one once it is safely on disk, so a
+    crash while writing leaves the previous checkpoint intact.  A new
+    log is started after every checkpoint."""
+
+    def __init__(self, game_state, filename, interval, log_interval, session_key, saved):
+        self.game_state = game_state
+        self.filename = filename
+        self.log_filename = filename + ".log"
+        self.interval = interval
+        self.log_interval = log_interval
+        self.session_key = session_key
+        self.sequence = saved.sequence
+        self.__locations = dict(saved.locations)
+        self.__changed = {}
+        self.__log = None
+        self.__requests = Queue.Queue()
+
+        # Save straight away, so that there is a log to append to, and the restored world is the new baseline.
+        self.__next_checkpoint = 0
+        self.__next_log = time.time() + log_interval
+
+        self.__writer = threading.Thread(target=self.__work, name="Checkpoint writer")
+        self.__writer.daemon = True
+        self.__writer.start()
+
+    def location_for(self, user_id):
+        """Return where the player was last seen, as (x, y, z,
+        heading), or None if they haven't played before."""
+
+        return self.__locations.get(user_id)
+
+    def __note_location(self, player):
+        position = player.get_position()
+        location = (position.x, position.y, position.z, player.get_heading())
+        if self.__locations.get(player.user_id) != location:
+            self.__locations[player.user_id] = location
+            self.__changed[player.user_id] = location
+
+    def player_left(self, player):
+        """Remember where a player was when they left."""
+
+        self.__note_location(player)
+
+    def tick(self, now):
+        if now >= self.__next_checkpoint:
+            self.__next_checkpoint = now + self.interval
+            self.__next_log = now + self.log_interval
+            self.__checkpoint(now)
+        elif now >= self.__next_log:
+            self.__next_log = now + self.log_interval
+            for player in Player.all_players():
+                if player.user_id is not None:
+                    self.__note_location(player)
+
+            if self.__changed:
+                self.__requests.put((self.__append_log, (self.__changed,)))
+                self.__changed = {}
+
+    def __checkpoint(self, now):
+        for player in Player.all_players():
+            if player.user_id is not None:
+                self.__note_location(player)
+
+        self.sequence += 1
+        npcs = self.game_state.npcs.snapshot() if self.game_state.npcs is not None else None
+        self.__requests.put((self.__write_checkpoint,
+                             (self.sequence, now, npcs, dict(self.__locations), self.__changed)))
+        self.__changed = {}
+
+    def close(self):
+        """Write a final checkpoint, and wait for it to be saved."""
+
+        self.__checkpoint(time.time())
+        self.__requests.put(None)
+        self.__writer.join()
+
+    def __work(self):
+        while True:
+            request = self.__requests.get()
+            if request is None:
+                break
+
+            function, args = request
+            try:
+                function(*args)
+            except EnvironmentError as e:
+                print >>sys.stderr, "Couldn't save the world: %s" % e
+            except Exception:
+                traceback.print_exc()
+
+    def __write_checkpoint(self, sequence, saved_time, npcs, locations, changed):
+        try:
+            self.__save_world(sequence, saved_time, npcs, locations)
+        except EnvironmentError:
+            # The previous checkpoint hasn't been replaced, so its log is still the one to follow, and the
+            # locations which changed since the last log entry are appended to it instead.
+            self.__append_log(changed)
+            raise
+
+        self.__start_log(sequence)
+
+    def __save_world(self, sequence, saved_time, npcs, locations):
+        npc_count = len(npcs["position"]) if npcs is not None else 0
+
+        # The session key is in here, so only the server's own user may read the file.
+        new_filename = self.filename + ".new"
+        with os.fdopen(os.open(new_filename, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0600), "wb") as checkpoint:
+            checkpoint.write(_CHECKPOINT_HEADER.pack(_CHECKPOINT_MAGIC, _CHECKPOINT_VERSION, sequence, saved_time,
+                                                     npc_count, len(locations), len(self.session_key)))
+            checkpoint.write(self.session_key)
+            checkpoint.write("\0" * (-(_CHECKPOINT_HEADER.size + len(self.session_key)) % 8))
+
+            if npc_count:
+                for name, shape in STATE_ARRAYS:
+                    checkpoint.write(numpy.ascontiguousarray(npcs[name], "<f8").tostring())
+
+            checkpoint.write("".join(_pack_location(user_id, location)
+                                     for user_id, location in locations.iteritems()))
+            checkpoint.flush()
+            os.fsync(checkpoint.fileno())
+
+        os.rename(new_filename, self.filename)
+
+    def __start_log(self, sequence):
+        if self.__log is not None:
+            self.__log.close()
+            self.__log = None
+
+        new_filename = self.log_filename + ".new"
+        with open(new_filename, "wb") as log:
+            log.write(_LOG_HEADER.pack(_LOG_MAGIC, sequence))
+            log.flush()
+            os.fsync(log.fileno())
+
+        os.rename(new_filename, self.log_filename)
+        self.__log = open(self.log_filename, "ab")
+
+    def __append_log(self, locations):
+        # There is no log if no checkpoint has been written yet, or if the last one was written but its log
+        # couldn't be started.  The locations are still in memory, and will be in the next checkpoint, but they
+        # would be lost if the server crashed before then.
+        if self.__log is None:
+            if locations:
+                print >>sys.stderr, "Couldn't log where %d players are, because there is no log.  " \
+                    "They will be saved in the next checkpoint." % len(locations)
+            return
+
+        self.__log.write("".join(_pack_location(user_id, location) for user_id, location in locations.iteritems()))
+        self.__log.flush()
+        os.fsync(self.__log.fileno())
+
+def _exit(*signal_args):
+    sys.exit(0)
+
+def load_world():
+    """Load the world saved by the checkpointer configured in the
+    checkpoint section of the configuration file.  Returns an empty
+    SavedWorld if checkpointing is disabled."""
+
+    filename = config.get("checkpoint", "file")
+    if not filename:
+        return SavedWorld()
+
+    return load(filename)
+
+def start(game_state, session_key, saved):
+    """Start saving the world, as configured in the checkpoint section
+    of the configuration file.  Returns the Checkpointer, or None if
+    checkpointing is disabled.
+
+    The server is usually stopped with SIGTERM, which would otherwise
+    kill it on the spot, so it is made to exit normally instead, which
+    gives the caller a chance to close the Checkpointer."""
+
+    filename = config.get("checkpoint", "file")
+    if not filename:
+        return None
+
+    signal.signal(signal.SIGTERM, _exit)
+    return Checkpointer(game_state, filename, config.getfloat("checkpoint", "interval"),
+                        config.getfloat("checkpoint", "log-interval"), session_key, saved)
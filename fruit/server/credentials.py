@@ -0,0 +1,70 @@
+import binascii, hashlib, hmac, os, time
+
+# Passwords are stored as "pbkdf2_sha256$iterations$salt$hash", so that the number of iterations can be
+# increased later without invalidating the existing hashes.
+_ALGORITHM = "pbkdf2_sha256"
+_SALT_SIZE = 16
+
+def hash_password(password, iterations):
+    """Return a salted hash of the password, suitable for storing in
+    the account database.  This is deliberately slow, so it should be
+    run in a separate process rather than on the simulation thread."""
+
+    salt = binascii.hexlify(os.urandom(_SALT_SIZE))
+    digest = hashlib.pbkdf2_hmac("sha256", password.encode("utf-8"), salt, iterations)
+    return "%s$%d$%s$%s" % (_ALGORITHM, iterations, salt, binascii.hexlify(digest))
+
+def verify_password(password, stored):
+    """Check a password against a hash made by hash_password."""
+
+    try:
+        algorithm, iterations, salt, expected = stored.split("$")
+        iterations = int(iterations)
+    except ValueError:
+        return False
+
+    if algorithm != _ALGORITHM:
+        return False
+
+    digest = hashlib.pbkdf2_hmac("sha256", password.encode("utf-8"), str(salt), iterations)
+    return hmac.compare_digest(binascii.hexlify(digest), str(expected))
+
+class SessionSigner(object):
+
+    """Issues and checks session tokens.  A token names a user and
+    the time it expires, and is signed with a secret key, so the
+    server can trust it without looking anything up.  This lets a
+    client which lost its connection log straight back in, without
+    the expense of checking its password again.
+
+    The key is chosen at random when the server starts, unless one is
+    given.  The checkpointer saves the key with the world, so that
+    tokens survive a restart and players can resume their sessions
+    as soon as the server is back."""
+
+    def __init__(self, lifetime, key=None):
+        self.lifetime = lifetime
+        self.key = key if key is not None else os.urandom(32)
+
+    def __sign(self, payload):
+        return hmac.new(self.key, payload, hashlib.sha256).hexdigest()
+
+    def issue(self, user_id):
+        payload = "%s:%d" % (user_id.encode("utf-8"), int(time.time() + self.lifetime))
+        return payload + ":" + self.__sign(payload)
+
+    def verify(self, token):
+        """Return the user ID in the token, or None if the token is
+        forged, corrupt or has expired."""
+
+        try:
+            payload, signature = str(token).rsplit(":", 1)
+            user_id, expires = payload.rsplit(":", 1)
+            expires = int(expires)
+        except (ValueError, UnicodeError):
+            return None
+
+        if not hmac.compare_digest(self.__sign(payload), signature) or expires < time.time():
+            return None
+
+        return user_id.decode("utf-8")
@@ -1,18 +1,67 @@
-import asyncore, heapq
 from time import time
 
-from direct.showbase.ShowBase import ShowBase
 from panda3d.bullet import BulletCapsuleShape, BulletCharacterControllerNode, BulletPlaneShape, BulletRigidBodyNode, \
     BulletWorld, ZUp
-from panda3d.core import BitMask32, Vec3
+from panda3d.core import BitMask32, NodePath, Vec3
 from pandac.PandaModules import loadPrcFile
 
+from . import metrics
+from .identifiers import IdAllocator
+from .priority import Prioritizer
+from .scheduler import UpdateScheduler
+from .spatial import SpatialGrid
+from .ticker import TickScheduler
+from .. import config, controls
+from ..snapshots import Quantizer, SnapshotEncoder
 from fruit.rpc import game_pb2, general_pb2
 
-# How often do we update the location of objects which haven't been moved explicitly?
-STATIONARY_OBJECT_UPDATE_TIME = 5
+# How often do we update the location of objects which are known to be moving?  Objects which aren't moving
+# are only updated when they change.
 MOVING_OBJECT_UPDATE_TIME = 0.5
 
+# When a client's bandwidth is limited, updates are sent in priority order (see Player.priority_weight.)  A
+# Thing at PRIORITY_DISTANCE metres from the player has half the priority of a Thing next to the player, and a
+# Thing moving at PRIORITY_SPEED metres (or degrees) per second has twice the priority of a stationary Thing.
+PRIORITY_DISTANCE = 20.0
+PRIORITY_SPEED = 10.0
+
+# The player's own avatar is much more important than anything else.  Things which the client has just been
+# told about get a large one-off boost, so that they don't sit at the origin waiting for their first update.
+OWN_AVATAR_PRIORITY = 10.0
+NEW_THING_PRIORITY = 100.0
+
+# New players appear here, and fall onto the ground plane when the game starts.  This is a feature, not a bug. :)
+START_LOCATION = (0, -20, 5)
+
+# How fast players move (metres per second) and turn (degrees per second) while the controls are held.
+PLAYER_SPEED = 10
+STRAFE_SPEED = PLAYER_SPEED / 2
+TURN_SPEED = 30
+
+_tick_seconds = metrics.registry.histogram("fruit_tick_seconds", "Time taken by each tick.")
+_message_seconds = metrics.registry.histogram("fruit_message_handling_seconds",
+                                              "Time taken by each tick to handle messages from clients.")
+_player_update_seconds = metrics.registry.histogram("fruit_player_update_seconds",
+                                                    "Time taken by each tick to send updates to players.")
+_physics_seconds = metrics.registry.histogram("fruit_physics_seconds",
+                                              "Time taken by each tick to run the physics engine.")
+_npc_seconds = metrics.registry.histogram("fruit_npc_seconds", "Time taken by each tick to move the NPCs.")
+_states_sent = metrics.registry.counter("fruit_thing_states_sent_total", "Thing states sent to clients.")
+_snapshots_skipped = metrics.registry.counter("fruit_snapshots_skipped_total",
+                                              "Snapshots not sent because the client was lagging.")
+_changes_detected = metrics.registry.counter("fruit_changes_detected_total",
+                                             "Updates sent because a stationary Thing was found to have moved.")
+
+def _entry_size(size):
+    """Return how many bytes an entry of the given size takes up in a
+    snapshot, including the field number and length before it."""
+
+    length_size = 1
+    while size >= 1 << (7 * length_size):
+        length_size += 1
+
+    return 1 + length_size + size
+
 class Thing(object):
 
     """Thing represents a single physical object in the game.  It
@@ -20,72 +69,164 @@ class Thing(object):
     confusion with the object-oriented programming concept, or the
     built-in Python type "object"."""
 
-    pending_updates = []
+    pending_updates = UpdateScheduler()
+
+    # The IDs are shared with the NPC store, whose NPCs aren't Things but are sent to clients in the same way.
+    ids = IdAllocator()
 
     __next_thing = 0
-    __thing_list = {}
+    __name_step = 1
+    __things = set()
 
-    def __init__(self, game_state):
+    def __init__(self, game_state, handoff=None):
         self.game_state = game_state
+        if handoff is not None:
+            self.id = Thing.ids.adopt(handoff["id"], self)
+        else:
+            self.id = Thing.ids.allocate(self)
+        Thing.__things.add(self)
         self.update_due_time = 0
         self.schedule_for_update()
         self.__velocity = general_pb2.Vector()
         self.__velocity.x = self.__velocity.y = self.__velocity.z = 0
         self.__angular_velocity = 0
+        self.__state = None
+        self.__state_tick = None
+        self.__broadcast = None
 
     def get_unique_name(self, name):
         """All Things have a unique name.  This is made up of a
         human-readable string, which is followed by a number to ensure
-        uniqueness."""
+        uniqueness.  Clients are told the name once, when they learn
+        about the Thing; after that it is referred to by its ID."""
 
-        Thing.__next_thing += 1
+        Thing.__next_thing += Thing.__name_step
         self.name = name + str(Thing.__next_thing)
-        Thing.__thing_list[self.name] = self
         return self.name
 
+    @classmethod
+    def number_names(self, first, step):
+        """Number the names of new Things first, first + step, and so
+        on.  When the world is split into zones, each zone starts from
+        a different number, so that the names are still unique."""
+
+        Thing.__next_thing = first - step
+        Thing.__name_step = step
+
     @classmethod
     def all_things(self):
-        return self.__thing_list.values()
+        return list(self.__things)
+
+    @classmethod
+    def thing_count(self):
+        return len(self.ids)
+
+    def destroy(self):
+        """Remove the Thing from the game.  Players who know about it
+        are told to remove it straight away, and it is taken out of
+        everything which refers to it, so that it can be freed.  Its
+        ID may be reused."""
+
+        Player.forget_everywhere(self)
+        self.remove_from_world()
+        Thing.ids.release(self.id)
+
+    def hand_off(self):
+        """Remove the Thing from this zone, because another zone is
+        taking it over.  Unlike destroy, players aren't told to forget
+        it (the zone gives them a ghost of it instead), and its ID
+        stays reserved, since the Thing still exists."""
+
+        self.remove_from_world()
+        Thing.ids.lend(self.id)
+
+    def remove_from_world(self):
+        """Take the Thing out of the simulation, for destroy and
+        hand_off."""
+
+        Thing.pending_updates.remove(self)
+        self.game_state.grid.remove(self)
+        Thing.__things.discard(self)
+        self.node_path.removeNode()
+
+    def handoff_state(self):
+        """Return everything another zone needs in order to take the
+        Thing over, as a dictionary which can be pickled."""
+
+        position = self.node_path.getPos()
+        velocity = self.__velocity
+        return {"id": self.id, "name": self.name, "height": self.height, "radius": self.radius,
+                "position": (position.x, position.y, position.z), "heading": self.node_path.getH(),
+                "velocity": (velocity.x, velocity.y, velocity.z), "angular_velocity": self.__angular_velocity,
+                "state": self.get_state()}
+
+    def restore_handoff_state(self, state):
+        """Put the Thing where another zone's handoff_state said it
+        was, moving as it was."""
+
+        self.move(*state["position"])
+        self.set_heading(state["heading"])
+
+        velocity = general_pb2.Vector()
+        velocity.x, velocity.y, velocity.z = state["velocity"]
+        self.set_velocity(velocity)
+        self.set_angular_velocity(state["angular_velocity"])
 
     def schedule_for_update(self):
         """Clients must be notified about changes to the state of
         Things (movement, rotation, and so on).  A notification is
-        sent every STATIONARY_OBJECT_UPDATE_TIME seconds for objects
-        which are not known to have moved.  If the object is known to
-        be moving, updates are sent every MOVING_OBJECT_UPDATE_TIME
-        seconds.  By updating moving objects more frequently, we
-        reduce disagreement between the client and the server about
-        objects' locations.
-
-        (An object can move without our knowledge, for example if it
-        gets hit and as a result is moved by the physics engine.)
-
-        Pending updates are stored in a priority queue
-        (http://en.wikipedia.org/wiki/Priority_queue).  When we want
-        to send updates, we pop Things off the front of the queue
-        until the highest priority Thing in the queue is not yet due
-        for update.  The nature of a priority queue then guarantees
-        that no other queued Things are due for update either.
-
-        When we want to schedule an update, we just write an entry
-        into the queue with an appropriate priority.  This may mean
-        that some Things are in the queue more than once, but that
-        doesn't matter.  We throw away duplicates before sending out
-        updates; we also make sure that we are not sending an update
-        for a Thing whose priority was lowered after it was placed in
-        the queue."""
-
-        heapq.heappush(Thing.pending_updates, (self.update_due_time, self))
+        sent straight away when we change a Thing ourselves.  If the
+        Thing is known to be moving, updates are then sent every
+        MOVING_OBJECT_UPDATE_TIME seconds, which reduces disagreement
+        between the client and the server about its location.  A Thing
+        which isn't moving is left alone until it changes.
 
-    def reschedule_update(self):
-        """Schedule an update for this Thing once an appropriate
-        amount of time has passed."""
+        A Thing can also move without our knowledge, for example if it
+        gets hit and as a result is moved by the physics engine.  That
+        is caught by check_for_changes, which compares each stationary
+        Thing with the state we last sent.
 
-        update_delay = STATIONARY_OBJECT_UPDATE_TIME if self.__velocity.x == 0 and self.__velocity.y == 0 and \
-            self.__velocity.z == 0 and self.__angular_velocity == 0 else MOVING_OBJECT_UPDATE_TIME
+        Pending updates are stored in an UpdateScheduler, which is a
+        priority queue.  When we want to send updates, we take all the
+        Things which are due off the front of the queue.  Each Thing
+        is in the queue at most once, so rescheduling a Thing just
+        moves its existing entry."""
 
-        self.update_due_time = time() + update_delay
-        self.schedule_for_update()
+        Thing.pending_updates.schedule(self, self.update_due_time)
+
+    def is_moving(self):
+        return self.__velocity.x != 0 or self.__velocity.y != 0 or self.__velocity.z != 0 or \
+            self.__angular_velocity != 0
+
+    def reschedule_update(self):
+        """An update about this Thing is being sent.  Remember where
+        it was, and if it is moving, schedule the next update once an
+        appropriate amount of time has passed."""
+
+        position = self.node_path.getPos()
+        self.__broadcast = (position.x, position.y, position.z, self.node_path.getH())
+
+        if self.is_moving():
+            self.update_due_time = time() + MOVING_OBJECT_UPDATE_TIME
+            self.schedule_for_update()
+
+    def check_for_changes(self, position):
+        """Schedule an update if the Thing isn't supposed to be moving,
+        but its position or heading has changed by more than the
+        game's epsilons since the last update was sent.  The caller
+        passes in the position, since it has usually just looked it
+        up."""
+
+        broadcast = self.__broadcast
+        if broadcast is None or self.is_moving() or self in Thing.pending_updates:
+            return
+
+        epsilon = self.game_state.position_epsilon
+        turned = abs(self.node_path.getH() - broadcast[3]) % 360
+        if abs(position.x - broadcast[0]) > epsilon or abs(position.y - broadcast[1]) > epsilon or \
+                abs(position.z - broadcast[2]) > epsilon or min(turned, 360 - turned) > self.game_state.angle_epsilon:
+            _changes_detected.inc()
+            self.force_update()
 
     def force_update(self):
         """Schedule an update for this Thing immediately, probably
@@ -94,8 +235,31 @@ class Thing(object):
         self.update_due_time = 0
         self.schedule_for_update()
 
+    def get_state(self):
+        """Return the quantized state of this Thing, as sent to
+        clients.  The state is only calculated once per tick, however
+        many players are interested in it."""
+
+        if self.__state_tick != self.game_state.tick:
+            self.__state_tick = self.game_state.tick
+            self.__state = self.game_state.quantizer.quantize(self.node_path.getPos(), self.__velocity,
+                                                              self.node_path.getH(), self.__angular_velocity)
+
+        return self.__state
+
+    def get_position(self):
+        return self.node_path.getPos()
+
     def move(self, x, y, z):
         self.node_path.setPos(x, y, z)
+        self.game_state.grid.update(self, x, y)
+        self.force_update()
+
+    def get_heading(self):
+        return self.node_path.getH()
+
+    def set_heading(self, heading):
+        self.node_path.setH(heading)
         self.force_update()
 
     def get_velocity(self):
@@ -117,100 +281,418 @@ class Thing(object):
 class LivingThing(Thing):
     """This is the superclass for players and NPCs."""
 
-    def __init__(self, game_state, height, radius, name):
-        Thing.__init__(self, game_state)
+    def __init__(self, game_state, height, radius, name, handoff=None):
+        Thing.__init__(self, game_state, handoff)
         self.height = height
         self.radius = radius
 
+        if handoff is not None:
+            self.name = handoff["name"]
+        else:
+            self.get_unique_name(name)
+
         shape = BulletCapsuleShape(radius, height - 2 * radius, ZUp)
 
-        self.node = BulletCharacterControllerNode(shape, 0.4, self.get_unique_name(name))
+        self.node = BulletCharacterControllerNode(shape, 0.4, self.name)
         self.node_path = self.game_state.render.attachNewNode(self.node)
         self.game_state.world.attachCharacter(self.node_path.node())
 
+        if handoff is not None:
+            self.restore_handoff_state(handoff)
+
+    def remove_from_world(self):
+        self.game_state.set_angular_velocity(self.node, 0)
+        self.game_state.world.removeCharacter(self.node)
+        Thing.remove_from_world(self)
+
 class Player(LivingThing):
     __players = set()
+    __input_pending = set()
 
-    def __init__(self, game_state, player_connection):
-        LivingThing.__init__(self, game_state, 1.75, 0.4, "Player")
+    def __init__(self, game_state, player_connection, user_id=None, handoff=None):
+        LivingThing.__init__(self, game_state, 1.75, 0.4, "Player", handoff)
         self.player_connection = player_connection
+        self.user_id = user_id
+        self.controls = 0
+        self.__input_sequence = 0
+        self.__next_controls = 0
+        self.__keepalive_interval = 0
+        self.__next_keepalive = 0
 
         self.__players.add(self)
         self.__known_things = set()
+        self.__waiting = Prioritizer()
+
+        if game_state.delta_snapshots:
+            self.__encoder = SnapshotEncoder(game_state.snapshot_history)
+        else:
+            self.__encoder = None
+
+        if handoff is not None:
+            self.__take_over(handoff)
+            return
+
+        # A returning player starts where they were when the world was last saved.
+        location = None
+        if game_state.checkpointer is not None and user_id is not None:
+            location = game_state.checkpointer.location_for(user_id)
+
+        if location is not None:
+            x, y, z, heading = location
+            self.move(x, y, z)
+            self.set_heading(heading)
+        else:
+            self.move(*START_LOCATION)
+
+    def welcome(self, session_token):
+        """Tell the client that it has joined the game, and which Thing
+        is its avatar."""
+
+        msg = game_pb2.Start()
+        msg.player_tag = self.name
+        msg.session_token = session_token
+        if self.game_state.delta_snapshots:
+            msg.position_precision = self.game_state.quantizer.position_precision
+            msg.angle_precision = self.game_state.quantizer.angle_precision
+        self.player_connection.send_rpc(msg)
+
+    def handoff_state(self):
+        state = LivingThing.handoff_state(self)
+        state.update(user_id=self.user_id, controls=self.controls, input_sequence=self.__input_sequence,
+                     next_controls=self.__next_controls, input_pending=self in Player.__input_pending,
+                     keepalive_interval=self.__keepalive_interval, next_keepalive=self.__next_keepalive,
+                     known=[thing.id for thing in self.__known_things], encoder=self.__encoder)
+        return state
+
+    def __take_over(self, state):
+        # The player has arrived from another zone.  The client already knows about everything the player knew
+        # about, so the player keeps knowing about whatever is here (as a Thing or a ghost), and the client is
+        # told to forget the rest.  Everything is sent again, since the updates due in the old zone were lost.
+        self.controls = state["controls"]
+        self.__input_sequence = state["input_sequence"]
+        self.__next_controls = state["next_controls"]
+        if state["input_pending"]:
+            Player.__input_pending.add(self)
+        self.__keepalive_interval = state["keepalive_interval"]
+        self.__next_keepalive = state["next_keepalive"]
+        self.__encoder = state["encoder"]
+
+        for thing_id in state["known"]:
+            thing = self.game_state.find_thing(thing_id)
+            if thing is not None:
+                self.__known_things.add(thing)
+            else:
+                data = game_pb2.RemoveObject()
+                data.id = thing_id
+                self.player_connection.send_rpc(data)
+                if self.__encoder is not None:
+                    self.__encoder.forget(thing_id)
+
+        self.__waiting.add(self.__known_things)
+
+    def queue_input(self, sequence, controls):
+        """Remember the latest InputCommand from the client.  Commands
+        are applied by apply_inputs, once per tick, so however many the
+        client sends, only the latest one costs anything."""
+
+        if sequence > self.__input_sequence:
+            self.__input_sequence = sequence
+            self.__next_controls = controls
+            Player.__input_pending.add(self)
+
+    def set_keepalive(self, interval):
+        """Send the client the state of everything it knows about every
+        interval seconds, whether or not it has changed, or stop doing
+        so if the interval is 0.  This is for clients which would
+        rather spend some bandwidth than trust that nothing has
+        changed."""
+
+        if interval > 0:
+            interval = max(interval, self.game_state.min_keepalive_interval)
+            self.__next_keepalive = time() + interval
+
+        self.__keepalive_interval = interval
+
+    def __apply_controls(self, held):
+        # The velocity is only set (and the update forced) when the controls actually change.
+        if held == self.controls:
+            return
+
+        self.controls = held
+
+        velocity = self.get_velocity()
+        velocity.x = controls.axis(held, controls.STRAFE_RIGHT, controls.STRAFE_LEFT, STRAFE_SPEED)
+        velocity.y = controls.axis(held, controls.FORWARD, controls.BACKWARD, PLAYER_SPEED)
+        self.set_velocity(velocity)
+
+        angular_velocity = controls.axis(held, controls.TURN_LEFT, controls.TURN_RIGHT, TURN_SPEED)
+        if angular_velocity != self.get_angular_velocity():
+            self.set_angular_velocity(angular_velocity)
+
+    @classmethod
+    def apply_inputs(self):
+        """Apply the latest controls sent by each player."""
+
+        for player in self.__input_pending:
+            player.__apply_controls(player.__next_controls)
+
+        self.__input_pending.clear()
+
+    def destroy(self):
+        """The player has left the game."""
 
-        # The player will fall onto the ground plane when the game starts.  This is a feature, not a bug. :)
+        if self.game_state.checkpointer is not None and self.user_id is not None:
+            self.game_state.checkpointer.player_left(self)
 
-        self.move(0, -20, 5)
+        self.__known_things.clear()
+        self.__waiting = Prioritizer()
+        LivingThing.destroy(self)
+
+    def remove_from_world(self):
+        self.__players.discard(self)
+        self.__input_pending.discard(self)
+        LivingThing.remove_from_world(self)
+
+    def __forget(self, thing):
+        data = game_pb2.RemoveObject()
+        data.id = thing.id
+        self.player_connection.send_rpc(data)
+        self.__known_things.remove(thing)
+        self.__waiting.discard(thing)
+
+        if self.__encoder is not None:
+            self.__encoder.forget(thing.id)
+
+    @classmethod
+    def forget_everywhere(self, thing):
+        """Tell every player who knows about the Thing to remove it."""
+
+        for player in self.__players:
+            if thing in player.__known_things:
+                player.__forget(thing)
+
+    @classmethod
+    def substitute_everywhere(self, old, new):
+        """Make every player who knows about old know about new
+        instead, without telling the clients.  The two must have the
+        same ID, so that they are the same Thing as far as the clients
+        are concerned: a Thing and its ghost, for example."""
+
+        for player in self.__players:
+            if old in player.__known_things:
+                player.__known_things.remove(old)
+                player.__known_things.add(new)
+                if old in player.__waiting:
+                    player.__waiting.discard(old)
+                    player.__waiting.add(new)
 
     def update_known_things(self):
         """Make sure that the client representing this player is aware
         of the right set of objects.  It is possible that objects were
-        added to, or removed from, the scene."""
-
-        candidates = set(self.all_things())
-        for remove in self.__known_things - candidates:
-            data = game_pb2.RemoveObject()
-            data.tag = remove.name
-            self.player_connection.send_rpc(data)
-            self.__known_things.remove(remove)
-
-        to_add = candidates - self.__known_things
-        for add in to_add:
-            data = game_pb2.AddObject()
-            data.tag = add.name
-            data.height = self.height
-            data.radius = self.radius
-            self.player_connection.send_rpc(data)
-            self.__known_things.add(add)
+        added to, or removed from, the scene, or that they have moved
+        into or out of the player's area of interest.
+
+        A Thing becomes known when it comes within the interest radius,
+        but it is only forgotten when it moves further away than the
+        interest radius plus the hysteresis distance.  Otherwise a
+        Thing which was hovering around the edge of the area would be
+        repeatedly added and removed."""
+
+        grid = self.game_state.grid
+        position = self.node_path.getPos()
+        add_distance = self.game_state.interest_radius
+        remove_distance = add_distance + self.game_state.interest_hysteresis
+        add_distance_squared = add_distance * add_distance
+        remove_distance_squared = remove_distance * remove_distance
+
+        to_remove = [thing for thing in self.__known_things
+                     if thing not in grid or
+                     (thing.get_position() - position).lengthSquared() > remove_distance_squared]
+
+        for remove in to_remove:
+            self.__forget(remove)
+
+        to_add = set()
+        for add in grid.query(position.x, position.y, add_distance):
+            if add not in self.__known_things and \
+                    (add.get_position() - position).lengthSquared() <= add_distance_squared:
+                data = game_pb2.AddObject()
+                data.tag = add.name
+                data.id = add.id
+                data.height = add.height
+                data.radius = add.radius
+                self.player_connection.send_rpc(data)
+                self.__known_things.add(add)
+                to_add.add(add)
 
         return to_add
 
-    def update_locations(self, to_update):
-        """Send updates to the client informing it about changes to
-        objects (location, velocity, heading and angular velocity.)"""
+    def priority_weight(self, thing):
+        """How much the priority of a waiting update about the Thing
+        increases each tick.  Nearby Things and moving Things are more
+        important."""
 
-        for thing in to_update:
-            data = game_pb2.ThingState()
-            data.tag = thing.name
+        if thing is self:
+            return OWN_AVATAR_PRIORITY
 
-            location = thing.node_path.getPos()
-            data.location.x = location.x
-            data.location.y = location.y
-            data.location.z = location.z
+        distance = (thing.get_position() - self.node_path.getPos()).length()
+        velocity = thing.get_velocity()
+        speed = abs(velocity.x) + abs(velocity.y) + abs(velocity.z) + abs(thing.get_angular_velocity())
+        return (1 + speed / PRIORITY_SPEED) * PRIORITY_DISTANCE / (PRIORITY_DISTANCE + distance)
 
-            data.velocity.CopyFrom(thing.get_velocity())
+    def update_locations(self, to_update, additions, now):
+        """Send updates to the client informing it about changes to
+        objects (location, velocity, heading and angular velocity.)
+        All the updates for one tick are sent in a single message.
+
+        Each client has a bandwidth budget.  Updates which don't fit
+        into this tick's budget wait in a Prioritizer, and the most
+        important ones are sent first on later ticks.  If the client
+        isn't keeping up at all, nothing is sent.  Either way, when a
+        waiting Thing is eventually sent, the client receives its
+        latest state, rather than all the stale states it missed."""
+
+        if self.__encoder is not None and self.__encoder.full_refresh_needed:
+            self.__waiting.add(self.__known_things)
+
+        if self.__keepalive_interval > 0 and now >= self.__next_keepalive:
+            self.__next_keepalive = now + self.__keepalive_interval
+            self.__waiting.add(self.__known_things)
+
+        self.__waiting.add(to_update)
+        self.__waiting.add(additions, NEW_THING_PRIORITY)
+
+        if not self.__waiting:
+            return
+
+        self.__waiting.accumulate(self.priority_weight)
+        if self.player_connection.lagging:
+            _snapshots_skipped.inc()
+            return
+
+        snapshot = game_pb2.WorldSnapshot()
+        snapshot.tick = self.game_state.tick
+        budget = self.game_state.client_bandwidth * self.game_state.ticker.tick_length
+
+        # The base tick, which is filled in at the end, is never bigger than the tick.
+        size = 2 * snapshot.ByteSize()
+        entries = snapshot.things if self.__encoder is None else snapshot.deltas
+
+        # Each entry is only kept if it fits in the budget, except that the first one is always sent, so that
+        # something gets through however small the budget is.
+        for thing in self.__waiting.by_priority():
+            state = thing.get_state()
+            if self.__encoder is None:
+                data = snapshot.things.add()
+                self.game_state.quantizer.fill_thing_state(data, thing.id, state)
+            else:
+                data = self.__encoder.encode(snapshot, thing.id, state)
+
+            entry_size = _entry_size(data.ByteSize())
+            if size + entry_size > budget and len(entries) > 1:
+                del entries[-1]
+                break
+
+            size += entry_size
+            self.__waiting.sent(thing)
+            if self.__encoder is not None:
+                self.__encoder.sent(thing.id, state)
+
+        if self.__encoder is not None:
+            self.__encoder.finish(snapshot)
+
+        self.player_connection.send_rpc(snapshot, low_priority=True)
+        _states_sent.inc(len(snapshot.things) + len(snapshot.deltas))
+
+    def acknowledge_snapshot(self, tick):
+        if self.__encoder is not None:
+            self.__encoder.acknowledge(tick)
 
-            data.angle = thing.node_path.getH()
-            data.angular_velocity = thing.get_angular_velocity()
+    @classmethod
+    def all_players(self):
+        return list(self.__players)
 
-            self.player_connection.send_rpc(data)
+    @classmethod
+    def player_count(self):
+        return len(self.__players)
 
     @classmethod
-    def update_all(self):
-        """Send appropriate updates to all players."""
+    def update_all(self, *stores):
+        """Send appropriate updates to all players, including updates
+        about the NPCs or ghosts in the given stores (anything with a
+        pop_due method, such as an NpcStore).  Returns the set of
+        everything which was due to be updated."""
 
         update_time = time()
         to_update = set()
-        while Thing.pending_updates and Thing.pending_updates[0][0] < update_time:
-            _, thing = heapq.heappop(Thing.pending_updates)
-            if thing.update_due_time < update_time:
-                to_update.add(thing)
-                thing.reschedule_update()
+        for thing in Thing.pending_updates.pop_due(update_time):
+            to_update.add(thing)
+            thing.reschedule_update()
+
+        for store in stores:
+            to_update.update(store.pop_due(update_time))
+
+        # Messages are held back until all the updates for this tick have been generated, so each client
+        # receives them in a single write.
+        for player in self.__players:
+            player.player_connection.cork()
 
         for player in self.__players:
             additions = player.update_known_things()
-            player.update_locations(additions | to_update)
+            player.update_locations(to_update & player.__known_things, additions, update_time)
+
+        for player in self.__players:
+            player.player_connection.uncork()
 
-class GameState(ShowBase):
-    def __init__(self):
+        return to_update
+
+class GameState(object):
+
+    """GameState holds the world which is simulated by the server.
+    It doesn't need any of Panda's rendering or task management, so
+    rather than using ShowBase, it keeps its own scene graph and runs
+    a TickScheduler, which updates the world at a fixed rate."""
+
+    def __init__(self, network):
         loadPrcFile("server-config.prc")
-        ShowBase.__init__(self)
+        self.network = network
+        self.metrics_log = None
+        self.checkpointer = None
+        self.npcs = None
+        self.ghosts = None
+        self.updated_things = set()
+        self.render = NodePath("render")
         self.__rotations = {}
+        self.tick = 0
+
+        # Players are only told about Things within interest_radius of themselves.  The grid lets us find
+        # those Things quickly.
+        self.interest_radius = config.getfloat("game", "interest-radius")
+        self.interest_hysteresis = config.getfloat("game", "interest-hysteresis")
+        self.grid = SpatialGrid(config.getfloat("game", "grid-cell-size"))
 
-        # Panda pollutes the global namespace.  Some of the extra globals can be referred to in nicer ways
-        # (for example self.render instead of render).  The globalClock object, though, is only a global!  We
-        # create a reference to it here, in a way that won't upset PyFlakes.
-        self.globalClock = __builtins__["globalClock"]
+        # States sent to clients are rounded to these precisions.  In delta mode, clients only receive the fields
+        # which changed since the last snapshot they acknowledged.
+        self.quantizer = Quantizer(config.getfloat("game", "position-precision"),
+                                   config.getfloat("game", "angle-precision"))
+        self.delta_snapshots = config.getboolean("game", "delta-snapshots")
+        self.snapshot_history = config.getint("game", "snapshot-history")
+
+        # A stationary Thing which moves further than this, or turns further than this, is sent to clients again.
+        self.position_epsilon = config.getfloat("game", "change-position-epsilon")
+        self.angle_epsilon = config.getfloat("game", "change-angle-epsilon")
+
+        # Clients may ask to be sent everything they know about every so often, but not more often than this.
+        self.min_keepalive_interval = config.getfloat("game", "min-keepalive-interval")
+
+        # The number of bytes of object updates each client may be sent per second.
+        self.client_bandwidth = config.getint("game", "client-bandwidth")
+
+        # Physics is always stepped by whole ticks, split into a fixed number of substeps, so the simulation
+        # doesn't depend on how busy the server is.
+        self.physics_substeps = config.getint("game", "physics-substeps")
+        self.ticker = TickScheduler(config.getfloat("game", "tick-rate"), config.getint("game", "max-catch-up-ticks"),
+                                    self.update)
 
         # Set up physics: the ground plane and the capsule which represents the player.
         self.world = BulletWorld()
@@ -223,23 +705,74 @@ class GameState(ShowBase):
         np.setPos(0, 0, 0)
         self.world.attachRigidBody(node)
 
-        # Create a task to update the scene regularly.
-        self.taskMgr.add(self.update, "UpdateTask")
+    def run(self):
+        self.ticker.run()
 
     # Update the scene by turning objects if necessary, and processing physics.
-    def update(self, task):
-        asyncore.loop(timeout=0.1, use_poll=True, count=1)
-        Player.update_all()
+    def update(self, dt):
+        start = time()
+        self.network.process_messages()
+        Player.apply_inputs()
+        messages_handled = time()
+
+        self.tick += 1
+        self.updated_things = Player.update_all(*[store for store in (self.npcs, self.ghosts) if store is not None])
+        players_updated = time()
 
         for node, angular_velocity in self.__rotations.iteritems():
             node.setAngularMovement(angular_velocity)
 
-        dt = self.globalClock.getDt()
-        self.world.doPhysics(dt)
-        return task.cont
+        self.world.doPhysics(dt, self.physics_substeps, dt / self.physics_substeps)
+        physics_done = time()
+
+        if self.npcs is not None:
+            self.npcs.update(dt, physics_done)
+        npcs_moved = time()
+
+        # The physics engine may have moved things, so keep the grid up to date, and make sure the clients hear
+        # about it.
+        for thing in Thing.all_things():
+            location = thing.node_path.getPos()
+            self.grid.update(thing, location.x, location.y)
+            thing.check_for_changes(location)
+
+        end = time()
+        _message_seconds.observe(messages_handled - start)
+        _player_update_seconds.observe(players_updated - messages_handled)
+        _physics_seconds.observe(physics_done - players_updated)
+        _npc_seconds.observe(npcs_moved - physics_done)
+        _tick_seconds.observe(end - start)
+
+        if self.metrics_log is not None:
+            self.metrics_log.tick(end)
+
+        if self.checkpointer is not None:
+            self.checkpointer.tick(end)
+
+    def add_player(self, connection, user_id, session_token):
+        """A client has logged in.  Create its player, and return it."""
+
+        player = Player(self, connection, user_id)
+        player.welcome(session_token)
+        return player
+
+    def find_thing(self, thing_id):
+        """Return the Thing, NPC or ghost with the given ID, or None if
+        there isn't one here."""
+
+        thing = Thing.ids.get(thing_id)
+        if thing is None and self.ghosts is not None:
+            thing = self.ghosts.get(thing_id)
+
+        return thing
 
     def set_angular_velocity(self, node, angular_velocity):
         if angular_velocity != 0:
             self.__rotations[node] = angular_velocity
         elif node in self.__rotations:
             del self.__rotations[node]
+
+metrics.registry.gauge("fruit_pending_updates", "Things waiting in the update scheduler.",
+                       lambda: len(Thing.pending_updates))
+metrics.registry.gauge("fruit_players", "Players logged in.", Player.player_count)
+metrics.registry.gauge("fruit_things", "Things in the world, including players.", Thing.thing_count)
@@ -0,0 +1,133 @@
+import heapq
+
+class IdAllocator(object):
+
+    """Hands out the small integer IDs which identify Things in
+    messages to clients.  Small numbers are encoded as short varints,
+    so IDs are reused: when a Thing is destroyed its slot is freed,
+    and the lowest free slot is always allocated first.
+
+    Each slot has a generation counter, which goes up every time the
+    slot is freed, and the ID is made up of the slot number and the
+    generation.  An old ID which is still lying around somewhere
+    therefore doesn't refer to the new Thing in the same slot; get
+    returns None for it instead.  The generation only has a few bits,
+    so after enough reuses an old ID will match again, but by then it
+    has been meaningless for a long time.
+
+    With the default of 4 generation bits, the first 8 Things have
+    one-byte IDs, and the first 1024 have IDs of two bytes or less.
+
+    When the world is split into zones, each zone has its own
+    allocator, and the zones' IDs are interleaved: each zone's IDs
+    leave a different remainder (offset) when divided by the number of
+    zones (stride).  A Thing keeps its ID when it moves to another zone.
+    The zone it leaves lends the ID out, keeping the slot reserved,
+    and the zone it arrives in adopts it.  If the Thing is destroyed
+    somewhere other than the zone which allocated its ID, the ID is
+    added to foreign_releases, and the caller must pass it on to the
+    owner, which can then free the slot."""
+
+    def __init__(self, generation_bits=4, stride=1, offset=0):
+        self.generation_bits = generation_bits
+        self.stride = stride
+        self.offset = offset
+        self.foreign_releases = []
+        self.__generation_mask = (1 << generation_bits) - 1
+        self.__things = []
+        self.__generations = []
+        self.__free = []
+        self.__lent = set()
+        self.__foreign = {}
+        self.__count = 0
+
+    def __len__(self):
+        return self.__count
+
+    def owns(self, thing_id):
+        """Return True if the ID was allocated here."""
+
+        return thing_id % self.stride == self.offset
+
+    def allocate(self, thing):
+        """Return a new ID for the Thing."""
+
+        if self.__free:
+            slot = heapq.heappop(self.__free)
+            self.__things[slot] = thing
+        else:
+            slot = len(self.__things)
+            self.__things.append(thing)
+            self.__generations.append(0)
+
+        self.__count += 1
+        return (slot << self.generation_bits | self.__generations[slot]) * self.stride + self.offset
+
+    def release(self, thing_id):
+        """Free the ID's slot so that it can be reused.  Releasing an
+        ID which isn't in use does nothing."""
+
+        if not self.owns(thing_id):
+            if self.__foreign.pop(thing_id, None) is not None:
+                self.__count -= 1
+                self.foreign_releases.append(thing_id)
+            return
+
+        slot = thing_id // self.stride >> self.generation_bits
+        if thing_id in self.__lent:
+            self.__lent.discard(thing_id)
+        elif self.get(thing_id) is None:
+            return
+        else:
+            self.__count -= 1
+
+        self.__things[slot] = None
+        self.__generations[slot] = (self.__generations[slot] + 1) & self.__generation_mask
+        heapq.heappush(self.__free, slot)
+
+    def lend(self, thing_id):
+        """The Thing with this ID has moved to another zone.  If the ID
+        was allocated here, its slot stays reserved until the ID is
+        released; either way, get no longer finds the Thing."""
+
+        if not self.owns(thing_id):
+            if self.__foreign.pop(thing_id, None) is not None:
+                self.__count -= 1
+            return
+
+        if self.get(thing_id) is not None:
+            self.__things[thing_id // self.stride >> self.generation_bits] = None
+            self.__lent.add(thing_id)
+            self.__count -= 1
+
+    def adopt(self, thing_id, thing):
+        """Give a Thing which has arrived from another zone its
+        existing ID, and return the ID."""
+
+        if self.owns(thing_id):
+            self.__lent.discard(thing_id)
+            self.__things[thing_id // self.stride >> self.generation_bits] = thing
+        else:
+            self.__foreign[thing_id] = thing
+
+        self.__count += 1
+        return thing_id
+
+    def get(self, thing_id):
+        """Return the Thing with the given ID, or None if the ID isn't
+        (or is no longer) in use here."""
+
+        if not self.owns(thing_id):
+            return self.__foreign.get(thing_id)
+
+        local_id = thing_id // self.stride
+        slot = local_id >> self.generation_bits
+        if slot >= len(self.__things) or self.__generations[slot] != local_id & self.__generation_mask:
+            return None
+
+        return self.__things[slot]
+
+    def things(self):
+        """Return a list of all the Things which have IDs here."""
+
+        return [thing for thing in self.__things if thing is not None] + self.__foreign.values()
@@ -0,0 +1,237 @@
+import asynchat, asyncore, bisect, logging, logging.handlers, re, socket, time
+
+from .. import config
+
+# Buckets (in seconds) for histograms of how long things take.  A tick at 30 ticks per second lasts 0.033s.
+TIME_BUCKETS = (0.0005, 0.001, 0.002, 0.005, 0.01, 0.02, 0.033, 0.05, 0.1, 0.25, 0.5, 1.0)
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+
+    return "{" + ",".join('%s="%s"' % (name, str(value).replace("\\", "\\\\").replace('"', '\\"'))
+                          for name, value in sorted(labels.iteritems())) + "}"
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+def _samples(name, value):
+    """Turn the value returned by a metric's function into samples.
+    The function returns either a number, or a list of (labels,
+    number) pairs, where labels is a dictionary.  That allows one
+    metric to report a value for each connection, for example."""
+
+    if isinstance(value, list):
+        return [(name, labels, number) for labels, number in value]
+    else:
+        return [(name, {}, value)]
+
+class Counter(object):
+
+    """A number which only goes up, such as the number of ticks run so
+    far.  The count is either kept by the Counter, or read from the
+    given function whenever the metrics are collected."""
+
+    type = "counter"
+
+    def __init__(self, name, help, function=None):
+        self.name = name
+        self.help = help
+        self.value = 0
+        self.__function = function
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def samples(self):
+        return _samples(self.name, self.__function() if self.__function is not None else self.value)
+
+class Gauge(object):
+
+    """A number which goes up and down, such as the number of players.
+    The function is called whenever the metrics are collected."""
+
+    type = "gauge"
+
+    def __init__(self, name, help, function):
+        self.name = name
+        self.help = help
+        self.__function = function
+
+    def samples(self):
+        return _samples(self.name, self.__function())
+
+class Histogram(object):
+
+    """Counts observations (such as tick durations) in buckets.  Each
+    observation costs a binary search and a few additions, so the
+    histograms can be kept up to date all the time."""
+
+    type = "histogram"
+
+    def __init__(self, name, help, buckets=TIME_BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def samples(self):
+        # Prometheus buckets are cumulative.
+        samples = []
+        total = 0
+        for bound, count in zip(self.buckets + (float("inf"),), self.counts):
+            total += count
+            samples.append((self.name + "_bucket", {"le": _format_value(bound)}, total))
+
+        samples.append((self.name + "_sum", {}, self.sum))
+        samples.append((self.name + "_count", {}, self.count))
+        return samples
+
+class Registry(object):
+
+    """All the metrics for the server.  Metrics are usually created
+    when a module is imported, and updated by the simulation thread.
+    They are collected by the network thread when the metrics page is
+    requested.  The values may be a little out of step with each
+    other, but no locking is needed."""
+
+    def __init__(self):
+        self.__metrics = []
+
+    def add(self, metric):
+        self.__metrics.append(metric)
+        return metric
+
+    def counter(self, name, help, function=None):
+        return self.add(Counter(name, help, function))
+
+    def gauge(self, name, help, function):
+        return self.add(Gauge(name, help, function))
+
+    def histogram(self, name, help, buckets=TIME_BUCKETS):
+        return self.add(Histogram(name, help, buckets))
+
+    def render(self):
+        """Return all the metrics in Prometheus's text format."""
+
+        lines = []
+        for metric in self.__metrics:
+            lines.append("# HELP %s %s" % (metric.name, metric.help))
+            lines.append("# TYPE %s %s" % (metric.name, metric.type))
+            for name, labels, value in metric.samples():
+                lines.append("%s%s %s" % (name, _format_labels(labels), _format_value(value)))
+
+        return "\n".join(lines) + "\n"
+
+    def summary(self):
+        """Return a one-line summary of the metrics, for the log.
+        Histograms are summarized by their count and sum."""
+
+        fields = []
+        for metric in self.__metrics:
+            for name, labels, value in metric.samples():
+                if not labels and not name.endswith("_bucket"):
+                    fields.append("%s=%s" % (name, _format_value(value)))
+
+        return " ".join(fields)
+
+registry = Registry()
+
+class _MetricsRequest(asynchat.async_chat):
+
+    """Answers a single HTTP request for the metrics page."""
+
+    def __init__(self, sock, map):
+        asynchat.async_chat.__init__(self, sock, map)
+        self.set_terminator("\r\n\r\n")
+        self.__request = []
+
+    def collect_incoming_data(self, data):
+        # Nothing we serve needs a long request, so don't let anyone make us buffer one.
+        if sum(len(part) for part in self.__request) + len(data) > 8192:
+            self.close()
+        else:
+            self.__request.append(data)
+
+    def found_terminator(self):
+        self.set_terminator(None)
+        request_line = "".join(self.__request).split("\r\n", 1)[0].split()
+
+        if len(request_line) >= 2 and request_line[0] == "GET" and request_line[1] in ("/", "/metrics"):
+            status = "200 OK"
+            body = registry.render()
+        else:
+            status = "404 Not Found"
+            body = "Not found.\n"
+
+        self.push("HTTP/1.0 %s\r\nContent-Type: text/plain; version=0.0.4\r\nContent-Length: %d\r\n\r\n%s" %
+                  (status, len(body), body))
+        self.close_when_done()
+
+class MetricsServer(asyncore.dispatcher):
+
+    """Serves the metrics over HTTP, on the network thread, so that
+    collecting them doesn't hold up the simulation."""
+
+    def __init__(self, network, address):
+        asyncore.dispatcher.__init__(self, map=network.map)
+        self.network = network
+
+        ip, port = re.split(r"\s*,\s*", address, 2)
+        port = int(port)
+
+        self.create_socket(socket.AF_INET6 if ":" in ip else socket.AF_INET, socket.SOCK_STREAM)
+        self.set_reuse_addr()
+        self.bind((ip, port))
+        self.listen(5)
+
+    def handle_accept(self):
+        accepted = self.accept()
+        if accepted is not None:
+            _MetricsRequest(accepted[0], self.network.map)
+
+class MetricsLog(object):
+
+    """Writes a summary of the metrics to a log file every interval
+    seconds.  The log is rotated when it reaches max_bytes."""
+
+    def __init__(self, filename, interval, max_bytes, backups):
+        self.interval = interval
+        self.__next_write = time.time() + interval
+
+        handler = logging.handlers.RotatingFileHandler(filename, maxBytes=max_bytes, backupCount=backups)
+        handler.setFormatter(logging.Formatter("%(asctime)s %(message)s"))
+        self.__logger = logging.getLogger("fruit.metrics")
+        self.__logger.propagate = False
+        self.__logger.setLevel(logging.INFO)
+        self.__logger.addHandler(handler)
+
+    def tick(self, now):
+        if now >= self.__next_write:
+            self.__next_write = now + self.interval
+            self.__logger.info(registry.summary())
+
+def start(network):
+    """Start serving the metrics, and logging them, as configured in
+    the metrics section of the configuration file.  Returns the
+    MetricsLog, or None if logging is disabled."""
+
+    for address in config.get_all("metrics", "listen"):
+        MetricsServer(network, address)
+
+    log_file = config.get("metrics", "log-file")
+    if not log_file:
+        return None
+
+    return MetricsLog(log_file, config.getfloat("metrics", "log-interval"), config.getint("metrics", "log-max-bytes"),
+                      config.getint("metrics", "log-backups"))
@@ -0,0 +1,408 @@
+import sys, time
+
+from panda3d.core import Point3, Vec3
+
+from .gamestate import MOVING_OBJECT_UPDATE_TIME, Player, Thing
+from .. import config
+
+# NumPy is only needed if there are NPCs, so the server can run without it.
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# NPCs walk in a straight line for between this many seconds before picking a new direction.
+MIN_TURN_INTERVAL = 2.0
+MAX_TURN_INTERVAL = 10.0
+
+class Npc(object):
+
+    """One of the NPCs in an NpcStore.  It has the methods which the
+    player update code uses to find out about Things, but its state
+    is kept in the store's arrays, at position index."""
+
+    __slots__ = ("store", "index", "id", "name", "height", "radius")
+
+    def __init__(self, store, index, name, height, radius, thing_id=None):
+        self.store = store
+        self.index = index
+        if thing_id is not None:
+            self.id = Thing.ids.adopt(thing_id, self)
+        else:
+            self.id = Thing.ids.allocate(self)
+        self.name = name
+        self.height = height
+        self.radius = radius
+
+    def get_position(self):
+        return Point3(*self.store.position[self.index].tolist())
+
+    def get_velocity(self):
+        return Vec3(*self.store.velocity[self.index].tolist())
+
+    def get_angular_velocity(self):
+        return float(self.store.angular_velocity[self.index])
+
+    def get_state(self):
+        return self.store.get_state(self.index)
+
+    def move(self, x, y, z):
+        self.store.move(self.index, x, y, z)
+
+    def set_velocity(self, x, y, z):
+        self.store.set_velocity(self.index, x, y, z)
+
+    def destroy(self):
+        self.store.remove(self)
+
+    def handoff_state(self):
+        return self.store.handoff_state(self.index)
+
+    def hand_off(self):
+        self.store.hand_off(self)
+
+# The arrays in an NpcStore which describe the NPCs themselves, and are saved in checkpoints, with the shape of
+# each entry.  They are all arrays of floats.  size holds each NPC's height and radius.
+STATE_ARRAYS = (("position", (3,)), ("velocity", (3,)), ("heading", ()), ("angular_velocity", ()), ("size", (2,)))
+
+# All the arrays, with their types.  The broadcast array holds the position and heading each NPC had when it was
+# last sent to clients, and cell the grid cell it is filed under.
+_ARRAYS = tuple((name, shape, float) for name, shape in STATE_ARRAYS) + \
+    (("due_time", (), float), ("next_turn", (), float), ("broadcast", (4,), float), ("cell", (2,), int))
+
+class NpcStore(object):
+
+    """Keeps the state of a large number of simple NPCs in NumPy arrays
+    (one array per field, rather than one object per NPC), so that the
+    work done for them each tick is a handful of operations on whole
+    arrays rather than a loop over Python objects.  Moving them,
+    working out which ones need to be sent to clients, and quantizing
+    their states are all done that way.
+
+    Simple NPCs have no physical body.  They walk across the ground
+    in straight lines, turning to a random new heading every few
+    seconds (or back towards the middle, if they stray further than
+    wander_radius), and don't collide with anything.  Thousands of
+    character controllers would be far too much for the physics
+    engine, and the arrays are the only copy of the NPCs' state, so
+    there is nothing to keep in step with the scene graph.
+
+    As for Things, velocities are relative to the NPC's heading
+    (forward is +Y), because that is how clients apply them.  NPCs
+    share Things' IDs, and are updated on the same terms: every
+    MOVING_OBJECT_UPDATE_TIME seconds while they are moving, and
+    otherwise only when they change."""
+
+    def __init__(self, game_state, walk_speed, wander_radius, capacity=1024, seed=None):
+        self.game_state = game_state
+        self.walk_speed = walk_speed
+        self.wander_radius = wander_radius
+        self.random = numpy.random.RandomState(seed)
+        self.count = 0
+        self.capacity = 0
+        self.__npcs = []
+        self.__next_name = 0
+        self.__name_step = 1
+        self.__states = None
+        self.__states_tick = None
+        self.__grow(capacity)
+
+    def __len__(self):
+        return self.count
+
+    def number_names(self, first, step):
+        """Number the names of new NPCs first, first + step, and so
+        on, as Thing.number_names does for Things, so that the zones
+        don't give their NPCs the same names."""
+
+        self.__next_name = first - step
+        self.__name_step = step
+
+    def __iter__(self):
+        return iter(self.__npcs)
+
+    def __grow(self, capacity):
+        for name, shape, dtype in _ARRAYS:
+            array = numpy.zeros((capacity,) + shape, dtype)
+            if self.count:
+                array[:self.count] = getattr(self, name)[:self.count]
+            setattr(self, name, array)
+
+        self.capacity = capacity
+
+    def spawn(self, count, height=1.75, radius=0.4, name="Npc"):
+        """Create count NPCs, scattered at random within the wander
+        radius, and return them."""
+
+        first, last = self.__make_room(count)
+
+        angles = self.random.uniform(0, 2 * numpy.pi, count)
+        distances = self.wander_radius * numpy.sqrt(self.random.uniform(0, 1, count))
+        self.position[first:last, 0] = distances * numpy.cos(angles)
+        self.position[first:last, 1] = distances * numpy.sin(angles)
+        self.position[first:last, 2] = height / 2
+        self.velocity[first:last] = (0, self.walk_speed, 0)
+        self.heading[first:last] = self.random.uniform(0, 360, count)
+        self.angular_velocity[first:last] = 0
+        self.size[first:last] = (height, radius)
+        return self.__add(first, last, name)
+
+    def adopt(self, state):
+        """Add an NPC which another zone has handed over, with the ID
+        and name it already has, and return it."""
+
+        first, last = self.__make_room(1)
+        self.position[first] = state["position"]
+        self.velocity[first] = state["velocity"]
+        self.heading[first] = state["heading"]
+        self.angular_velocity[first] = state["angular_velocity"]
+        self.size[first] = (state["height"], state["radius"])
+        return self.__add(first, last, adopted=[(state["id"], state["name"])])[0]
+
+    def restore(self, arrays, name="Npc"):
+        """Add NPCs whose state was saved by snapshot.  arrays is a
+        dictionary of arrays (which may be read-only, such as views of
+        a memory-mapped file), keyed by the names in STATE_ARRAYS."""
+
+        first, last = self.__make_room(len(arrays["position"]))
+        for array_name, shape in STATE_ARRAYS:
+            getattr(self, array_name)[first:last] = arrays[array_name]
+
+        return self.__add(first, last, name)
+
+    def snapshot(self):
+        """Return a copy of the NPCs' state, in the form taken by
+        restore."""
+
+        return dict((name, getattr(self, name)[:self.count].copy()) for name, shape in STATE_ARRAYS)
+
+    def __make_room(self, count):
+        first = self.count
+        last = first + count
+        if last > self.capacity:
+            self.__grow(max(last, 2 * self.capacity))
+
+        return first, last
+
+    def __add(self, first, last, name=None, adopted=None):
+        # Finish setting up the NPCs in the given range, whose state has been filled in.  Adopted NPCs already
+        # have IDs and names, listed in adopted; the others are named after name.
+        self.due_time[first:last] = 0
+        self.next_turn[first:last] = time.time() + self.random.uniform(0, MAX_TURN_INTERVAL, last - first)
+        self.broadcast[first:last, :3] = self.position[first:last]
+        self.broadcast[first:last, 3] = self.heading[first:last]
+        self.cell[first:last] = numpy.floor(self.position[first:last, :2] / self.game_state.grid.cell_size)
+
+        npcs = []
+        grid = self.game_state.grid
+        for index in xrange(first, last):
+            if adopted is not None:
+                thing_id, npc_name = adopted[index - first]
+            else:
+                self.__next_name += self.__name_step
+                thing_id, npc_name = None, name + str(self.__next_name)
+
+            npc = Npc(self, index, npc_name, self.size[index, 0], self.size[index, 1], thing_id)
+            grid.update(npc, self.position[index, 0], self.position[index, 1])
+            npcs.append(npc)
+
+        self.__npcs.extend(npcs)
+        self.count = last
+        self.__states_tick = None
+        return npcs
+
+    def remove(self, npc):
+        """Destroy an NPC.  The last NPC is moved into its place, so the
+        arrays stay packed."""
+
+        Player.forget_everywhere(npc)
+        self.__take_out(npc)
+        Thing.ids.release(npc.id)
+
+    def hand_off(self, npc):
+        """Remove an NPC which another zone is taking over.  As for
+        Things, players aren't told to forget it, and its ID stays
+        reserved."""
+
+        self.__take_out(npc)
+        Thing.ids.lend(npc.id)
+
+    def handoff_state(self, index):
+        """Return everything another zone needs in order to take the
+        NPC at index over, in the same form as Thing.handoff_state."""
+
+        npc = self.__npcs[index]
+        return {"id": npc.id, "name": npc.name, "height": npc.height, "radius": npc.radius,
+                "position": tuple(self.position[index].tolist()), "heading": float(self.heading[index]),
+                "velocity": tuple(self.velocity[index].tolist()),
+                "angular_velocity": float(self.angular_velocity[index]), "state": self.get_state(index)}
+
+    def between(self, low, high):
+        """Return the NPCs whose X coordinates are between low and
+        high."""
+
+        x = self.position[:self.count, 0]
+        npcs = self.__npcs
+        return [npcs[index] for index in numpy.flatnonzero((x >= low) & (x <= high)).tolist()]
+
+    def outside(self, low, high):
+        """Return the NPCs whose X coordinates are below low or above
+        high."""
+
+        x = self.position[:self.count, 0]
+        npcs = self.__npcs
+        return [npcs[index] for index in numpy.flatnonzero((x < low) | (x > high)).tolist()]
+
+    def __take_out(self, npc):
+        self.game_state.grid.remove(npc)
+
+        index = npc.index
+        last = self.count - 1
+        if index != last:
+            for name, shape, dtype in _ARRAYS:
+                array = getattr(self, name)
+                array[index] = array[last]
+
+            moved = self.__npcs[last]
+            moved.index = index
+            self.__npcs[index] = moved
+
+        self.__npcs.pop()
+        self.count = last
+        self.__states_tick = None
+
+    def move(self, index, x, y, z):
+        self.position[index] = (x, y, z)
+        self.cell[index] = numpy.floor(self.position[index, :2] / self.game_state.grid.cell_size)
+        self.game_state.grid.update(self.__npcs[index], x, y)
+        self.due_time[index] = 0
+        self.__states_tick = None
+
+    def set_velocity(self, index, x, y, z):
+        self.velocity[index] = (x, y, z)
+        self.due_time[index] = 0
+        self.__states_tick = None
+
+    def update(self, dt, now):
+        """Move all the NPCs on by one tick."""
+
+        count = self.count
+        if count == 0:
+            return
+
+        position = self.position[:count]
+        velocity = self.velocity[:count]
+        heading = self.heading[:count]
+
+        # Pick new directions for the NPCs which have walked far enough, and turn back the ones which have strayed
+        # too far and are still heading away from the middle.
+        turning = numpy.flatnonzero(self.next_turn[:count] <= now)
+        if len(turning):
+            heading[turning] = self.random.uniform(0, 360, len(turning))
+            self.next_turn[turning] = now + self.random.uniform(MIN_TURN_INTERVAL, MAX_TURN_INTERVAL, len(turning))
+            self.due_time[turning] = 0
+
+        radians = numpy.radians(heading)
+        sin = numpy.sin(radians)
+        cos = numpy.cos(radians)
+
+        # In Panda's coordinates, an NPC with heading h faces (-sin h, cos h).
+        strayed = numpy.flatnonzero((position[:, 0] ** 2 + position[:, 1] ** 2 > self.wander_radius ** 2) &
+                                    (position[:, 1] * cos - position[:, 0] * sin > 0))
+        if len(strayed):
+            heading[strayed] = numpy.degrees(numpy.arctan2(position[strayed, 0], -position[strayed, 1]))
+            radians[strayed] = numpy.radians(heading[strayed])
+            sin[strayed] = numpy.sin(radians[strayed])
+            cos[strayed] = numpy.cos(radians[strayed])
+            self.due_time[strayed] = 0
+
+        position[:, 0] += (velocity[:, 0] * cos - velocity[:, 1] * sin) * dt
+        position[:, 1] += (velocity[:, 0] * sin + velocity[:, 1] * cos) * dt
+        position[:, 2] += velocity[:, 2] * dt
+        heading += self.angular_velocity[:count] * dt
+        heading %= 360
+
+        # Only the NPCs which have crossed into a new cell need to be refiled in the grid.
+        grid = self.game_state.grid
+        cells = numpy.floor(position[:, :2] / grid.cell_size).astype(int)
+        changed = numpy.flatnonzero((cells != self.cell[:count]).any(axis=1))
+        self.cell[:count] = cells
+        npcs = self.__npcs
+        for index in changed.tolist():
+            grid.update(npcs[index], position[index, 0], position[index, 1])
+
+        # NPCs which are moving are updated regularly anyway.  Stationary ones are only sent again if something has
+        # moved them further than the epsilons since they were last sent.
+        broadcast = self.broadcast[:count]
+        turned = numpy.abs(heading - broadcast[:, 3]) % 360
+        changed = (numpy.abs(position - broadcast[:, :3]).max(axis=1) > self.game_state.position_epsilon) | \
+            (numpy.minimum(turned, 360 - turned) > self.game_state.angle_epsilon)
+        self.due_time[:count][changed & ~self.__moving(slice(0, count))] = 0
+
+        self.__states_tick = None
+
+    def __moving(self, indices):
+        return (self.velocity[indices] != 0).any(axis=1) | (self.angular_velocity[indices] != 0)
+
+    def pop_due(self, now):
+        """Return the NPCs which are due to be sent to clients, and
+        schedule their next updates."""
+
+        due = numpy.flatnonzero(self.due_time[:self.count] < now)
+        if not len(due):
+            return []
+
+        self.broadcast[due, :3] = self.position[due]
+        self.broadcast[due, 3] = self.heading[due]
+        self.due_time[due] = numpy.where(self.__moving(due), now + MOVING_OBJECT_UPDATE_TIME, numpy.inf)
+
+        npcs = self.__npcs
+        return [npcs[index] for index in due.tolist()]
+
+    def get_state(self, index):
+        """Return the quantized state of an NPC, as sent to clients.
+        The states of all the NPCs are quantized together, once per
+        tick, the first time one of them is needed."""
+
+        if self.__states_tick != self.game_state.tick:
+            self.__states_tick = self.game_state.tick
+
+            count = self.count
+            quantizer = self.game_state.quantizer
+            states = numpy.empty((count, 8))
+            states[:, 0:3] = self.position[:count]
+            states[:, 3:6] = self.velocity[:count]
+            states[:, 0:6] /= quantizer.position_precision
+            states[:, 6] = self.heading[:count]
+            states[:, 7] = self.angular_velocity[:count]
+            states[:, 6:8] /= quantizer.angle_precision
+            self.__states = numpy.rint(states).astype(int)
+
+        return tuple(self.__states[index].tolist())
+
+def start(game_state, saved=None, zone=0, zones=1):
+    """Create the NPCs described in the npcs section of the
+    configuration file.  NPCs saved in a checkpoint (saved is a
+    dictionary of arrays, as taken by NpcStore.restore) are brought
+    back first, and new ones are only created if there are fewer than
+    count of them.  When the world is split into zones, each zone
+    creates its share of the NPCs, and hands them over to the zones
+    they belong in.  Returns the NpcStore, or None if there aren't any
+    NPCs."""
+
+    count = config.getint("npcs", "count")
+    if count <= 0 and saved is None:
+        return None
+
+    if numpy is None:
+        print >>sys.stderr, "NumPy isn't installed, so no NPCs will be created."
+        return None
+
+    share = count * (zone + 1) // zones - count * zone // zones
+    store = NpcStore(game_state, config.getfloat("npcs", "walk-speed"), config.getfloat("npcs", "wander-radius"))
+    store.number_names(zone + 1, zones)
+    if saved is not None:
+        store.restore(saved)
+    if len(store) < share:
+        store.spawn(share - len(store))
+    return store
@@ -0,0 +1,49 @@
+class Prioritizer(object):
+
+    """Decides the order in which one client is sent updates about
+    the Things it knows, when there isn't enough bandwidth to send
+    them all at once.
+
+    Each Thing which needs to be sent has an accumulated priority.
+    Every tick, each waiting Thing's priority is increased by a weight
+    which reflects how important it is to this client (for example,
+    nearby and fast-moving Things have higher weights).  The Things
+    with the highest priorities are sent first, and a Thing's priority
+    is reset when it is sent.  Because priorities keep growing while
+    Things wait, unimportant Things are delayed but never starved."""
+
+    def __init__(self):
+        self.__priorities = {}
+
+    def __len__(self):
+        return len(self.__priorities)
+
+    def __contains__(self, thing):
+        return thing in self.__priorities
+
+    def add(self, things, priority=0.0):
+        """Mark the Things as needing to be sent.  If a Thing is
+        already waiting, it keeps its accumulated priority, plus the
+        priority given here."""
+
+        priorities = self.__priorities
+        for thing in things:
+            priorities[thing] = priorities.get(thing, 0.0) + priority
+
+    def discard(self, thing):
+        self.__priorities.pop(thing, None)
+
+    def accumulate(self, weight):
+        """Increase the priority of every waiting Thing by weight(thing)."""
+
+        priorities = self.__priorities
+        for thing in priorities:
+            priorities[thing] += weight(thing)
+
+    def by_priority(self):
+        """Return the waiting Things, highest priority first."""
+
+        return sorted(self.__priorities, key=self.__priorities.__getitem__, reverse=True)
+
+    def sent(self, thing):
+        del self.__priorities[thing]
@@ -0,0 +1,142 @@
+import cProfile, heapq, os, pstats, signal, sys, time
+
+from .. import config
+
+class TickProfiler(object):
+
+    """Profiles the next few ticks of the simulation when asked to, so
+    that a slow server can be investigated while it is running.
+
+    Normally the profiler does nothing at all: the ticker calls the
+    simulation directly.  When the profiler is armed, it replaces the
+    ticker's function with one which runs each tick under cProfile,
+    and puts the original back once it has profiled the requested
+    number of ticks.
+
+    The results are written to a new directory, named after the time
+    profiling started.  all-ticks.prof has the combined profile of
+    every tick, and the slowest few ticks are kept separately as
+    slowest-N.prof, since a profile of one bad tick is often more
+    telling than an average which hides it.  The files can be read
+    with pstats, or a viewer such as SnakeViz.  summary.txt lists the
+    wall time of every tick, followed by the top of the combined
+    profile."""
+
+    def __init__(self, ticker, ticks, keep_slowest, directory):
+        self.ticker = ticker
+        self.ticks = ticks
+        self.keep_slowest = keep_slowest
+        self.directory = directory
+        self.__original = None
+
+    def running(self):
+        return self.__original is not None
+
+    def arm(self, *signal_args):
+        """Start profiling from the next tick.  This takes (and
+        ignores) any arguments, so that it can be used as a signal
+        handler.  Python runs signal handlers on the main thread, which
+        is the one running the simulation, so if the signal arrives in
+        the middle of a tick, that tick finishes normally and profiling
+        starts with the next one."""
+
+        if self.running():
+            return
+
+        print >>sys.stderr, "Profiling the next %d ticks." % self.ticks
+
+        self.__started = time.time()
+        self.__durations = []
+        self.__slowest = []
+        self.__combined = None
+        self.__original = self.ticker.tick
+        self.ticker.tick = self.__profiled_tick
+
+    def __profiled_tick(self, dt):
+        profile = cProfile.Profile()
+        start = time.time()
+        try:
+            profile.runcall(self.__original, dt)
+        finally:
+            duration = time.time() - start
+            self.__record(profile, duration)
+
+    def __record(self, profile, duration):
+        tick_number = self.ticker.ticks + 1
+        self.__durations.append((tick_number, duration))
+
+        if self.__combined is None:
+            self.__combined = pstats.Stats(profile)
+        else:
+            self.__combined.add(profile)
+
+        # A min-heap of the slowest ticks so far, so the fastest of them is the one pushed out.
+        entry = (duration, tick_number, profile)
+        if len(self.__slowest) < self.keep_slowest:
+            heapq.heappush(self.__slowest, entry)
+        elif self.__slowest and duration > self.__slowest[0][0]:
+            heapq.heapreplace(self.__slowest, entry)
+
+        if len(self.__durations) >= self.ticks:
+            self.ticker.tick = self.__original
+            self.__write_results()
+            self.__original = None
+
+    def __write_results(self):
+        directory = os.path.join(self.directory, time.strftime("profile-%Y%m%d-%H%M%S",
+                                                               time.localtime(self.__started)))
+        try:
+            os.makedirs(directory)
+
+            self.__combined.dump_stats(os.path.join(directory, "all-ticks.prof"))
+
+            slowest = sorted(self.__slowest, reverse=True)
+            for rank, (duration, tick_number, profile) in enumerate(slowest, 1):
+                profile.dump_stats(os.path.join(directory, "slowest-%d.prof" % rank))
+
+            with open(os.path.join(directory, "summary.txt"), "w") as summary:
+                self.__write_summary(summary, slowest)
+        except (IOError, OSError) as e:
+            print >>sys.stderr, "Couldn't write the profile to %s: %s" % (directory, e)
+        else:
+            print >>sys.stderr, "Profile written to %s." % directory
+
+        # Don't hang on to the profiles until the next time.
+        self.__slowest = []
+        self.__combined = None
+
+    def __write_summary(self, summary, slowest):
+        durations = [duration for tick_number, duration in self.__durations]
+        print >>summary, "%d ticks profiled, budget %.1f ms." % (len(durations), self.ticker.tick_length * 1000)
+        print >>summary, "Wall time: mean %.2f ms, longest %.2f ms (including the profiler's overhead)." % \
+            (sum(durations) / len(durations) * 1000, max(durations) * 1000)
+
+        print >>summary
+        print >>summary, "Slowest ticks:"
+        for rank, (duration, tick_number, profile) in enumerate(slowest, 1):
+            print >>summary, "  slowest-%d.prof: tick %d, %.2f ms" % (rank, tick_number, duration * 1000)
+
+        print >>summary
+        print >>summary, "Every tick:"
+        for tick_number, duration in self.__durations:
+            print >>summary, "  tick %d: %.2f ms" % (tick_number, duration * 1000)
+
+        print >>summary
+        print >>summary, "Combined profile, by cumulative time:"
+        self.__combined.stream = summary
+        self.__combined.sort_stats("cumulative").print_stats(40)
+
+def install(ticker):
+    """Create a TickProfiler for the ticker, as configured in the
+    profiler section of the configuration file, and arm it whenever
+    the server receives SIGUSR1.  Returns the profiler, or None if it
+    is disabled."""
+
+    ticks = config.getint("profiler", "ticks")
+    if ticks <= 0 or not hasattr(signal, "SIGUSR1"):
+        return None
+
+    profiler = TickProfiler(ticker, ticks, config.getint("profiler", "keep-slowest"),
+                            config.get("profiler", "directory"))
+    signal.signal(signal.SIGUSR1, profiler.arm)
+    return profiler
@@ -0,0 +1,118 @@
+class UpdateScheduler(object):
+
+    """A priority queue (http://en.wikipedia.org/wiki/Priority_queue)
+    of items which are due to be processed at some time.  Each item
+    appears in the queue at most once: scheduling an item which is
+    already queued just changes its due time.
+
+    The queue is a binary heap, like the ones made by the heapq
+    module, but we also keep a dictionary giving the position of each
+    item in the heap.  This allows an item's due time to be changed,
+    or the item to be removed, in O(log n) time without searching for
+    it.
+
+    Each heap entry is a list of [due time, sequence number, item].
+    The sequence number breaks ties between items which are due at
+    the same time, so the items themselves are never compared, and
+    items which were scheduled first come out first."""
+
+    def __init__(self):
+        self.__heap = []
+        self.__positions = {}
+        self.__sequence = 0
+
+    def __len__(self):
+        return len(self.__heap)
+
+    def __contains__(self, item):
+        return item in self.__positions
+
+    def schedule(self, item, due_time):
+        """Add the item to the queue, or change its due time if it is
+        already queued."""
+
+        self.__sequence += 1
+        position = self.__positions.get(item)
+
+        if position is None:
+            self.__heap.append([due_time, self.__sequence, item])
+            self.__positions[item] = len(self.__heap) - 1
+            self.__sift_up(len(self.__heap) - 1)
+        else:
+            entry = self.__heap[position]
+            old_due_time = entry[0]
+            entry[0] = due_time
+            entry[1] = self.__sequence
+
+            if due_time < old_due_time:
+                self.__sift_up(position)
+            else:
+                self.__sift_down(position)
+
+    def remove(self, item):
+        position = self.__positions.pop(item, None)
+        if position is None:
+            return
+
+        last = self.__heap.pop()
+        if position < len(self.__heap):
+            self.__heap[position] = last
+            self.__positions[last[2]] = position
+            self.__sift_up(position)
+            self.__sift_down(self.__positions[last[2]])
+
+    def pop_due(self, now):
+        """Remove and return a list of all the items which are due
+        before the given time, earliest first."""
+
+        due = []
+        heap = self.__heap
+        while heap and heap[0][0] < now:
+            item = heap[0][2]
+            self.remove(item)
+            due.append(item)
+
+        return due
+
+    def __sift_up(self, position):
+        heap = self.__heap
+        entry = heap[position]
+
+        while position > 0:
+            parent_position = (position - 1) >> 1
+            parent = heap[parent_position]
+            if entry < parent:
+                heap[position] = parent
+                self.__positions[parent[2]] = position
+                position = parent_position
+            else:
+                break
+
+        heap[position] = entry
+        self.__positions[entry[2]] = position
+
+    def __sift_down(self, position):
+        heap = self.__heap
+        size = len(heap)
+        entry = heap[position]
+
+        while True:
+            child_position = 2 * position + 1
+            if child_position >= size:
+                break
+
+            # Move the smaller of the two children up.
+            right_position = child_position + 1
+            if right_position < size and heap[right_position] < heap[child_position]:
+                child_position = right_position
+
+            child = heap[child_position]
+            if child < entry:
+                heap[position] = child
+                self.__positions[child[2]] = position
+                position = child_position
+            else:
+                break
+
+        heap[position] = entry
+        self.__positions[entry[2]] = position
@@ -1,8 +1,9 @@
-import asyncore, re, socket
-import pymongo.errors
+import asyncore, re, socket, sys
 
-from . import db
-from .gamestate import GameState, Player
+from . import checkpoint, metrics, npcs, profiler, zones
+from .accounts import AccountExists, AccountService, open_backend
+from .credentials import SessionSigner
+from .gamestate import GameState
 from .. import config, messaging
 from ..rpc import account_pb2, game_pb2
 
@@ -10,8 +11,13 @@ class FruitRequestHandler(messaging.Rpc):
 
     """Send and receive RPC messages on behalf of the server."""
 
+    # The connection each user is playing through, by user ID.
+    __playing = {}
+
     def __init__(self, server, conn, addr):
-        messaging.Rpc.__init__(self, server, conn, addr)
+        messaging.Rpc.__init__(self, server.network, conn)
+        self.__user_id = None
+        self.__player = None
         self.__next_event_tag = 0
         self.__events = {}
 
@@ -19,76 +25,166 @@ class FruitRequestHandler(messaging.Rpc):
     def set_game_state(self, game_state):
         self.game_state = game_state
 
-    def message_received(self, name, msg):
-        if name == "account_pb2.NewAccount":
-            data = account_pb2.NewAccount()
-            data.ParseFromString(msg)
-            self.__new_account(data.user_id, data.password)
-        elif name == "account_pb2.Login":
-            data = account_pb2.Login()
-            data.ParseFromString(msg)
-            self.__login(data.user_id, data.password)
-        elif name == "game_pb2.EventOccurred":
-            data = game_pb2.EventOccurred()
-            data.ParseFromString(msg)
-            self.__events[data.tag](*[self.decode_variant(arg) for arg in data.args])
-
-    def __new_account(self, user_id, password):
-        try:
-            user = {"user_id": user_id, "password": password}
-            db().users.insert(user, safe=True)
+    @classmethod
+    def set_account_service(self, accounts, sessions):
+        self.accounts = accounts
+        self.sessions = sessions
+
+    def connection_closed(self):
+        # The player's avatar leaves the game with them.
+        self.__leave_game()
+
+    def __leave_game(self):
+        if self.__player is not None:
+            self.__player.destroy()
+            self.__player = None
+            if self.__playing.get(self.__user_id) is self:
+                del self.__playing[self.__user_id]
+
+    @messaging.handles(game_pb2.SnapshotAck)
+    def __snapshot_ack(self, data):
+        # A connection which has been replaced by a newer one may still send game messages until its client
+        # hears that it has been kicked.  These are ignored.
+        if self.__player is not None:
+            self.__player.acknowledge_snapshot(data.tick)
+
+    @messaging.handles(game_pb2.Ping)
+    def __ping(self, data):
+        msg = game_pb2.Pong()
+        msg.sequence = data.sequence
+        msg.tick = self.game_state.tick
+        msg.tick_duration = self.game_state.ticker.last_tick_duration
+        self.send_rpc(msg)
 
+    @messaging.handles(game_pb2.InputBatch)
+    def __input_batch(self, data):
+        # The commands are in order, so only the last one matters.
+        if data.commands and self.__player is not None:
+            command = data.commands[-1]
+            self.__player.queue_input(command.sequence, command.controls)
+
+    @messaging.handles(game_pb2.KeepaliveRequest)
+    def __keepalive_request(self, data):
+        if self.__player is not None:
+            self.__player.set_keepalive(data.interval)
+
+    @messaging.handles(game_pb2.EventOccurred)
+    def __event_occurred(self, data):
+        # A client may report an event nobody asked for (an old client, for example, or a broken one).  That
+        # isn't worth dropping the connection over, so it is ignored.
+        handler = self.__events.get(data.tag)
+        if handler is not None:
+            handler(*[self.decode_variant(arg) for arg in data.args])
+
+    @messaging.handles(account_pb2.NewAccount)
+    def __new_account(self, data):
+        self.accounts.create_user(self, data.user_id, data.password, self.__account_created)
+
+    def __account_created(self, result, error):
+        if error is None:
             msg = account_pb2.TellUser()
             msg.message = "Your account has been created.  Thank you for registering."
             self.send_rpc(msg)
-        except pymongo.errors.DuplicateKeyError:
+        elif isinstance(error, AccountExists):
             msg = account_pb2.Error()
             msg.message = "That user ID is already in use."
             self.send_rpc(msg)
+        else:
+            self.__database_unavailable()
 
         msg = account_pb2.Kick()
         self.send_rpc(msg)
 
-    def __login(self, user_id, password):
-        user = db().users.find_one({"user_id": user_id})
-        if user is None or user["password"] != password:
+    @messaging.handles(account_pb2.Login)
+    def __login(self, data):
+        if self.__already_playing():
+            return
+
+        self.accounts.authenticate(self, data.user_id, data.password, self.__authenticated)
+
+    @messaging.handles(account_pb2.Resume)
+    def __resume(self, data):
+        if self.__already_playing():
+            return
+
+        # The token is checked here, rather than by the account service, because it's quick and doesn't need
+        # the database.
+        user_id = self.sessions.verify(data.session_token)
+        if user_id is None:
             msg = account_pb2.Error()
-            msg.message = "Unknown user ID or incorrect password."
+            msg.message = "Your session has expired.  Please log in again."
             self.send_rpc(msg)
 
             msg = account_pb2.Kick()
             self.send_rpc(msg)
         else:
-            self.__player = Player(self.game_state, self)
-            msg = game_pb2.Start()
-            msg.player_tag = self.__player.name
+            self.__start_player(user_id)
+
+    def __database_unavailable(self):
+        msg = account_pb2.Error()
+        msg.message = "The account database is unavailable.  Please try again later."
+        self.send_rpc(msg)
+
+    def __authenticated(self, user, error):
+        # The client may have disconnected while we were waiting for the database.
+        if not self.connected:
+            return
+
+        if error is not None:
+            self.__database_unavailable()
+
+            msg = account_pb2.Kick()
+            self.send_rpc(msg)
+        elif user is None:
+            msg = account_pb2.Error()
+            msg.message = "Unknown user ID or incorrect password."
             self.send_rpc(msg)
 
-            # Set up the keyboard controls.
-            player_speed = 10
-            strafe_speed = player_speed / 2
-            turn_speed = 30
+            msg = account_pb2.Kick()
+            self.send_rpc(msg)
+        else:
+            self.__start_player(user["user_id"])
+
+    def __already_playing(self):
+        # Each connection only has one avatar, so logging in (or resuming) again on the same connection is refused.
+        if self.__player is None:
+            return False
+
+        msg = account_pb2.Error()
+        msg.message = "You are already logged in."
+        self.send_rpc(msg)
+        return True
+
+    def __start_player(self, user_id):
+        # Two Logins in quick succession can both be authenticated.
+        if self.__already_playing():
+            return
+
+        # A client which reconnects usually gets here before the server notices that its old connection has
+        # dropped.  The old avatar leaves the game, so the user doesn't have two, and the old connection is
+        # kicked, in case there is still a client at the other end.  The new avatar starts where the old one
+        # was, if the world is being checkpointed.
+        previous = self.__playing.get(user_id)
+        if previous is not None:
+            previous.__leave_game()
 
-            self.accept('w', self.__forward, [player_speed])
-            self.accept('w-up', self.__forward, [0])
-            self.accept('s', self.__forward, [-player_speed])
-            self.accept('s-up', self.__forward, [0])
+            msg = account_pb2.Error()
+            msg.message = "You have logged in again somewhere else."
+            previous.send_rpc(msg)
 
-            self.accept('a', self.__strafe, [-strafe_speed])
-            self.accept('a-up', self.__strafe, [0])
-            self.accept('d', self.__strafe, [strafe_speed])
-            self.accept('d-up', self.__strafe, [0])
+            msg = account_pb2.Kick()
+            previous.send_rpc(msg)
 
-            self.accept('arrow_left', self.__turn, [turn_speed])
-            self.accept('arrow_left-up', self.__turn, [0])
-            self.accept('arrow_right', self.__turn, [-turn_speed])
-            self.accept('arrow_right-up', self.__turn, [0])
+        self.__user_id = user_id
+        self.__player = self.game_state.add_player(self, user_id, self.sessions.issue(user_id))
+        self.__playing[user_id] = self
 
     def accept(self, event, handler, preset_args):
         """Subscribe to an event on the client.  This allows the
         server to receive keystrokes, mouse clicks, and so on.  A
         unique tag is sent to the client, allowing events of this type
-        to be distinguished from other events."""
+        to be distinguished from other events.  (The movement controls
+        are sent in InputBatch messages instead.)"""
 
         def handle_event(*event_args):
             handler(*(preset_args + list(event_args)))
@@ -103,28 +199,10 @@ class FruitRequestHandler(messaging.Rpc):
         msg.tag = self.__next_event_tag
         self.send_rpc(msg)
 
-    def __forward(self, speed):
-        """Set the player to move forward (W or S keys)."""
-
-        velocity = self.__player.get_velocity()
-        velocity.y = speed
-        self.__player.set_velocity(velocity)
-
-    def __strafe(self, speed):
-        """Set the player to move sideways (A or D keys)."""
-
-        velocity = self.__player.get_velocity()
-        velocity.x = speed
-        self.__player.set_velocity(velocity)
-
-    def __turn(self, rate):
-        """Set the player to turn (left and right arrow keys)."""
-
-        self.__player.set_angular_velocity(rate)
-
 class FruitServer(asyncore.dispatcher):
-    def __init__(self, address_family, address):
-        asyncore.dispatcher.__init__(self)
+    def __init__(self, network, address_family, address):
+        asyncore.dispatcher.__init__(self, map=network.map)
+        self.network = network
 
         ip, port = re.split(r"\s*,\s*", address, 2)
         port = int(port)
@@ -138,16 +216,91 @@ class FruitServer(asyncore.dispatcher):
         conn, addr = self.accept()
         FruitRequestHandler(self, conn, addr)
 
+def register_metrics(network, game_state):
+    """Add the metrics which depend on the network thread and the
+    game state."""
+
+    registry = metrics.registry
+
+    registry.counter("fruit_ticks_total", "Ticks run.", lambda: game_state.ticker.ticks)
+    registry.counter("fruit_tick_overruns_total", "Ticks which took longer than a tick.",
+                     lambda: game_state.ticker.overruns)
+    registry.counter("fruit_ticks_skipped_total", "Ticks skipped because the server fell too far behind.",
+                     lambda: game_state.ticker.skipped_ticks)
+
+    registry.counter("fruit_bytes_received_total", "Bytes received from clients.", lambda: network.bytes_received)
+    registry.counter("fruit_bytes_sent_total", "Bytes sent to clients.", lambda: network.bytes_sent)
+    registry.counter("fruit_messages_received_total", "Messages received from clients.",
+                     lambda: network.messages_received)
+    registry.counter("fruit_messages_sent_total", "Messages sent to clients.", lambda: network.messages_sent)
+    registry.gauge("fruit_queued_messages", "Messages waiting to be handled.", network.queued_messages)
+
+    def connections():
+        return [connection for connection in network.map.values() if isinstance(connection, FruitRequestHandler)]
+
+    def per_connection(function):
+        return lambda: [({"connection": "%s:%s" % connection.addr[:2]}, function(connection))
+                        for connection in connections()]
+
+    registry.gauge("fruit_connections", "Client connections.", lambda: len(connections()))
+    registry.counter("fruit_connection_bytes_received_total", "Bytes received from each client.",
+                     per_connection(lambda connection: connection.bytes_received))
+    registry.counter("fruit_connection_bytes_sent_total", "Bytes sent to each client.",
+                     per_connection(lambda connection: connection.bytes_sent))
+    registry.gauge("fruit_connection_buffered_bytes", "Bytes waiting to be sent to each client.",
+                   per_connection(lambda connection: connection.buffered_bytes()))
+
 def run():
+    # The zone workers are forked before anything else is set up, so that they don't inherit the listening sockets
+    # or any threads.
+    zone_map = zones.configured_map()
+    if zone_map is not None:
+        zone_workers = zones.start_workers(zone_map)
+
     listen4_addresses = config.get_all("network", "listen4")
     listen6_addresses = config.get_all("network", "listen6")
 
+    network = messaging.NetworkThread(config.getint("network", "inbox-size"))
+
     for address in listen4_addresses:
-        FruitServer(socket.AF_INET, address)
+        FruitServer(network, socket.AF_INET, address)
 
     for address in listen6_addresses:
-        FruitServer(socket.AF_INET6, address)
-
-    game_state = GameState()
+        FruitServer(network, socket.AF_INET6, address)
+
+    FruitRequestHandler.high_water_mark = config.getint("network", "high-water-mark")
+
+    # The saved world is loaded before anything else is set up, since the session key is part of it.
+    if zone_map is None:
+        saved = checkpoint.load_world()
+    else:
+        if config.get("checkpoint", "file"):
+            print >>sys.stderr, "The world can't be checkpointed when it is split into zones, so it won't be saved."
+        saved = checkpoint.SavedWorld()
+
+    workers = config.getint("database", "workers")
+    accounts = AccountService(network, open_backend(workers), workers, config.getint("accounts", "hash-processes"),
+                              config.getint("accounts", "hash-iterations"))
+    sessions = SessionSigner(config.getint("accounts", "session-lifetime"), saved.session_key)
+    FruitRequestHandler.set_account_service(accounts, sessions)
+
+    if zone_map is None:
+        game_state = GameState(network)
+        game_state.npcs = npcs.start(game_state, saved.npcs)
+        game_state.checkpointer = checkpoint.start(game_state, sessions.key, saved)
+    else:
+        game_state = zones.Coordinator(network, zone_map, zone_workers)
+
+    # The saved NPC arrays point into the memory-mapped checkpoint, which can be unmapped once they're copied.
+    del saved
     FruitRequestHandler.set_game_state(game_state)
-    game_state.run()
+
+    register_metrics(network, game_state)
+    game_state.metrics_log = metrics.start(network)
+    profiler.install(game_state.ticker)
+    network.start()
+    try:
+        game_state.run()
+    finally:
+        if game_state.checkpointer is not None:
+            game_state.checkpointer.close()
@@ -0,0 +1,66 @@
+import math
+
+class SpatialGrid(object):
+
+    """SpatialGrid is an index which allows us to find the Things
+    near a point without looking at every Thing in the world.  The
+    ground is divided into square cells, and each Thing is filed
+    under the cell which contains it.  (The Z coordinate is ignored,
+    because the world is essentially flat.)
+
+    To find the Things within a given radius of a point, we only need
+    to look in the cells which overlap the circle.  The result is a
+    superset of the Things which are really in range, so callers must
+    check the exact distance themselves."""
+
+    def __init__(self, cell_size):
+        self.cell_size = float(cell_size)
+        self.__cells = {}
+        self.__locations = {}
+
+    def __cell(self, x, y):
+        return int(math.floor(x / self.cell_size)), int(math.floor(y / self.cell_size))
+
+    def update(self, thing, x, y):
+        """Record that the Thing is now at (x, y).  This is cheap if the
+        Thing hasn't left its cell, so it can be called for every Thing
+        on every frame."""
+
+        cell = self.__cell(x, y)
+        old_cell = self.__locations.get(thing)
+        if old_cell == cell:
+            return
+
+        if old_cell is not None:
+            self.__remove_from_cell(thing, old_cell)
+
+        self.__cells.setdefault(cell, set()).add(thing)
+        self.__locations[thing] = cell
+
+    def remove(self, thing):
+        cell = self.__locations.pop(thing, None)
+        if cell is not None:
+            self.__remove_from_cell(thing, cell)
+
+    def __remove_from_cell(self, thing, cell):
+        occupants = self.__cells[cell]
+        occupants.discard(thing)
+        if not occupants:
+            del self.__cells[cell]
+
+    def __contains__(self, thing):
+        return thing in self.__locations
+
+    def query(self, x, y, radius):
+        """Generate every Thing in the cells which overlap the circle of
+        the given radius around (x, y)."""
+
+        min_x, min_y = self.__cell(x - radius, y - radius)
+        max_x, max_y = self.__cell(x + radius, y + radius)
+
+        for cell_x in xrange(min_x, max_x + 1):
+            for cell_y in xrange(min_y, max_y + 1):
+                occupants = self.__cells.get((cell_x, cell_y))
+                if occupants:
+                    for thing in occupants:
+                        yield thing
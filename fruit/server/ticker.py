@@ -0,0 +1,89 @@
+import sys
+from time import sleep, time
+
+class TickScheduler(object):
+
+    """Calls a function at a fixed rate, passing it the (fixed) length
+    of a tick in seconds.  Between ticks, the thread sleeps.
+
+    If a tick takes longer than its allotted time, the following ticks
+    are run straight away, without sleeping, until the simulation has
+    caught up with real time.  However, we never run more than
+    max_catch_up ticks back to back.  If we are further behind than
+    that, the missing ticks are skipped, and the simulation runs a
+    little slower than real time.  Otherwise a long stall could make
+    the server run flat out for a long time trying to catch up, which
+    would make things worse.
+
+    Ticks which take longer than the tick length are counted as
+    overruns, and a summary is printed every report_interval seconds
+    if there were any.
+
+    The function is kept in the tick attribute, and can be replaced
+    between ticks; the profiler does this to wrap it only while it is
+    running."""
+
+    def __init__(self, tick_rate, max_catch_up, tick, report_interval=10):
+        self.tick_length = 1.0 / tick_rate
+        self.max_catch_up = max_catch_up
+        self.report_interval = report_interval
+        self.tick = tick
+
+        # Totals since the server started.
+        self.ticks = 0
+        self.overruns = 0
+        self.skipped_ticks = 0
+        self.busy_time = 0.0
+        self.last_tick_duration = 0.0
+
+        self.__reset_report()
+
+    def __reset_report(self):
+        self.__report_ticks = 0
+        self.__report_overruns = 0
+        self.__report_skipped = 0
+        self.__report_longest = 0.0
+        self.__report_time = time() + self.report_interval
+
+    def run(self):
+        next_tick = time()
+
+        while True:
+            now = time()
+            if now < next_tick:
+                sleep(next_tick - now)
+                continue
+
+            behind = int((now - next_tick) / self.tick_length)
+            if behind > self.max_catch_up:
+                skipped = behind - self.max_catch_up
+                next_tick += skipped * self.tick_length
+                self.skipped_ticks += skipped
+                self.__report_skipped += skipped
+
+            self.run_tick()
+            next_tick += self.tick_length
+
+    def run_tick(self):
+        start = time()
+        self.tick(self.tick_length)
+        end = time()
+
+        duration = end - start
+        self.ticks += 1
+        self.busy_time += duration
+        self.last_tick_duration = duration
+        self.__report_ticks += 1
+        self.__report_longest = max(self.__report_longest, duration)
+
+        if duration > self.tick_length:
+            self.overruns += 1
+            self.__report_overruns += 1
+
+        if end >= self.__report_time:
+            if self.__report_overruns or self.__report_skipped:
+                print >>sys.stderr, "%d of the last %d ticks overran (longest %.1f ms, budget %.1f ms); " \
+                    "%d ticks skipped." % (self.__report_overruns, self.__report_ticks,
+                                           self.__report_longest * 1000, self.tick_length * 1000,
+                                           self.__report_skipped)
+            self.__reset_report()
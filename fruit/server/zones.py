@@ -0,0 +1,605 @@
+import math, multiprocessing, signal, sys
+from time import time
+
+from panda3d.core import Point3, Vec3
+
+from . import metrics, npcs, profiler
+from .gamestate import START_LOCATION, GameState, Player, Thing
+from .identifiers import IdAllocator
+from .ticker import TickScheduler
+from .. import config, messaging
+
+# A Thing is only handed over to the next zone once it is this many metres past the boundary, so that one which
+# wanders back and forth across the boundary isn't handed over every tick.
+HANDOFF_HYSTERESIS = 2.0
+
+class ZoneMap(object):
+
+    """Divides the world into count zones, which are strips running
+    north to south, width metres wide.  The boundaries are arranged
+    symmetrically around the middle of the world, and the outermost
+    zones extend to the edge of the world.
+
+    Things within ghost_margin metres of a boundary are copied to the
+    zone on the other side, as ghosts, so that players near the
+    boundary can see them."""
+
+    def __init__(self, count, width, ghost_margin):
+        if count > 2 and ghost_margin >= width:
+            raise ValueError("The ghost margin (%g) must be less than the width of the zones (%g)." %
+                             (ghost_margin, width))
+
+        self.count = count
+        self.width = width
+        self.ghost_margin = ghost_margin
+
+    def bounds(self, zone):
+        """Return the lowest and highest X coordinates in the zone."""
+
+        low = (zone - self.count / 2.0) * self.width if zone > 0 else float("-inf")
+        high = (zone + 1 - self.count / 2.0) * self.width if zone < self.count - 1 else float("inf")
+        return low, high
+
+    def zone_for(self, x):
+        """Return the zone which contains the X coordinate."""
+
+        return min(max(int(math.floor(x / self.width + self.count / 2.0)), 0), self.count - 1)
+
+    def neighbours(self, zone):
+        return [neighbour for neighbour in (zone - 1, zone + 1) if 0 <= neighbour < self.count]
+
+class Ghost(object):
+
+    """A copy of a Thing (or NPC) which belongs to a neighbouring zone,
+    but is close enough to the boundary for players in this zone to
+    see it.  It has the methods which the player update code uses to
+    find out about Things.  Its state is the quantized state which
+    the owning zone last sent, and it is updated whenever the owner
+    sends its own players an update about the Thing."""
+
+    __slots__ = ("id", "name", "height", "radius", "state", "values")
+
+    def __init__(self, thing_id, name, height, radius):
+        self.id = thing_id
+        self.name = name
+        self.height = height
+        self.radius = radius
+
+    def get_position(self):
+        return Point3(*self.values[0:3])
+
+    def get_velocity(self):
+        return Vec3(*self.values[3:6])
+
+    def get_angular_velocity(self):
+        return self.values[7]
+
+    def get_state(self):
+        return self.state
+
+class GhostStore(object):
+
+    """The ghosts in one zone.  Ghosts are filed in the zone's grid,
+    so players find them just as they find the zone's own Things, and
+    the store has a pop_due method, like an NpcStore, so that ghosts
+    whose state has changed are sent to the players who know them."""
+
+    def __init__(self, game_state):
+        self.game_state = game_state
+        self.__ghosts = {}
+        self.__due = set()
+
+    def __len__(self):
+        return len(self.__ghosts)
+
+    def get(self, thing_id):
+        return self.__ghosts.get(thing_id)
+
+    def update(self, added, changed, removed):
+        """Apply a batch of changes sent by a neighbouring zone.  added
+        lists (ID, name, height, radius, state) for the Things which
+        have come within the margin, changed lists (ID, state) for the
+        ones which have been updated, and removed lists the IDs of the
+        ones which have gone."""
+
+        for thing_id, name, height, radius, state in added:
+            # The ghost may already exist, if the Thing was handed over from this zone.  A Thing which this zone
+            # has taken over since the neighbour sent the batch isn't a ghost any more.
+            if Thing.ids.get(thing_id) is not None:
+                continue
+
+            ghost = self.__ghosts.get(thing_id)
+            if ghost is None:
+                ghost = self.__ghosts[thing_id] = Ghost(thing_id, name, height, radius)
+            self.__set_state(ghost, state)
+
+        for thing_id, state in changed:
+            ghost = self.__ghosts.get(thing_id)
+            if ghost is not None:
+                self.__set_state(ghost, state)
+
+        for thing_id in removed:
+            ghost = self.__ghosts.pop(thing_id, None)
+            if ghost is not None:
+                Player.forget_everywhere(ghost)
+                self.game_state.grid.remove(ghost)
+                self.__due.discard(ghost)
+
+    def add(self, state):
+        """Create a ghost of a Thing which this zone has just handed
+        over, from its handoff state, and return it."""
+
+        ghost = self.__ghosts[state["id"]] = Ghost(state["id"], state["name"], state["height"], state["radius"])
+        self.__set_state(ghost, state["state"])
+        return ghost
+
+    def take(self, thing_id):
+        """Remove the ghost of a Thing which this zone has just taken
+        over, without telling the players, and return it (or None if
+        there was no ghost)."""
+
+        ghost = self.__ghosts.pop(thing_id, None)
+        if ghost is not None:
+            self.game_state.grid.remove(ghost)
+            self.__due.discard(ghost)
+
+        return ghost
+
+    def pop_due(self, now):
+        due = list(self.__due)
+        self.__due.clear()
+        return due
+
+    def __set_state(self, ghost, state):
+        ghost.state = state
+        ghost.values = self.game_state.quantizer.dequantize(state)
+        self.game_state.grid.update(ghost, ghost.values[0], ghost.values[1])
+        self.__due.add(ghost)
+
+class ZoneConnection(object):
+
+    """Stands in for a client's connection in a zone worker.  Messages
+    for the client are encoded and kept until the end of the tick,
+    when they are passed to the coordinator, which owns the real
+    connection.  lagging is copied from the real connection at the
+    start of every tick."""
+
+    def __init__(self, connection_id):
+        self.connection_id = connection_id
+        self.lagging = False
+        self.frames = []
+
+    def send_rpc(self, msg, low_priority=False):
+        if low_priority and self.lagging:
+            return False
+
+        self.frames.append(messaging.encode_frame(msg))
+        return True
+
+    def cork(self):
+        pass
+
+    def uncork(self):
+        pass
+
+class Zone(object):
+
+    """Simulates one zone of the world, in a worker process.  The zone
+    has its own GameState, with its own BulletWorld, and stands in for
+    the GameState's network: instead of reading messages from
+    clients, it applies the events which the coordinator sends at the
+    start of each tick.  Those are the players' messages, along with
+    Things handed over by other zones, changes to the ghosts, and so
+    on.
+
+    After each tick, the zone sends the coordinator the messages for
+    its players' clients, the Things which have crossed into other
+    zones, and the changes to the ghosts of its Things which the
+    neighbouring zones hold."""
+
+    def __init__(self, zone_map, index, pipe):
+        self.zone_map = zone_map
+        self.index = index
+        self.pipe = pipe
+        self.low, self.high = zone_map.bounds(index)
+
+        self.__events = []
+        self.__handlers = {"join": self.__join, "leave": self.__leave, "input": self.__input,
+                           "keepalive": self.__keepalive, "ack": self.__ack, "arrive": self.__arrive,
+                           "ghosts": self.__ghosts, "release": self.__release}
+        self.__connections = {}
+        self.__players = {}
+
+        # For each neighbour, the states of the Things it has ghosts of, as last sent, by ID.  None means that
+        # the neighbour made the ghost itself, when it handed the Thing over.
+        self.__ghosted = dict((neighbour, {}) for neighbour in zone_map.neighbours(index))
+
+        self.game_state = GameState(self)
+        self.game_state.ghosts = GhostStore(self.game_state)
+        self.game_state.npcs = npcs.start(self.game_state, zone=index, zones=zone_map.count)
+
+    def run(self):
+        while True:
+            try:
+                request = self.pipe.recv()
+            except EOFError:
+                return
+
+            if request is None:
+                return
+
+            tick, self.__events, lagging = request
+            for connection_id, connection in self.__connections.iteritems():
+                connection.lagging = connection_id in lagging
+
+            # The coordinator numbers the ticks, so that snapshots are numbered the same way in every zone.
+            self.game_state.tick = tick - 1
+            self.game_state.ticker.run_tick()
+
+            frames = self.__collect_frames()
+            handoffs = self.__hand_off()
+            ghosts = self.__ghost_updates()
+            releases = Thing.ids.foreign_releases
+            Thing.ids.foreign_releases = []
+            stats = (self.game_state.ticker.last_tick_duration, len(Thing.ids), len(self.__players))
+            self.pipe.send((frames, handoffs, ghosts, releases, stats))
+
+    def process_messages(self):
+        """Apply the events sent by the coordinator.  The GameState
+        calls this at the start of the tick, as it would for a real
+        network."""
+
+        events, self.__events = self.__events, []
+        for event in events:
+            self.__handlers[event[0]](*event[1:])
+
+    def __join(self, connection_id, user_id, session_token):
+        connection = self.__connections[connection_id] = ZoneConnection(connection_id)
+        self.__players[connection_id] = self.game_state.add_player(connection, user_id, session_token)
+
+    def __leave(self, connection_id):
+        self.__connections.pop(connection_id, None)
+        player = self.__players.pop(connection_id, None)
+        if player is not None:
+            player.destroy()
+
+    def __input(self, connection_id, sequence, controls):
+        player = self.__players.get(connection_id)
+        if player is not None:
+            player.queue_input(sequence, controls)
+
+    def __keepalive(self, connection_id, interval):
+        player = self.__players.get(connection_id)
+        if player is not None:
+            player.set_keepalive(interval)
+
+    def __ack(self, connection_id, tick):
+        player = self.__players.get(connection_id)
+        if player is not None:
+            player.acknowledge_snapshot(tick)
+
+    def __arrive(self, state):
+        ghost = self.game_state.ghosts.take(state["id"])
+
+        if state["kind"] == "player":
+            connection_id = state["connection_id"]
+            connection = self.__connections[connection_id] = ZoneConnection(connection_id)
+            thing = self.__players[connection_id] = Player(self.game_state, connection, state["user_id"], state)
+        else:
+            thing = self.game_state.npcs.adopt(state)
+
+        if ghost is not None:
+            Player.substitute_everywhere(ghost, thing)
+
+        # If the zone which handed the Thing over made a ghost of it, that ghost is now ours to keep up to date.
+        if state["ghosted"] and state["zone"] in self.__ghosted:
+            self.__ghosted[state["zone"]][state["id"]] = None
+
+    def __ghosts(self, update):
+        self.game_state.ghosts.update(*update)
+
+    def __release(self, thing_id):
+        Thing.ids.release(thing_id)
+
+    def __collect_frames(self):
+        frames = {}
+        for connection_id, connection in self.__connections.iteritems():
+            if connection.frames:
+                frames[connection_id] = ("".join(connection.frames), len(connection.frames))
+                connection.frames = []
+
+        return frames
+
+    def __hand_off(self):
+        """Hand over everything which has crossed into another zone.
+        Returns a list of (zone, handoff state) pairs."""
+
+        low = self.low - HANDOFF_HYSTERESIS
+        high = self.high + HANDOFF_HYSTERESIS
+        leaving = [thing for thing in Thing.all_things() if not low <= thing.get_position().x <= high]
+        if self.game_state.npcs is not None:
+            leaving.extend(self.game_state.npcs.outside(low, high))
+
+        margin = self.zone_map.ghost_margin
+        handoffs = []
+        for thing in leaving:
+            state = thing.handoff_state()
+            state["zone"] = self.index
+
+            if isinstance(thing, Player):
+                state["kind"] = "player"
+                state["connection_id"] = thing.player_connection.connection_id
+                del self.__connections[state["connection_id"]]
+                del self.__players[state["connection_id"]]
+            else:
+                state["kind"] = "npc"
+
+            thing.hand_off()
+
+            # The players here who know about the Thing go on seeing it, as a ghost, as long as it is near the
+            # boundary.
+            x = state["position"][0]
+            state["ghosted"] = self.low - margin <= x <= self.high + margin
+            if state["ghosted"]:
+                Player.substitute_everywhere(thing, self.game_state.ghosts.add(state))
+            else:
+                Player.forget_everywhere(thing)
+
+            handoffs.append((self.zone_map.zone_for(x), state))
+
+        return handoffs
+
+    def __ghost_updates(self):
+        """Work out what each neighbour needs to know about the Things
+        near its boundary.  Returns a list of (zone, (added, changed,
+        removed)) pairs, in the form taken by GhostStore.update."""
+
+        margin = self.zone_map.ghost_margin
+        updated = self.game_state.updated_things
+        updates = []
+
+        for neighbour, sent in self.__ghosted.iteritems():
+            if neighbour < self.index:
+                low, high = self.low, self.low + margin
+            else:
+                low, high = self.high - margin, self.high
+
+            near = [thing for thing in Thing.all_things() if low <= thing.get_position().x <= high]
+            if self.game_state.npcs is not None:
+                near.extend(self.game_state.npcs.between(low, high))
+
+            # As for players, ghosts are only updated when the owner would send an update about the Thing, and
+            # then only if its state has actually changed.
+            added = []
+            changed = []
+            seen = set()
+            for thing in near:
+                thing_id = thing.id
+                seen.add(thing_id)
+                if thing_id not in sent:
+                    state = sent[thing_id] = thing.get_state()
+                    added.append((thing_id, thing.name, thing.height, thing.radius, state))
+                elif thing in updated or sent[thing_id] is None:
+                    state = thing.get_state()
+                    if state != sent[thing_id]:
+                        sent[thing_id] = state
+                        changed.append((thing_id, state))
+
+            removed = list(set(sent) - seen)
+            for thing_id in removed:
+                del sent[thing_id]
+
+            if added or changed or removed:
+                updates.append((neighbour, (added, changed, removed)))
+
+        return updates
+
+def _run_zone(zone_map, index, pipe):
+    # The coordinator decides when to stop, and the workers stop when it does.  Without this, pressing Ctrl-C in
+    # the terminal would interrupt every process.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    Thing.ids = IdAllocator(stride=zone_map.count, offset=index)
+    Thing.number_names(index + 1, zone_map.count)
+
+    zone = Zone(zone_map, index, pipe)
+    profiler.install(zone.game_state.ticker)
+    zone.run()
+
+class ZoneFailed(Exception):
+
+    """A zone worker has died, so the world can't be simulated any
+    more."""
+
+class ZoneProcess(object):
+
+    """The coordinator's handle on a zone worker.  events holds the
+    events to be sent to the zone at the start of the next tick, and
+    the other attributes are the statistics the zone sent back after
+    the last one."""
+
+    def __init__(self, zone_map, index):
+        self.index = index
+        self.events = []
+        self.tick_duration = 0.0
+        self.things = 0
+        self.players = 0
+
+        self.pipe, worker_pipe = multiprocessing.Pipe()
+        self.process = multiprocessing.Process(target=_run_zone, args=(zone_map, index, worker_pipe),
+                                               name="Zone %d" % index)
+        self.process.daemon = True
+        self.process.start()
+        worker_pipe.close()
+
+class RemotePlayer(object):
+
+    """Stands in, on the coordinator, for a player whose avatar is
+    simulated by a zone worker.  FruitRequestHandler calls the same
+    methods as it would on a Player, and they are passed on to
+    whichever zone owns the avatar."""
+
+    def __init__(self, coordinator, connection, connection_id, zone):
+        self.coordinator = coordinator
+        self.connection = connection
+        self.connection_id = connection_id
+        self.zone = zone
+
+    def queue_input(self, sequence, controls):
+        self.zone.events.append(("input", self.connection_id, sequence, controls))
+
+    def set_keepalive(self, interval):
+        self.zone.events.append(("keepalive", self.connection_id, interval))
+
+    def acknowledge_snapshot(self, tick):
+        self.zone.events.append(("ack", self.connection_id, tick))
+
+    def destroy(self):
+        self.coordinator.remove_player(self)
+
+class Coordinator(object):
+
+    """Runs the game when the world is split into zones.  The
+    coordinator takes the place of the GameState in the main process:
+    it owns the clients' connections, and passes each player's
+    messages on to the zone which owns the player's avatar.
+
+    The zones run in lockstep with the coordinator's ticks.  At the
+    start of each tick, the coordinator sends every zone its events,
+    and the zones all run their ticks at the same time, on separate
+    cores.  The coordinator then collects the results, forwarding the
+    messages for the clients unchanged, and routing the Things which
+    were handed over, and the changes to the ghosts, to the zones
+    they are for.  Those are applied at the start of the next tick,
+    before anything else, so every zone sees a consistent world.
+
+    If a zone worker dies, the coordinator stops the others and shuts
+    the server down."""
+
+    metrics_log = None
+    checkpointer = None
+
+    def __init__(self, network, zone_map, zones):
+        self.network = network
+        self.zone_map = zone_map
+        self.zones = zones
+        self.tick = 0
+        self.ticker = TickScheduler(config.getfloat("game", "tick-rate"), config.getint("game", "max-catch-up-ticks"),
+                                    self.update)
+        self.__players = {}
+        self.__next_connection_id = 0
+
+        registry = metrics.registry
+        registry.gauge("fruit_zone_tick_duration_seconds", "Time taken by each zone's last tick.",
+                       lambda: [({"zone": zone.index}, zone.tick_duration) for zone in self.zones])
+        registry.gauge("fruit_zone_things", "Things in each zone, including players.",
+                       lambda: [({"zone": zone.index}, zone.things) for zone in self.zones])
+        registry.gauge("fruit_zone_players", "Players in each zone.",
+                       lambda: [({"zone": zone.index}, zone.players) for zone in self.zones])
+
+    def run(self):
+        try:
+            self.ticker.run()
+        except ZoneFailed as e:
+            print >>sys.stderr, e
+            sys.exit(1)
+        finally:
+            self.stop()
+
+    def stop(self):
+        """Tell the zone workers to stop, and wait for them.  Any which
+        don't stop within a few seconds are killed."""
+
+        for zone in self.zones:
+            try:
+                zone.pipe.send(None)
+            except EnvironmentError:
+                pass
+
+        for zone in self.zones:
+            zone.process.join(5)
+            if zone.process.is_alive():
+                zone.process.terminate()
+                zone.process.join()
+
+    def __zone_failed(self, zone, error):
+        # The dead zone's Things, players included, are gone, and the other zones can't carry on without the
+        # handoffs and ghosts it would have sent, so the server stops rather than running a world with a hole
+        # in it.  The workers are stopped first, so that none are left behind.
+        self.stop()
+        raise ZoneFailed("Zone %d has stopped (exit code %s, %s), so the server is shutting down." %
+                         (zone.index, zone.process.exitcode, error or "no reply"))
+
+    def add_player(self, connection, user_id, session_token):
+        """A client has logged in.  Tell the zone where new players
+        appear to create the player, and return a RemotePlayer."""
+
+        self.__next_connection_id += 1
+        zone = self.zones[self.zone_map.zone_for(START_LOCATION[0])]
+        player = self.__players[self.__next_connection_id] = \
+            RemotePlayer(self, connection, self.__next_connection_id, zone)
+        zone.events.append(("join", player.connection_id, user_id, session_token))
+        return player
+
+    def remove_player(self, player):
+        del self.__players[player.connection_id]
+        player.zone.events.append(("leave", player.connection_id))
+
+    def update(self, dt):
+        self.network.process_messages()
+        self.tick += 1
+
+        lagging = frozenset(connection_id for connection_id, player in self.__players.iteritems()
+                            if player.connection.lagging)
+        for zone in self.zones:
+            events, zone.events = zone.events, []
+            try:
+                zone.pipe.send((self.tick, events, lagging))
+            except EnvironmentError as e:
+                self.__zone_failed(zone, e)
+
+        for zone in self.zones:
+            try:
+                frames, handoffs, ghosts, releases, stats = zone.pipe.recv()
+            except (EOFError, EnvironmentError) as e:
+                self.__zone_failed(zone, e)
+            zone.tick_duration, zone.things, zone.players = stats
+
+            for connection_id, (data, count) in frames.iteritems():
+                player = self.__players.get(connection_id)
+                if player is not None:
+                    player.connection.send_frames(data, count)
+
+            for destination, state in handoffs:
+                self.zones[destination].events.append(("arrive", state))
+                if state["kind"] == "player":
+                    self.__players[state["connection_id"]].zone = self.zones[destination]
+
+            for destination, update in ghosts:
+                self.zones[destination].events.append(("ghosts", update))
+
+            # An ID can only be reused by the zone which allocated it.
+            for thing_id in releases:
+                self.zones[thing_id % len(self.zones)].events.append(("release", thing_id))
+
+        if self.metrics_log is not None:
+            self.metrics_log.tick(time())
+
+def configured_map():
+    """Return the ZoneMap described in the zones section of the
+    configuration file, or None if the world isn't split into zones."""
+
+    count = config.getint("zones", "count")
+    if count <= 1:
+        return None
+
+    return ZoneMap(count, config.getfloat("zones", "width"), config.getfloat("zones", "ghost-margin"))
+
+def start_workers(zone_map):
+    """Start a worker process for each zone, and return their
+    ZoneProcesses.  The workers are forked, so this must be called
+    before any threads are started or sockets opened, so that the
+    workers don't inherit them."""
+
+    print >>sys.stderr, "Splitting the world into %d zones." % zone_map.count
+    return [ZoneProcess(zone_map, index) for index in xrange(zone_map.count)]
@@ -0,0 +1,186 @@
+# The order of the fields in a state tuple, and the names of the corresponding fields in ThingDelta.
+DELTA_FIELDS = ("x", "y", "z", "velocity_x", "velocity_y", "velocity_z", "angle", "angular_velocity")
+
+class Quantizer(object):
+
+    """Converts the state of a Thing (location, velocity, heading and
+    angular velocity) to and from a tuple of integers.  Locations and
+    velocities are stored as multiples of position_precision, and
+    angles and angular velocities are stored as multiples of
+    angle_precision.
+
+    Integers are used because they compare exactly, so it is easy to
+    tell whether anything has changed, and because small integers
+    take up very little space in a protobuf message."""
+
+    def __init__(self, position_precision, angle_precision):
+        self.position_precision = position_precision
+        self.angle_precision = angle_precision
+
+    def quantize(self, location, velocity, angle, angular_velocity):
+        p = self.position_precision
+        a = self.angle_precision
+        return (int(round(location.x / p)), int(round(location.y / p)), int(round(location.z / p)),
+                int(round(velocity.x / p)), int(round(velocity.y / p)), int(round(velocity.z / p)),
+                int(round(angle / a)), int(round(angular_velocity / a)))
+
+    def dequantize(self, state):
+        p = self.position_precision
+        a = self.angle_precision
+        return (state[0] * p, state[1] * p, state[2] * p, state[3] * p, state[4] * p, state[5] * p,
+                state[6] * a, state[7] * a)
+
+    def fill_thing_state(self, data, thing_id, state):
+        """Write a state tuple into a ThingState message, for clients
+        which are receiving full snapshots."""
+
+        data.id = thing_id
+        (data.location.x, data.location.y, data.location.z,
+         data.velocity.x, data.velocity.y, data.velocity.z,
+         data.angle, data.angular_velocity) = self.dequantize(state)
+
+class SnapshotEncoder(object):
+
+    """Encodes WorldSnapshots for one client as deltas against the
+    last snapshot the client acknowledged.  Only the fields which
+    changed since then are sent.
+
+    We remember what the client's view of the world will be after each
+    snapshot we send (the "view" is a dictionary mapping Thing IDs to
+    state tuples).  When the client acknowledges a snapshot, its view
+    becomes the base for all subsequent deltas, and older views can be
+    thrown away.
+
+    If the client stops acknowledging snapshots, we eventually give up
+    on it and send full states again.  The same happens if the client
+    asks for a resynchronisation by acknowledging snapshot 0, or when
+    a new connection is made (because a new encoder is created)."""
+
+    def __init__(self, history_size):
+        self.history_size = history_size
+        self.full_refresh_needed = False
+        self.__reset()
+
+    def __reset(self):
+        self.__base_tick = 0
+        self.__base_view = {}
+        self.__view = {}
+        self.__history = {}
+
+    def acknowledge(self, tick):
+        if tick == 0:
+            # The client couldn't decode a snapshot.  Forget everything and start again.
+            self.__reset()
+            self.full_refresh_needed = True
+        elif tick in self.__history and tick > self.__base_tick:
+            self.__base_tick = tick
+            self.__base_view = self.__history[tick]
+            for old_tick in [old_tick for old_tick in self.__history if old_tick <= tick]:
+                del self.__history[old_tick]
+
+    def forget(self, thing_id):
+        """The client has been told to remove this Thing, so it will
+        no longer have any record of its state."""
+
+        self.__view.pop(thing_id, None)
+        self.__base_view.pop(thing_id, None)
+        for view in self.__history.itervalues():
+            view.pop(thing_id, None)
+
+    def encode(self, snapshot, thing_id, state):
+        """Add a delta for the Thing to the snapshot, and return it.
+        The delta only becomes part of the client's view when sent is
+        called, so one which turns out not to fit can be deleted from
+        the snapshot again."""
+
+        data = snapshot.deltas.add()
+        data.id = thing_id
+
+        # Fields which are the same as in the base are left out.  If nothing at all has changed, the entry just
+        # contains the ID, which tells the client to put the Thing back where it should be.
+        base = self.__base_view.get(thing_id)
+        for index, value in enumerate(state):
+            if base is None or base[index] != value:
+                setattr(data, DELTA_FIELDS[index], value)
+
+        return data
+
+    def sent(self, thing_id, state):
+        """The delta made by encode is staying in the snapshot."""
+
+        self.__view[thing_id] = state
+
+    def finish(self, snapshot):
+        """Record the client's view of the world after the snapshot
+        has been received."""
+
+        snapshot.base_tick = self.__base_tick
+        self.__history[snapshot.tick] = dict(self.__view)
+        self.full_refresh_needed = False
+
+        if len(self.__history) > self.history_size:
+            # The client has stopped acknowledging snapshots.  The next snapshot will be sent against an empty
+            # base, so it will contain full states.
+            self.__base_tick = 0
+            self.__base_view = {}
+            self.__history.clear()
+
+class SnapshotDecoder(object):
+
+    """Applies WorldSnapshots on the client.  Full snapshots (which
+    contain ThingStates) are simply passed through.  Delta snapshots
+    are applied to our copy of the view which the server used as the
+    base."""
+
+    def __init__(self, quantizer=None):
+        self.quantizer = quantizer
+        self.__current = {}
+        self.__views = {}
+
+    def forget(self, thing_id):
+        self.__current.pop(thing_id, None)
+        for view in self.__views.itervalues():
+            view.pop(thing_id, None)
+
+    def decode(self, snapshot):
+        """Return a list of (Thing ID, state) pairs, where each state is a
+        tuple of floats in the same order as DELTA_FIELDS.  If the
+        snapshot can't be decoded, because we don't have the base it
+        refers to, None is returned and the caller should ask the
+        server to resynchronise."""
+
+        states = [(data.id, (data.location.x, data.location.y, data.location.z,
+                              data.velocity.x, data.velocity.y, data.velocity.z,
+                              data.angle, data.angular_velocity)) for data in snapshot.things]
+
+        if not snapshot.deltas:
+            return states
+
+        if snapshot.base_tick == 0:
+            base_view = {}
+        elif snapshot.base_tick in self.__views:
+            base_view = self.__views[snapshot.base_tick]
+        else:
+            return None
+
+        for data in snapshot.deltas:
+            base = base_view.get(data.id)
+            values = []
+            for index, field in enumerate(DELTA_FIELDS):
+                if data.HasField(field):
+                    values.append(getattr(data, field))
+                elif base is not None:
+                    values.append(base[index])
+                else:
+                    return None
+
+            state = tuple(values)
+            self.__current[data.id] = state
+            states.append((data.id, self.quantizer.dequantize(state)))
+
+        # The server will never again send a delta against a snapshot older than this one's base.
+        for old_tick in [old_tick for old_tick in self.__views if old_tick < snapshot.base_tick]:
+            del self.__views[old_tick]
+
+        self.__views[snapshot.tick] = dict(self.__current)
+        return states
@@ -0,0 +1,57 @@
+import Queue, unittest
+
+from fruit.server.accounts import AccountExists, AccountService, MemoryBackend
+
+class CallbackNetwork(object):
+
+    """Runs the callbacks straight away, on the worker threads, and
+    keeps what they were given."""
+
+    def __init__(self):
+        self.results = Queue.Queue()
+
+    def post_event(self, connection, callback, *args):
+        self.results.put(args)
+
+class AccountServiceTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(self):
+        self.network = CallbackNetwork()
+        self.backend = MemoryBackend()
+        self.accounts = AccountService(self.network, self.backend, 2, 1, 10)
+
+    def call(self, function, *args):
+        function(None, *args, callback=None)
+        return self.network.results.get(timeout=10)
+
+    def test_authenticate(self):
+        self.assertEqual(self.call(self.accounts.create_user, "alice", "secret"), (None, None))
+
+        user, error = self.call(self.accounts.authenticate, "alice", "secret")
+        self.assertIsNone(error)
+        self.assertEqual(user["user_id"], "alice")
+        self.assertNotIn("password", user)
+
+        self.assertEqual(self.call(self.accounts.authenticate, "alice", "wrong"), (None, None))
+        self.assertEqual(self.call(self.accounts.authenticate, "nobody", "secret"), (None, None))
+
+    def test_user_id_in_use(self):
+        self.call(self.accounts.create_user, "bob", "secret")
+        result, error = self.call(self.accounts.create_user, "bob", "other")
+        self.assertIsInstance(error, AccountExists)
+        self.assertEqual(self.call(self.accounts.authenticate, "bob", "other"), (None, None))
+
+    def test_plain_text_password_is_hashed(self):
+        self.backend.create_user({"user_id": "carol", "password": "secret"})
+
+        user, error = self.call(self.accounts.authenticate, "carol", "secret")
+        self.assertEqual(user["user_id"], "carol")
+
+        stored = self.backend.find_user("carol")
+        self.assertNotIn("password", stored)
+        self.assertIn("password_hash", stored)
+        self.assertEqual(self.call(self.accounts.authenticate, "carol", "secret")[0]["user_id"], "carol")
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,52 @@
+import os, shutil, tempfile, time, unittest
+
+from fruit import config
+
+# The server reads its settings when the modules are imported, and Panda's from the current directory.
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+os.chdir(ROOT)
+config.read(os.path.join(ROOT, "server.cfg.sample"))
+
+from fruit.server import checkpoint
+from fruit.server.gamestate import GameState, Player
+
+class IdleNetwork(object):
+    def process_messages(self):
+        pass
+
+class FailedCheckpointTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.filename = os.path.join(self.directory, "world.checkpoint")
+        self.game_state = GameState(IdleNetwork())
+        self.player = Player(self.game_state, None, "alice")
+
+    def tearDown(self):
+        self.player.destroy()
+        shutil.rmtree(self.directory)
+
+    def test_changes_are_logged_when_checkpoint_fails(self):
+        checkpointer = checkpoint.Checkpointer(self.game_state, self.filename, 300, 10, "key",
+                                               checkpoint.SavedWorld())
+        checkpointer.tick(1000)
+
+        # Wait for the first checkpoint, and its log, to be written.
+        deadline = time.time() + 10
+        while not os.path.exists(checkpointer.log_filename) and time.time() < deadline:
+            time.sleep(0.01)
+
+        # The checkpoint is written to a new file first, so a directory in its way makes the next one fail.
+        self.player.move(5, 6, 1)
+        os.mkdir(self.filename + ".new")
+        checkpointer.tick(2000)
+        checkpointer.close()
+
+        saved = checkpoint.load(self.filename)
+        self.assertEqual(saved.sequence, 1)
+        x, y, z, heading = saved.locations["alice"]
+        self.assertAlmostEqual(x, 5, 3)
+        self.assertAlmostEqual(y, 6, 3)
+
+if __name__ == "__main__":
+    unittest.main()
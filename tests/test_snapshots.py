@@ -0,0 +1,81 @@
+import os, unittest
+
+from fruit import config
+
+# The server reads its settings when the modules are imported, and Panda's from the current directory.
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+os.chdir(ROOT)
+config.read(os.path.join(ROOT, "server.cfg.sample"))
+
+from fruit.rpc import game_pb2
+from fruit.server.gamestate import GameState, Player
+
+class IdleNetwork(object):
+    def process_messages(self):
+        pass
+
+class RecordingConnection(object):
+
+    """Keeps the snapshots a Player sends, instead of sending them."""
+
+    lagging = False
+
+    def __init__(self):
+        self.snapshots = []
+
+    def send_rpc(self, msg, low_priority=False):
+        if isinstance(msg, game_pb2.WorldSnapshot):
+            self.snapshots.append(msg)
+        return True
+
+    def cork(self):
+        pass
+
+    def uncork(self):
+        pass
+
+class SnapshotBudgetTest(unittest.TestCase):
+
+    def setUp(self):
+        self.game_state = GameState(IdleNetwork())
+        self.players = []
+
+    def tearDown(self):
+        for player in self.players:
+            player.destroy()
+
+    def check_budget(self, delta_snapshots):
+        self.game_state.delta_snapshots = delta_snapshots
+        self.game_state.client_bandwidth = 6000
+        budget = self.game_state.client_bandwidth * self.game_state.ticker.tick_length
+
+        # Plenty of players close together, so that every client has far more to be told than fits.
+        for index in xrange(40):
+            player = Player(self.game_state, RecordingConnection())
+            player.move(index % 8, index // 8 - 20, 1)
+            self.players.append(player)
+
+        for _ in xrange(10):
+            self.game_state.ticker.run_tick()
+
+        entry_counts = []
+        for player in self.players:
+            for snapshot in player.player_connection.snapshots:
+                entries = len(snapshot.things) + len(snapshot.deltas)
+                entry_counts.append(entries)
+                if entries > 1:
+                    self.assertLessEqual(snapshot.ByteSize(), budget)
+
+        # The test is only meaningful if the budget held some snapshots to more than one entry, and some
+        # entries had to wait.
+        self.assertGreater(max(entry_counts), 1)
+        self.assertLess(max(entry_counts), len(self.players))
+
+    def test_full_snapshots_fit_budget(self):
+        self.check_budget(False)
+
+    def test_delta_snapshots_fit_budget(self):
+        self.check_budget(True)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,52 @@
+import os, unittest
+
+from fruit import config
+
+# The server reads its settings when the modules are imported, and Panda's from the current directory.
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+os.chdir(ROOT)
+config.read(os.path.join(ROOT, "server.cfg.sample"))
+
+from fruit.server import zones
+from fruit.server.gamestate import GameState
+from fruit.server.npcs import NpcStore
+
+class IdleNetwork(object):
+    def process_messages(self):
+        pass
+
+class NpcNameTest(unittest.TestCase):
+
+    def test_zones_name_npcs_differently(self):
+        names = []
+        for zone in xrange(3):
+            store = NpcStore(GameState(IdleNetwork()), 1, 10, seed=zone)
+            store.number_names(zone + 1, 3)
+            store.spawn(20)
+            names.extend(npc.name for npc in store)
+
+        self.assertEqual(len(set(names)), len(names))
+
+class WorkerFailureTest(unittest.TestCase):
+
+    def setUp(self):
+        zone_map = zones.ZoneMap(3, 500, 120)
+        self.workers = zones.start_workers(zone_map)
+        self.coordinator = zones.Coordinator(IdleNetwork(), zone_map, self.workers)
+
+    def tearDown(self):
+        self.coordinator.stop()
+
+    def test_dead_worker_stops_the_others(self):
+        self.coordinator.update(0)
+
+        dead = self.workers[1].process
+        dead.terminate()
+        dead.join()
+
+        self.assertRaises(zones.ZoneFailed, self.coordinator.update, 0)
+        for zone in self.workers:
+            self.assertFalse(zone.process.is_alive())
+
+if __name__ == "__main__":
+    unittest.main()